@@ -469,7 +469,16 @@ def run_interactive_job(jobid, user, disable_preboot, nodes, procs):
             start_session(location[0], resid, nodes, procs)
             break
         client_utils.logger.debug('Current State "%s" for job %s', str(state), str(jobid))
-        sleep(2)
+        try:
+            # returns as soon as the job starts running, rather than after a fixed sleep.  A call that comes straight back
+            # was not held, as the queue manager had as many waiters as it allows, so back off.
+            start = time.time()
+            if client_utils.component_call(QUEMGR, False, 'wait_jobs', ([{'tag':'job', 'jobid':jobid}], 'running', 60), False) \
+                    and time.time() - start < 1:
+                sleep(2)
+        except xmlrpclib.Fault as fault:
+            client_utils.logger.debug('Error waiting for job: %s', fault)
+            sleep(2)
 
     return deljob
 
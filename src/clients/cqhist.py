@@ -24,6 +24,7 @@ __version__ = '$Version$'
 
 # Python imports
 import sys
+import time
 from optparse import OptionParser
 
 # Application imports
@@ -54,6 +55,18 @@ if __name__ == '__main__':
     parser.add_option( "-q", "--queue", default=None,
                        action="store", type="string", dest="queue",
                        help="display only jobs from this queue" )
+    parser.add_option( "-p", "--project", default=None,
+                       action="store", type="string", dest="project",
+                       help="display only jobs charged to this project" )
+    parser.add_option( "-e", "--exit", default=None,
+                       action="store", type="int", dest="exit",
+                       help="display only jobs with this exit status" )
+    parser.add_option( "", "--start", default=None,
+                       action="store", type="string", dest="start",
+                       help="display only jobs that ended at or after START (YYYY-MM-DD[ HH:MM:SS])" )
+    parser.add_option( "", "--end", default=None,
+                       action="store", type="string", dest="end",
+                       help="display only jobs that ended before END (YYYY-MM-DD[ HH:MM:SS])" )
 
 
     # Output length
@@ -76,6 +89,20 @@ if __name__ == '__main__':
     # Get the options
     (options, args) = parser.parse_args()
 
+    def parse_date(option, value):
+        if value is None:
+            return None
+        for date_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                return time.mktime(time.strptime(value, date_format))
+            except ValueError:
+                pass
+        parser.error("%s must be YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS'" % option)
+    start = parse_date("--start", options.start)
+    end = parse_date("--end", options.end)
+    if options.lines < 1:
+        parser.error("-n must be at least 1")
+
     # default headers used for querying job history and output
     long_header = ("EndTime", "JobID", "User",
                    "WallTime", "QueuedTime", "RunTime",
@@ -103,18 +130,31 @@ if __name__ == '__main__':
 #         jobs = cqm.get_history([query])
 #     except (ComponentLookupError):
 #     print "Trouble connecting to queue manager, falling back to log files"
-    cqp = cqparse.CobaltLogParser()
-    cqp.perform_default_parse()
-    jobs = cqp.q_get([query])
+    jobs = None
+    count = None
+    try:
+        # the index answers any range of dates without rereading the logs.  update keeps
+        # what it reads in memory if the index is not ours to write, so it is never behind.
+        index = cqparse.HistoryIndex()
+        try:
+            index.update()
+            filters = dict(user=options.username, queue=options.queue, project=options.project,
+                           exit_status=options.exit, start=start, end=end)
+            # the header counts every matching job, not just the ones shown
+            count = index.count(**filters)
+            jobs = index.query(limit=options.lines, **filters)
+        finally:
+            index.close()
+    except Exception, err:
+        print >> sys.stderr, "history index unavailable, reading the last %d days of logs: %s" % \
+            (cqparse.DEFAULT_DAYS, err)
+    if jobs is None:
+        cqp = cqparse.CobaltLogParser()
+        cqp.perform_default_parse()
+        jobs = cqp.q_get([query])
 
     jobs = [j.to_rx() for j in jobs]
 
-    #
-    # Get the statistics
-    #
-    if not options.noheader:
-        print "Cobalt queue history (%i jobs):" % (len(jobs))
-
     #
     # Filter the jobs using the specified selection criteria
     #
@@ -122,15 +162,30 @@ if __name__ == '__main__':
         jobs = [ job for job in jobs if job['user'] == options.username ]
     if options.queue:
         jobs = [ job for job in jobs if job['queue'] == options.queue ]
+    if options.project:
+        jobs = [ job for job in jobs if job['account'] == options.project ]
+    if options.exit is not None:
+        jobs = [ job for job in jobs if str(job['exit']) == str(options.exit) ]
+    if start is not None:
+        jobs = [ job for job in jobs if job['end_time'] >= start ]
+    if end is not None:
+        jobs = [ job for job in jobs if job['end_time'] < end ]
 
     # Now, sort the jobs
     js = [ (job['endtime'], job) for job in jobs ]
     js.sort()
     jobs = [ job[1] for job in js ]
 
+    #
+    # Get the statistics
+    #
+    if count is None:
+        count = len(jobs)
+    if not options.noheader:
+        print "Cobalt queue history (%i jobs):" % (count)
+
     # Finally, truncate the results  
-    if options.lines:
-        jobs = jobs[-abs(options.lines):]
+    jobs = jobs[-options.lines:]
 
     #
     # Print the standard output
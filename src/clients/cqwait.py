@@ -52,13 +52,17 @@ if __name__ == '__main__':
             raise SystemExit, 1
     
     if opts['start']:
-        query = [{'tag':'job', 'jobid':jid, 'is_active':False, 'has_completed':False} for jid in args]
+        condition = 'started'
     else:
-        query = [{'tag':'job', 'jobid':jid} for jid in args]
+        condition = 'done'
+    query = [{'tag':'job', 'jobid':jid} for jid in args]
     
+    # the queue manager holds each call until the jobs get there or the timeout passes.  A call that comes straight back
+    # unfinished was not held, as the queue manager had as many waiters as it allows, so back off before asking again.
     while True:
-        response = cqm.get_jobs(query)
-        if len(response) == 0:
-            raise SystemExit, 0
-        else:
-            Cobalt.Util.sleep(2)
+        start = time.time()
+        if not cqm.wait_jobs(query, condition, 60):
+            break
+        if time.time() - start < 1:
+            time.sleep(2)
+    raise SystemExit, 0
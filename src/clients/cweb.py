@@ -8,19 +8,25 @@ cweb queries a running Cobalt instance to obtain system configuration
 information, pending and active reservations, queued jobs and running jobs.
 
 This client is intended to run as a daemon and provides the system status as a
-REST-ish service.
+REST-ish service.  The status is kept in a cache refreshed on one background
+cadence and every client is served from it.  The full status carries an ETag
+so unchanged data is not sent again, and /changes?since=VERSION returns only
+the jobs, reservations and nodes changed since that version.
 
 '''
 
 import logging
 import sys
 import time
+import threading
 import traceback
+import xmlrpclib
 from collections import deque, defaultdict
 from logging.handlers import SysLogHandler
 from optparse import OptionParser
-from random import shuffle
+from random import getrandbits, shuffle
 from socket import getfqdn
+from urlparse import parse_qs
 from wsgiref.simple_server import make_server, WSGIRequestHandler
 try:
     import json
@@ -69,6 +75,9 @@ alps_system_query_fields = ['Node_id', 'Name', 'Queues', 'Status', 'Backfill']
 job_query_fields = ['jobid', 'walltime', 'nodes', 'mode', 'queue', 'starttime',
                     'submittime', 'project']
 reservation_query_fields = ['name', 'start', 'duration', 'partitions', 'queue']
+job_states = ('running', 'starting', 'queued')
+# formatted fields that change with the time of the refresh rather than with the job
+relative_time_fields = ('runtimef', 'queuedtimef', 'tminus')
 
 # Maps colors to nodes and partitions
 color_map = {}
@@ -119,17 +128,64 @@ def cobalt_query(state):
         return None
     # Templates for queries to coblat
 
-    query_job = dict.fromkeys(job_query_fields, '*')
     query_res = dict.fromkeys(reservation_query_fields, '*')
     if state == 'reservation':
         return scheduler.get_reservations([query_res])
+    return cqm.get_jobs([job_query(state)])
+
+def job_query(state):
+    '''Return the job query for jobs in state.'''
+    query_job = dict.fromkeys(job_query_fields, '*')
+    query_job['state'] = state
     if state == 'running' or state == 'starting':
-        query_job['state'] = state
         query_job['location'] = '*'
     if state == 'queued':
-        query_job['state'] = 'queued'
         query_job['score'] = '*'
-    return cqm.get_jobs([query_job])
+    return query_job
+
+def format_job(job, state, now, nodeinfo):
+    '''Add the display fields to a job or reservation from a state query,
+    and record the nodes of running and starting jobs in nodeinfo.'''
+    if 'walltime' in job: #walltime is in minutes
+        job['walltimef'] = tdformat(job['walltime'] * 60)
+    if 'duration' in job: #duration is in seconds
+        job['durationf'] = tdformat(job['duration'])
+    if 'location' in job:
+        if system_type in cluster_types:
+            job['locationf'] = merge_nodelist(job['location'])
+        elif system_type in cray_types:
+            #location needs no format changes in this case (?)
+            pass
+        else:
+            # On BGQ jobs only have one location
+            job['location'] = job['location'][0]
+            job['locationf'] = job['location']
+    if state in ['running', 'starting']:
+        if not color_map.get(job['jobid']):
+            color_map[job['jobid']] = color_queue.pop()
+        job['color'] = color_map[job['jobid']]
+        job['runtimef'] = tdformat(now - float(job['starttime']))
+        nodes = job['location']
+        if system_type in bg_types:
+            nodes = partition_table[job['location']]
+        for node in nodes:
+            nodeinfo[node]['jobid'] = job['jobid']
+            nodeinfo[node]['color'] = job['color']
+    if state == 'queued':
+        job['queuedtimef'] = tdformat(now - job['submittime'])
+    if state == 'reservation':
+        job['startf'] = time.strftime('%x %X %Z',
+                                      time.localtime(job['start']))
+        if system_type in cluster_types:
+            nodes = job['partitions'].split(',')
+            job['partitions'] = merge_nodelist(nodes)
+        elif system_type in cray_types:
+            nodes = job['partitions'].split(':')
+        if now > job['start']:
+            job['tminus'] = 'active'
+        else:
+            job['tminus'] = tdformat(job['start'] - now)
+    return job
 
 def get_job_data():
     # Import this here to bypass problems with daemonization
@@ -154,47 +210,9 @@ def get_job_data():
         if state not in ('running', 'starting', 'queued', 'reservation'):
             continue
         for job in jobs[state]:
-            if 'walltime' in job: #walltime is in minutes
-                job['walltimef'] = tdformat(job['walltime'] * 60)
-            if 'duration' in job: #duration is in seconds
-                job['durationf'] = tdformat(job['duration'])
-            if 'location' in job:
-                if system_type in cluster_types:
-                    job['locationf'] = merge_nodelist(job['location'])
-                elif system_type in cray_types:
-                    #location needs no format changes in this case (?)
-                    pass
-                else:
-                    # On BGQ jobs only have one location
-                    job['location'] = job['location'][0]
-                    job['locationf'] = job['location']
-            if state in ['running', 'starting']:
-                if not color_map.get(job['jobid']):
-                    color_map[job['jobid']] = color_queue.pop()
-                job['color'] = color_map[job['jobid']]
-                job['runtimef'] = tdformat(now - float(job['starttime']))
-                nodes = job['location']
-                if system_type in bg_types:
-                    nodes = partition_table[job['location']]
-                for node in nodes:
-                    jobs['nodeinfo'][node]['jobid'] = job['jobid']
-                    jobs['nodeinfo'][node]['color'] = job['color']
-            if state == 'queued':
-                job['queuedtimef'] = tdformat(now - job['submittime'])
-            if state == 'reservation':
-                job['startf'] = time.strftime('%x %X %Z',
-                                              time.localtime(job['start']))
-                if system_type in cluster_types:
-                    nodes = job['partitions'].split(',')
-                    job['partitions'] = merge_nodelist(nodes)
-                elif system_type in cray_types:
-                    nodes = job['partitions'].split(':')
-                if now > job['start']:
-                    job['tminus'] = 'active'
-                else:
-                    job['tminus'] = tdformat(job['start'] - now)
-            for node in node_state:
-                jobs['nodeinfo'][node]['state'] = node_state[node]
+            format_job(job, state, now, jobs['nodeinfo'])
+    for node in node_state:
+        jobs['nodeinfo'][node]['state'] = node_state[node]
     return json.dumps(jobs, separators=(',', ':'))
 
 def fetch_hardware():
@@ -233,6 +251,205 @@ def fetch_hardware():
     return system_type
 
 
+def stable_fields(item):
+    '''Return item without the fields that only change with the time of the refresh.'''
+    return dict((key, value) for key, value in item.iteritems()
+                if key not in relative_time_fields)
+
+def log_exception():
+    '''Log the current exception to our logger a line at a time.'''
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    for line in traceback.format_exception(exc_type, exc_value, exc_traceback):
+        for sub_line in line.splitlines():
+            logger.error(sub_line)
+
+
+class VersionedTable(object):
+    '''Items by key, each stamped with the cache version it last changed in.
+    Removed keys are remembered for history versions.'''
+
+    def __init__(self, history):
+        self.history = history
+        self.horizon = 0
+        self.items = {}
+        self.stamps = {}
+        self.removed = {}
+
+    def update(self, items, version):
+        '''Replace the items, stamping the ones added or changed with version.'''
+        for key in self.items:
+            if key not in items:
+                del self.stamps[key]
+                self.removed[key] = version
+        for key, item in items.iteritems():
+            old = self.items.get(key)
+            if old is None or stable_fields(old) != stable_fields(item):
+                self.stamps[key] = version
+                self.removed.pop(key, None)
+        self.items = items
+        self.horizon = max(self.horizon, version - self.history)
+        for key, removed in self.removed.items():
+            if removed <= self.horizon:
+                del self.removed[key]
+
+    def since(self, version):
+        '''Return the items changed and the keys removed after version.'''
+        changed = dict((key, self.items[key]) for key, stamp in self.stamps.iteritems()
+                       if stamp > version)
+        removed = [key for key, stamp in self.removed.iteritems() if stamp > version]
+        return changed, removed
+
+
+class StatusCache(object):
+    '''Job, reservation and node status, refreshed on one cadence for every client.
+
+    Jobs are fetched from the queue-manager's change feed, so a refresh only
+    transfers the jobs that changed.  Each refresh that completes is a new
+    version; the full status is serialized once per version and every job,
+    reservation and node entry is stamped with the version it last changed in.
+    Versions are handed out as EPOCH.NUMBER, where the epoch is unique to this
+    process, so a version from before a restart is never taken for a current
+    one.
+    '''
+
+    def __init__(self, history=360):
+        self.lock = threading.Lock()
+        self.epoch = '%x%04x' % (int(time.time()), getrandbits(16))
+        self.version = 0
+        self.updated = 0
+        self.generation = 0
+        self.raw_jobs = {}
+        self.jobs = VersionedTable(history)
+        self.reservations = VersionedTable(history)
+        self.nodes = VersionedTable(history)
+        self.status = None
+
+    def refresh(self, hardware=False):
+        '''Fetch the changes from Cobalt and publish a new version.'''
+        if hardware or system_type is None:
+            fetch_hardware()
+        cqm = ComponentProxy('queue-manager', defer=True)
+        specs = [job_query(state) for state in job_states]
+        try:
+            changes = cqm.get_jobs_since(self.generation, specs)
+        except xmlrpclib.Fault as fault:
+            if fault.faultString != 'get_jobs_since': # NoExposedMethod
+                raise
+            # the queue-manager predates the change feed; fetch every job
+            changes = {'generation': 0, 'complete': True, 'deleted': [], 'items': cqm.get_jobs(specs)}
+        if changes['complete']:
+            self.raw_jobs = {}
+        for jobid in changes['deleted']:
+            self.raw_jobs.pop(jobid, None)
+        for job in changes['items']:
+            self.raw_jobs[job['jobid']] = job
+        self.generation = changes['generation']
+        raw_reservations = cobalt_query('reservation')
+
+        now = time.time()
+        check_finished([job['jobid'] for job in self.raw_jobs.itervalues()
+                        if job['state'] in ('running', 'starting')])
+        nodeinfo = defaultdict(dict)
+        jobs = {}
+        for jobid, raw_job in self.raw_jobs.iteritems():
+            # only the fields a query for this state returns
+            fields = job_query(raw_job['state'])
+            job = dict((key, value) for key, value in raw_job.iteritems() if key in fields)
+            jobs[jobid] = format_job(job, raw_job['state'], now, nodeinfo)
+        reservations = dict((res['name'], format_job(res, 'reservation', now, nodeinfo))
+                            for res in raw_reservations)
+        for node in node_state:
+            nodeinfo[node]['state'] = node_state[node]
+
+        with self.lock:
+            self.version += 1
+            self.updated = int(now)
+            self.jobs.update(jobs, self.version)
+            self.reservations.update(reservations, self.version)
+            self.nodes.update(dict(nodeinfo), self.version)
+            status = self._document(self.jobs.items, self.reservations.items, self.nodes.items)
+            self.status = ('"%s"' % self.version_name(self.version), json.dumps(status, separators=(',', ':')))
+
+    def version_name(self, version):
+        return '%s.%d' % (self.epoch, version)
+
+    def parse_version(self, name):
+        '''Return the version number for a version name, or 0 for a version
+        from another epoch.  Raises ValueError if name is not a version.'''
+        if name == '0':
+            return 0
+        epoch, version = name.split('.')
+        version = int(version)
+        if epoch != self.epoch:
+            return 0
+        return version
+
+    def _document(self, jobs, reservations, nodeinfo):
+        document = {'version': self.version_name(self.version),
+                    'lastUpdated': self.updated,
+                    'nodeinfo': nodeinfo,
+                    'indexes': indexes,
+                    'reservation': [reservations[name] for name in sorted(reservations)],
+                    'systemType': system_type,
+                    }
+        for state in job_states:
+            document[state] = []
+        for jobid in sorted(jobs):
+            document[jobs[jobid]['state']].append(jobs[jobid])
+        return document
+
+    def changes(self, since):
+        '''Return the JSON status of what changed after the version named
+        since, or None if there is no status yet.
+
+        If since is 0, from another epoch, newer than the current version or
+        too old to know what was removed since, every entry is returned and
+        'complete' is true.  Raises ValueError if since is not a version.
+        '''
+        since = self.parse_version(since)
+        with self.lock:
+            if self.status is None:
+                return None
+            complete = since <= 0 or since > self.version or since < self.jobs.horizon
+            if complete:
+                since = 0
+            jobs, deleted_jobs = self.jobs.since(since)
+            reservations, deleted_reservations = self.reservations.since(since)
+            nodeinfo, deleted_nodes = self.nodes.since(since)
+            document = self._document(jobs, reservations, nodeinfo)
+        document['complete'] = complete
+        document['deleted'] = {'jobs': deleted_jobs,
+                               'reservations': deleted_reservations,
+                               'nodes': deleted_nodes}
+        return json.dumps(document, separators=(',', ':'))
+
+    def run(self, interval, hardware_interval):
+        '''Refresh every interval seconds, refetching hardware every
+        hardware_interval seconds.'''
+        last_hardware = 0
+        while True:
+            start = time.time()
+            try:
+                hardware = start - last_hardware >= hardware_interval
+                self.refresh(hardware)
+                if hardware:
+                    last_hardware = start
+            except Exception:
+                # Most common cause of breakage is a need to refetch
+                # hardware.
+                log_exception()
+                last_hardware = 0
+            time.sleep(max(0, interval - (time.time() - start)))
+
+    def start(self, interval, hardware_interval):
+        '''Start refreshing in a background thread.'''
+        thread = threading.Thread(target=self.run, args=(interval, hardware_interval))
+        thread.setDaemon(True)
+        thread.start()
+
+status_cache = StatusCache()
+
+
 def immediate_run():
     '''run queries and immediately print json output.  Exit immediately
     afterward. Return a valid exit status.'''
@@ -249,16 +466,37 @@ def immediate_run():
     return 0
 
 def app(environ, start_response):
-    '''set application infomration'''
-    status = '200 OK'
+    '''Serve the cached status.  /changes?since=VERSION returns what changed
+    after VERSION, anything else the full status with an ETag.'''
+    path = environ.get('PATH_INFO', '')
     headers = [('Content-type', 'application/json')]
-    start_response(status, headers)
 
     # Allow a method for checking status of server without querying cobalt
-    if 'ping' in environ['PATH_INFO']:
-        return 'PONG\n'
+    if 'ping' in path:
+        start_response('200 OK', headers)
+        return ['PONG\n']
 
-    return get_job_data()
+    if path.rstrip('/') == '/changes':
+        try:
+            body = status_cache.changes(parse_qs(environ.get('QUERY_STRING', '')).get('since', ['0'])[0])
+        except ValueError:
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return ['since must be a status version\n']
+    else:
+        etag, body = status_cache.status or (None, None)
+        if etag is not None:
+            headers.extend([('ETag', etag), ('Cache-Control', 'no-cache')])
+            if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+            if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+                start_response('304 Not Modified', headers[1:])
+                return []
+
+    if body is None:
+        start_response('503 Service Unavailable', [('Content-type', 'text/plain')])
+        return ['status not fetched from Cobalt yet\n']
+    headers.append(('Content-Length', str(len(body))))
+    start_response('200 OK', headers)
+    return [body]
 
 def get_opts_and_args():
     '''parse out options and extract arguments'''
@@ -280,6 +518,10 @@ def get_opts_and_args():
                       default=None, help='additional fields to query for reservations')
     parser.add_option('--node-fields', dest='node_fields', action='store',
                       default=None, help='additional fields to query for nodes')
+    parser.add_option('-r', '--refresh', dest='refresh', default=10, type='float',
+                      help='seconds between status refreshes')
+    parser.add_option('--hardware-refresh', dest='hardware_refresh', default=60, type='float',
+                      help='seconds between node and partition refreshes')
 
     return parser.parse_args()
 
@@ -326,7 +568,8 @@ def main():
 
     if options.debug:
         # enable a simple ping-pong server for debugging.
-        print json.dumps(json.loads(app({}, lambda x, y: None)), indent=4)
+        status_cache.refresh(True)
+        print json.dumps(json.loads(''.join(app({}, lambda x, y: None))), indent=4)
         sys.exit(0)
 
     if options.immediate_return:
@@ -341,24 +584,19 @@ def main():
         context = daemon.DaemonContext(pidfile=pidfile, files_preserve=files)
         with context:
             logger.info('Starting server on port %d...\n', options.port)
+            # the refresh thread has to start in the daemonized process
+            status_cache.start(options.refresh, options.hardware_refresh)
             while 1:
                 try:
-                    # Most common cause of breakage is a need to refetch
-                    # hardware.
-                    fetch_hardware()
                     httpd.serve_forever()
                 except Exception:
                     # When we get exceptions, let's print them out to our
                     # logger and continue on with operation.
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    for line in traceback.format_exception(exc_type,
-                                                           exc_value,
-                                                           exc_traceback):
-                        for sub_line in line.splitlines():
-                            logger.error(sub_line)
+                    log_exception()
     else:
         logger.addHandler(logging.StreamHandler(sys.stdout))
         logger.info('Starting server on port %d...\n', options.port)
+        status_cache.start(options.refresh, options.hardware_refresh)
         httpd.serve_forever()
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+"""Incremental component statefiles.
+
+A checkpointed statefile is a full snapshot of a component plus a journal
+(the statefile name with ".journal" appended) of the checkpoints taken since.
+Components that keep a ChangeFeed of their bulk items (cqm's jobs) have those
+items pickled separately: the component itself refers to them by key, and
+each journal record holds only the items that changed or went away since the
+previous checkpoint.  Every snapshot_interval seconds a fresh snapshot
+replaces the statefile and the journal is started over.
+
+Only pickling happens in the caller (normally under the component lock); the
+files are written and synced by a background thread.
+
+Classes:
+StateJournal -- takes checkpoints of a component and writes them out
+
+Functions:
+load_state -- load a component from a statefile, replaying its journal
+"""
+
+__revision__ = '$Revision$'
+
+import os
+import time
+import logging
+import threading
+import Queue
+import cPickle
+from cStringIO import StringIO
+
+SNAPSHOT_MAGIC = 'COBALT-SNAPSHOT 1\n'
+
+logger = logging.getLogger(__name__)
+
+
+# stands in for the component in its pickled state and items (jobs hold bound methods of cqm)
+COMPONENT_ID = ('component',)
+
+def _dumps(obj, component, feed=None):
+    '''Pickle obj, replacing component and the items tracked by feed with persistent ids.'''
+    buf = StringIO()
+    pickler = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+    if feed is not None:
+        items = feed.items
+        key_attr = feed.key
+        def persistent_id(item):
+            if item is component:
+                return COMPONENT_ID
+            key = getattr(item, key_attr, None)
+            if key is not None and items.get(key) is item:
+                return key
+            return None
+    else:
+        def persistent_id(item):
+            if item is component:
+                return COMPONENT_ID
+            return None
+    pickler.inst_persistent_id = persistent_id
+    pickler.dump(obj)
+    return buf.getvalue()
+
+def _load_component(component_cls, state, items):
+    '''Rebuild a component from its state pickled by _dumps, given its pickled items by key.'''
+    component = component_cls.__new__(component_cls)
+    loaded = {}
+    def persistent_load(key):
+        if key == COMPONENT_ID:
+            return component
+        if key not in loaded:
+            loaded[key] = _loads(items[key], persistent_load)
+        return loaded[key]
+    component.__setstate__(_loads(state, persistent_load))
+    return component
+
+def _loads(data, persistent_load):
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+def _fsync_write(filename, data, mode):
+    out = open(filename, mode)
+    try:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+
+
+class StateJournal(object):
+
+    """Checkpoints of a component written to a statefile and its journal.
+
+    Arguments:
+    statefile -- the snapshot file; the journal is statefile + ".journal"
+    snapshot_interval -- seconds between full snapshots.  0 makes every
+                         checkpoint a snapshot.
+
+    Methods:
+    checkpoint -- pickle the changes since the last checkpoint and queue them to be written
+    flush -- wait for queued checkpoints to be written
+    close -- flush and stop the writer thread
+    """
+
+    def __init__(self, statefile, snapshot_interval=300.0):
+        self.statefile = statefile
+        self.journal_file = statefile + ".journal"
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_id = None
+        self.last_snapshot = 0
+        self.generation = 0
+        self.error = None
+        self._writes = Queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def checkpoint(self, component, feed=None):
+        '''Pickle component and queue it to be written.  Returns
+        (seconds spent pickling, whether this is a full snapshot).
+
+        feed is a ChangeFeed of items to store separately from the
+        component, by key.  The component must not change while this runs.
+
+        '''
+        start = time.time()
+        snapshot = (self.snapshot_id is None or feed is None or
+                start - self.last_snapshot >= self.snapshot_interval)
+        if feed is not None:
+            self.generation, complete, changed, removed = feed.since(self.generation)
+            if snapshot:
+                changed = feed.items.values()
+                removed = []
+            elif complete:
+                # the feed lost track of what we last saw; drop anything it no longer holds
+                snapshot = True
+                removed = []
+        else:
+            changed, removed = [], []
+        items = dict([(getattr(item, feed.key), _dumps(item, component)) for item in changed])
+        state = _dumps(component.__getstate__(), component, feed)
+        if snapshot:
+            self.snapshot_id = "%s.%s" % (start, os.getpid())
+            self.last_snapshot = start
+            self._writes.put(('snapshot', (self.snapshot_id, component.__class__, state, items, [])))
+        else:
+            self._writes.put(('journal', (self.snapshot_id, component.__class__, state, items, removed)))
+        return time.time() - start, snapshot
+
+    def flush(self):
+        '''Wait until all queued checkpoints have been written.'''
+        self._writes.join()
+
+    def close(self):
+        self.flush()
+        self._writes.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        while True:
+            work = self._writes.get()
+            try:
+                if work is None:
+                    return
+                kind, record = work
+                data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+                if kind == 'snapshot':
+                    temp_statefile = self.statefile + ".temp"
+                    _fsync_write(temp_statefile, SNAPSHOT_MAGIC + data, "wb")
+                    os.rename(temp_statefile, self.statefile)
+                    # records for the old snapshot are skipped on load anyway
+                    _fsync_write(self.journal_file, "", "wb")
+                else:
+                    _fsync_write(self.journal_file, data, "ab")
+                self.error = None
+            except (IOError, OSError), err:
+                logger.error("statefile failure : %s", err)
+                self.error = err
+                # make sure the next checkpoint is complete on its own
+                self.snapshot_id = None
+            except:
+                logger.error("unexpected statefile failure", exc_info=True)
+                self.snapshot_id = None
+            finally:
+                self._writes.task_done()
+
+
+def load_state(statefile):
+    '''Load a component from statefile, replaying its journal if it has one.
+    Plain pickled statefiles are loaded as they are.
+
+    '''
+    state = open(statefile, "rb")
+    try:
+        if state.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            state.seek(0)
+            return cPickle.load(state)
+        snapshot_id, component_cls, component_state, items, _ = cPickle.load(state)
+    finally:
+        state.close()
+    replayed = 0
+    try:
+        journal = open(statefile + ".journal", "rb")
+    except IOError:
+        journal = None
+    if journal is not None:
+        try:
+            while True:
+                try:
+                    record_id, record_cls, record_state, changed, removed = cPickle.load(journal)
+                except EOFError:
+                    break
+                except Exception:
+                    # a record cut short by a crash; everything before it is good
+                    logger.warning("ignoring incomplete record at the end of %s.journal", statefile)
+                    break
+                if record_id != snapshot_id:
+                    continue
+                component_cls, component_state = record_cls, record_state
+                items.update(changed)
+                for key in removed:
+                    items.pop(key, None)
+                replayed += 1
+        finally:
+            journal.close()
+    logger.info("loaded %s with %d journal records", statefile, replayed)
+    return _load_component(component_cls, component_state, items)
@@ -11,6 +11,7 @@ import sys
 import logging
 import ConfigParser
 import traceback
+from collections import deque
 
 try:
     import json
@@ -64,8 +65,9 @@ class MessageQueue(Component):
         Component.__init__(self, *args, **kwargs)
         self.sync_state = Cobalt.Util.FailureMode("Foreign Data Sync")
         self.connected = False
-        self.msg_queue = []
+        self.msg_queue = deque()
         self.decoder = LogMessageDecoder()
+        self.batch_size = int(get_cdbwriter_config('batch_size', '500'))
 
         self.overflow = False
         self.overflow_filename = None
@@ -89,16 +91,17 @@ class MessageQueue(Component):
         state.update(Component.__getstate__(self))
         state.update({
                 'cdbwriter_version': 1,
-                'msg_queue': self.msg_queue,
+                'msg_queue': list(self.msg_queue),
                 'overflow': self.overflow})
         return state
 
     def __setstate__(self, state):
         Component.__setstate__(self, state)
 
-        self.msg_queue = state['msg_queue']
+        self.msg_queue = deque(state['msg_queue'])
         self.connected = False
         self.decoder = LogMessageDecoder()
+        self.batch_size = int(get_cdbwriter_config('batch_size', '500'))
         self.clearing_overflow = False
         self.overflow_filename = None
         self.overflow_file = None
@@ -149,24 +152,16 @@ class MessageQueue(Component):
             if self.overflow_file:
                 overflow_queue = [self.decoder.decode(line)
                                   for line in self.overflow_file]
-                overflow_queue.extend(self.msg_queue)
-                self.msg_queue = overflow_queue
+                self.msg_queue.extendleft(reversed(overflow_queue))
                 self.close_overflow()
                 self.del_overflow()
                 self.overflow = False
 
         while self.msg_queue and self.connected:
-            msg = self.msg_queue[0]
-
-            try:
-                self.database_writer.addMessage(msg)
-            except db2util.adapterError:
-                logger.error("Error updating databse.  Unable to add message due to adapter error. Message dropped.")
-                logger.debug(traceback.format_exc())
-                self.msg_queue.pop(0)
-            except:
-                logger.error("Error updating databse.  Unable to add message. %s", msg)
-                logger.debug(traceback.format_exc())
+            batch = [self.msg_queue.popleft() for _ in xrange(min(self.batch_size, len(self.msg_queue)))]
+            written = self.database_writer.addMessages(batch)
+            if written < len(batch):
+                self.msg_queue.extendleft(reversed(batch[written:]))
                 self.connected = False
                 #if we were clearing an overflow, here we go again.
                 if ((self.max_queued != None) and
@@ -177,46 +172,47 @@ class MessageQueue(Component):
                         self.queue_to_overflow()
                         self.close_overflow()
 
-                break
-            else:
-                #message added
-                self.msg_queue.pop(0)
-
         self.clearing_overflow = False
 
     iterate = automatic(iterate)
 
 
     def add_message(self, msg):
+        '''Queue a single encoded message for the database.'''
+        self.add_messages([msg])
+
+    add_message = exposed(add_message)
+
+    def add_messages(self, msgs):
+        '''Queue a list of encoded messages for the database, in order.'''
 
         #keep the queue from consuming all memory
         if ((self.max_queued != None) and
-            (len(self.msg_queue) >= self.max_queued)and
+            (len(self.msg_queue) + len(msgs) > self.max_queued)and
             (not self.clearing_overflow)):
 
             self.overflow = True
             self.open_overflow('a')
             if self.overflow_file == None:
-                logger.critical("MESSAGE DROPPED: %s", msg)
+                for msg in msgs:
+                    logger.critical("MESSAGE DROPPED: %s", msg)
             else:
                 self.queue_to_overflow()
                 self.close_overflow()
         #and now queue as normal
 
-        msg_dict = None
-
-        try:
-            msg_dict = self.decoder.decode(msg)
-
-        except ValueError:
-            logger.error("Bad message received.  Failed to decode string %s", msg)
-            return
-        except:
-            logging.debug(traceback.format_exc())
-
-        self.msg_queue.append(msg_dict)
+        for msg in msgs:
+            try:
+                msg_dict = self.decoder.decode(msg)
+            except ValueError:
+                logger.error("Bad message received.  Failed to decode string %s", msg)
+                continue
+            except:
+                logging.debug(traceback.format_exc())
+                continue
+            self.msg_queue.append(msg_dict)
 
-    add_message = exposed(add_message)
+    add_messages = exposed(add_messages)
 
 
     def save_me(self):
@@ -243,20 +239,15 @@ class MessageQueue(Component):
     def queue_to_overflow(self):
 
         elements_written = 0
-        if len(self.msg_queue) == 0:
-            return
-
         while self.msg_queue:
-            msg = self.msg_queue.pop(0)
+            msg = self.msg_queue[0]
             try:
                 self.overflow_file.write(json.dumps(msg, cls=LogMessageEncoder)+'\n')
-                elements_written += 1
             except IOError:
                 logger.error('Could only partially empty queue, %d messages written', elements_written)
-                self.msg_queue.insert(0, msg)
-
-        if elements_written > 0:
-            del self.msg_queue[0:elements_written-1] #empty the queue of what we have written
+                break
+            self.msg_queue.popleft()
+            elements_written += 1
 
         return len(self.msg_queue)
 
@@ -330,6 +321,26 @@ class DatabaseWriter(object):
         #we opened with a schema, let's make that the default for now.
         self.db.prepExec("set current schema %s" % schema)
 
+    def addMessages(self, logMsgs):
+        '''Insert a batch of messages in order.  Messages the adapter rejects
+        are logged and dropped.  Stop at the first other failure, which is
+        taken to be a lost connection.
+
+        Returns the number of messages handled.
+
+        '''
+        for count, logMsg in enumerate(logMsgs):
+            try:
+                self.addMessage(logMsg)
+            except db2util.adapterError:
+                logger.error("Error updating databse.  Unable to add message due to adapter error. Message dropped.")
+                logger.debug(traceback.format_exc())
+            except:
+                logger.error("Error updating databse.  Unable to add message. %s", logMsg)
+                logger.debug(traceback.format_exc())
+                return count
+        return len(logMsgs)
+
     def addMessage(self, logMsg):
         logger.debug("Inserting Data message of type: %s.%s ", logMsg.item_type, logMsg.state)
         #print logMsg
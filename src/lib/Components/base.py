@@ -6,6 +6,7 @@ __revision__ = '$Revision: 2130 $'
 
 __all__ = ["Component", "exposed", "automatic", "run_component"]
 
+import heapq
 import inspect
 import os
 import os.path
@@ -22,10 +23,11 @@ import socket
 import Cobalt
 import Cobalt.Proxy
 import Cobalt.Logging
-from Cobalt.Server import BaseXMLRPCServer, XMLRPCServer, find_intended_location
+from Cobalt.Server import BaseXMLRPCServer, XMLRPCServer, PooledXMLRPCServer, find_intended_location
 from Cobalt.Data import get_spec_fields
 from Cobalt.Exceptions import NoExposedMethod
-from Cobalt.Statistics import Statistics
+from Cobalt.Statistics import Statistics, process_statistics, prometheus_text
+from Cobalt.Checkpoint import StateJournal, load_state
 import Cobalt.Util
 init_cobalt_config = Cobalt.Util.init_cobalt_config
 get_config_option = Cobalt.Util.get_config_option
@@ -172,7 +174,7 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
     if state_name:
         state_file_name = "%s/%s" % (state_file_location(), state_name)
         try:
-            component = cPickle.load(open(state_file_name))
+            component = load_state(state_file_name)
         except:
             component = component_cls(**cls_kwargs)
             component.logger.error("UNABLE TO LOAD STATE FROM %s.  STARTING WITH A BLANK SLATE.", state_file_name, exc_info=True)
@@ -198,8 +200,15 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
         server = BaseXMLRPCServer(location, keyfile=keypath, certfile=certpath,
                           cafile=capath, register=register, timeout=time_out, sleeptime=sleeptime)
     else:
-        server = XMLRPCServer(location, keyfile=keypath, certfile=certpath,
-                          cafile=capath, register=register, timeout=time_out, sleeptime=sleeptime)
+        rpc_workers = int(get_config_option('communication', 'rpc_workers', 0))
+        if rpc_workers > 0:
+            rpc_queue_depth = int(get_config_option('communication', 'rpc_queue_depth', 256))
+            server = PooledXMLRPCServer(location, keyfile=keypath, certfile=certpath,
+                              cafile=capath, register=register, timeout=time_out, sleeptime=sleeptime,
+                              workers=rpc_workers, queue_depth=rpc_queue_depth)
+        else:
+            server = XMLRPCServer(location, keyfile=keypath, certfile=certpath,
+                              cafile=capath, register=register, timeout=time_out, sleeptime=sleeptime)
 
     #Two components of the same type cannot be allowed to run at the same time.
     if component.name != 'service-location':
@@ -213,6 +222,9 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
         server.serve_forever()
     finally:
         server.server_close()
+        # components holding descriptors or signal handlers release them here
+        if hasattr(component, 'close'):
+            component.close()
 
 def exposed (func):
     """Mark a method to be exposed publically.
@@ -266,6 +278,86 @@ def marshal_query_result (items, specs=None):
         fields = None
     return [item.to_rx(fields) for item in items]
 
+class TaskScheduler (object):
+
+    """Runs a component's automatic methods when they are due.
+
+    The automatic methods are found once and kept in a heap ordered by the
+    time each is next due, so the component's task loop can sleep until
+    then.  A method is due automatic_period seconds after it last finished.
+    The run time and lateness (how long after it was due it started) of
+    each task are recorded in the component's statistics, as <name> and
+    <name>.lateness.
+
+    Methods:
+    run_due -- run the tasks that are due
+    next_due -- the time the next task is due
+    wait -- sleep until the next task is due or wake is called
+    wake -- make a task due now
+    """
+
+    def __init__ (self, component):
+        self.component = component
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        for name, func in inspect.getmembers(component, callable):
+            if getattr(func, "automatic", False):
+                heapq.heappush(self._heap, (func.automatic_ts + func.automatic_period, name, func))
+
+    def run_due (self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                due.append(heapq.heappop(self._heap))
+        for due_time, name, func in due:
+            need_to_lock = not getattr(func, 'locking', False)
+            if need_to_lock:
+                self.component.component_lock_acquire()
+            try:
+                mt1 = time.time()
+                func()
+            except:
+                self.component.logger.error("Automatic method %s failed" \
+                                  % (name), exc_info=1)
+            finally:
+                mt2 = time.time()
+                self.component.statistics.add_latency(name, mt2-mt1)
+                self.component.statistics.add_latency('%s.lateness' % name, max(0, mt1 - due_time))
+                if need_to_lock:
+                    self.component.component_lock_release()
+                func.__dict__['automatic_ts'] = time.time()
+                with self._lock:
+                    heapq.heappush(self._heap, (func.automatic_ts + func.automatic_period, name, func))
+
+    def next_due (self):
+        """Return the time the next task is due, or None if there are none."""
+        with self._lock:
+            if self._heap:
+                return self._heap[0][0]
+        return None
+
+    def wait (self, timeout=None, min_wait=0):
+        due = self.next_due()
+        if due is not None:
+            delay = max(min_wait, due - time.time())
+            if timeout is None or delay < timeout:
+                timeout = delay
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def wake (self, name=None):
+        if name is not None:
+            with self._lock:
+                for index, (due_time, task_name, func) in enumerate(self._heap):
+                    if task_name == name:
+                        self._heap[index] = (time.time(), task_name, func)
+                        heapq.heapify(self._heap)
+                        break
+        self._wakeup.set()
+
+
 class Component (object):
 
     """Base component.
@@ -301,7 +393,7 @@ class Component (object):
         else:
             self._registered_component=False
         self.logger = logging.getLogger("%s %s" % (self.implementation, self.name))
-        self._component_lock = threading.Lock()
+        self._component_lock = Cobalt.Util.ReadWriteLock()
         self._component_lock_acquired_time = None
         self.statistics = Statistics()
         self.logger.info("%s:%s component executing on %s", self.name,
@@ -321,7 +413,7 @@ class Component (object):
         else:
             self._registered_component=False
         self.logger = logging.getLogger("%s %s" % (self.implementation, self.name))
-        self._component_lock = threading.Lock()
+        self._component_lock = Cobalt.Util.ReadWriteLock()
         self._component_lock_acquired_time = None
         self.statistics = Statistics()
         self.logger.info("%s:%s component executing on %s", self.name,
@@ -331,21 +423,49 @@ class Component (object):
         entry_time = time.time()
         self._component_lock.acquire()
         self._component_lock_acquired_time = time.time()
-        self.statistics.add_value('component_lock_wait', self._component_lock_acquired_time - entry_time)
+        self.statistics.add_latency('component_lock_wait', self._component_lock_acquired_time - entry_time)
 
     def component_lock_release(self):
-        self.statistics.add_value('component_lock_held', time.time() - self._component_lock_acquired_time)
+        self.statistics.add_latency('component_lock_held', time.time() - self._component_lock_acquired_time)
         self._component_lock_acquired_time = None
         self._component_lock.release()
 
+    def component_read_lock_acquire(self):
+        '''Take the component lock shared with other readers and return the
+        time it was acquired.  Only for methods that do not modify the
+        component.
+
+        '''
+        entry_time = time.time()
+        self._component_lock.acquire_read()
+        acquired_time = time.time()
+        self.statistics.add_latency('component_read_lock_wait', acquired_time - entry_time)
+        return acquired_time
+
+    def component_read_lock_release(self, acquired_time):
+        '''Release a shared hold on the component lock taken at acquired_time'''
+        self.statistics.add_latency('component_read_lock_held', time.time() - acquired_time)
+        self._component_lock.release_read()
+
     def save (self, statefile=None):
         """Pickle the component.
 
+        If [statefiles] journal is enabled, saves to component.statefile
+        are checkpoints (see Cobalt.Checkpoint) written in the background.
+
         Arguments:
         statefile -- use this file, rather than component.statefile
         """
         statefile = statefile or self.statefile
         if statefile:
+            journal = self._get_statefile_journal()
+            if journal is not None and statefile == self.statefile:
+                pause, _ = journal.checkpoint(self, self.checkpoint_feed())
+                self.statistics.add_latency('save_pause', pause)
+                if journal.error is not None:
+                    return str(journal.error)
+                return "state checkpointed to file: %s" % statefile
+            start = time.time()
             temp_statefile = statefile + ".temp"
             data = cPickle.dumps(self)
             try:
@@ -358,33 +478,52 @@ class Component (object):
             else:
                 os.rename(temp_statefile, statefile)
                 return "state saved to file: %s" % statefile
+            finally:
+                self.statistics.add_latency('save_pause', time.time() - start)
     save = exposed(save)
 
+    def _get_statefile_journal (self):
+        """The StateJournal for component.statefile, if [statefiles] journal is enabled."""
+        journal = self.__dict__.get('_statefile_journal')
+        if journal is None and self.statefile and \
+                get_config_option('statefiles', 'journal', 'false').lower() in Cobalt.Util.config_true_values:
+            journal = StateJournal(self.statefile, float(get_config_option('statefiles', 'snapshot_interval', 300)))
+            self._statefile_journal = journal
+        return journal
+
+    def checkpoint_feed (self):
+        """Return a ChangeFeed of items to checkpoint separately from the component, or None."""
+        return None
+
     def do_tasks (self):
-        """Perform automatic tasks for the component.
+        """Perform automatic tasks for the component that are due.
 
         Automatic tasks are member callables with an attribute
         automatic == True.
         """
-        for name, func in inspect.getmembers(self, callable):
-            if getattr(func, "automatic", False):
-                need_to_lock = not getattr(func, 'locking', False)
-                if (time.time() - func.automatic_ts) > func.automatic_period:
-                    if need_to_lock:
-                        self.component_lock_acquire()
-                    try:
-                        mt1 = time.time()
-                        func()
-                    except:
-                        self.logger.error("Automatic method %s failed" \
-                                          % (name), exc_info=1)
-                    finally:
-                        mt2 = time.time()
-                        if not need_to_lock:
-                            self.component_lock_acquire()
-                        self.statistics.add_value(name, mt2-mt1)
-                        self.component_lock_release()
-                        func.__dict__['automatic_ts'] = time.time()
+        self._get_task_scheduler().run_due()
+
+    def wait_for_tasks (self, timeout=None, min_wait=0):
+        """Wait until an automatic task is due or wake_tasks is called, for at most timeout seconds.
+
+        min_wait -- wait at least this long (unless woken), so tasks due continually do not spin
+        """
+        self._get_task_scheduler().wait(timeout, min_wait)
+
+    def next_task_due (self):
+        """Return the time the next automatic task is due, or None if there are none."""
+        return self._get_task_scheduler().next_due()
+
+    def wake_tasks (self, name=None):
+        """Make the named automatic task due now (any waiting in wait_for_tasks returns either way)."""
+        self._get_task_scheduler().wake(name)
+
+    def _get_task_scheduler (self):
+        scheduler = self.__dict__.get('_task_scheduler')
+        if scheduler is None:
+            scheduler = TaskScheduler(self)
+            self._task_scheduler = scheduler
+        return scheduler
 
     def _resolve_exposed_method (self, method_name):
         """Resolve an exposed method.
@@ -416,11 +555,22 @@ class Component (object):
                     self.logger.error(e, exc_info=True)
                 raise xmlrpclib.Fault(getattr(e, "fault_code", 1), str(e))
 
-        need_to_lock = not getattr(method_func, 'locking', False)
-        if need_to_lock:
+        # Methods that do their own locking run unlocked, readonly methods
+        # share the lock with each other and everything else holds it
+        # exclusively.
+        if getattr(method_func, 'locking', False):
+            lock_mode = None
+        elif getattr(method_func, 'readonly', False):
+            lock_mode = 'read'
+        else:
+            lock_mode = 'write'
+        lock_start = time.time()
+        if lock_mode == 'read':
+            self.component_read_lock_acquire()
+        elif lock_mode == 'write':
             self.component_lock_acquire()
+        method_start = time.time()
         try:
-            method_start = time.time()
             result = method_func(*args)
         except Exception, e:
             if getattr(e, "log", True):
@@ -428,10 +578,14 @@ class Component (object):
             raise xmlrpclib.Fault(getattr(e, "fault_code", 1), str(e))
         finally:
             method_done = time.time()
-            if not need_to_lock:
-                self.component_lock_acquire()
-            self.statistics.add_value(method, method_done - method_start)
-            self.component_lock_release()
+            if lock_mode == 'read':
+                self.component_read_lock_release(method_start)
+            elif lock_mode == 'write':
+                self.component_lock_release()
+            self.statistics.add_latency(method, method_done - method_start)
+            if lock_mode is not None:
+                self.statistics.add_latency('%s.lock_wait' % method, method_start - lock_start)
+                self.statistics.add_latency('%s.lock_held' % method, method_done - method_start)
         if getattr(method_func, "query", False):
             if not getattr(method_func, "query_all_methods", False):
                 margs = args[:1]
@@ -476,4 +630,40 @@ class Component (object):
         return self.statistics.display()
     get_statistics = exposed(get_statistics)
 
+    def get_latency_histograms (self):
+        """Get histograms of the time taken by each exposed method"""
+        return self.statistics.display_histograms()
+    get_latency_histograms = exposed(get_latency_histograms)
+
+    def get_metrics (self, window=60):
+        """Get latency percentiles of requests, methods, automatic tasks, lock
+        waits and calls out of the process, since startup and over the last
+        window seconds"""
+        metrics = process_statistics.get_metrics(window)
+        metrics.update(self.statistics.get_metrics(window))
+        return metrics
+    get_metrics = exposed(get_metrics)
+
+    def _export_metrics (self):
+        """Write the latency metrics in the Prometheus text format to
+        <[metrics] prometheus_dir>/<component name>.prom, if it is set."""
+        directory = get_config_option('metrics', 'prometheus_dir', None)
+        if not directory:
+            return
+        window = float(get_config_option('metrics', 'window', 60))
+        labels = {'component':self.name}
+        lines = prometheus_text([self.statistics, process_statistics], labels, window)
+        filename = os.path.join(os.path.expandvars(directory), "%s.prom" % self.name)
+        try:
+            # renamed into place so collectors never read a partial file
+            out = open(filename + ".temp", "w")
+            try:
+                out.write("\n".join(lines) + "\n")
+            finally:
+                out.close()
+            os.rename(filename + ".temp", filename)
+        except (IOError, OSError), err:
+            self.logger.error("unable to write metrics to %s: %s", filename, err)
+    _export_metrics = automatic(locking(_export_metrics), float(get_config_option('metrics', 'export_interval', 60)))
+
 
@@ -28,6 +28,7 @@ import Cobalt.Components.base
 Component = Cobalt.Components.base.Component
 exposed = Cobalt.Components.base.exposed
 automatic = Cobalt.Components.base.automatic
+locking = Cobalt.Components.base.locking
 import Cobalt.Data
 IncrID = Cobalt.Data.IncrID
 import Cobalt.Statistics
@@ -35,6 +36,7 @@ Statistics = Cobalt.Statistics.Statistics
 import Cobalt.Util
 sleep = Cobalt.Util.sleep
 Timer = Cobalt.Util.Timer
+wait_readable = Cobalt.Util.wait_readable
 
 from Cobalt.Util import init_cobalt_config, get_config_option
 
@@ -593,6 +595,8 @@ class BaseChild (object):
             self.parent_postfork()
             return
 
+        # the forker's SIGCHLD handler is of no use to the child
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
         _logger.info("%s: child process %s created to run '%s'", self.label, os.getpid(), self.args[0])
 
         try:
@@ -657,7 +661,14 @@ class BaseForker (Component):
     signal -- signal a child with the specified signame (exposed)
     active_list -- retrieve a list of children which are still running (exposed)
     get_status -- return a dictionary of status information for a finished process (exposed)
+    wait_children -- get_children, waiting for one of the children to complete (exposed)
     wait -- wait on children and record their status (automatic)
+
+    Child exits are noticed through a SIGCHLD handler that writes to a
+    self-pipe, and child stdout pipes are polled for output.  The server
+    waits on both (see wakeup_fds), so children are reaped and their output
+    read as soon as something happens rather than on the next wait_interval;
+    the periodic wait remains as a fallback and drives the death timers.
     """
 
     # name = __name__.split('.')[-1]
@@ -667,6 +678,11 @@ class BaseForker (Component):
 
     UNKNOWN_ERROR = 256
     DEATH_TIMEOUT = 300 # seconds
+    WAIT_CHILDREN_TIMEOUT = float(get_forker_config('wait_children_timeout', 10.0)) # seconds
+
+    # descriptors the server accepts requests on, set by the server so that
+    # wait_children can give way to other clients.
+    server_fds = []
 
     __statefields__ = ['next_task_id', 'children']
 
@@ -683,6 +699,7 @@ class BaseForker (Component):
         self.children = {}
         self.active_runids = []
         self.marked_for_death = {}
+        self._init_child_events()
 
     def __getstate__(self):
         state = {}
@@ -722,6 +739,105 @@ class BaseForker (Component):
             self.marked_for_death = {}
         for child in self.children.values():
             _logger.debug("Child found: %s", child.id)
+        self._init_child_events()
+
+    def _init_child_events(self):
+        '''Set up the pid to child map, the stdout pipe registry and the
+        SIGCHLD self-pipe.  None of these are saved with the state.'''
+        self._children_by_pid = {}
+        for child in self.children.values() + self.marked_for_death.values():
+            if child.pid is not None:
+                self._children_by_pid[child.pid] = child
+        # output pipes of children from a previous forker process are not
+        # ours to read, so only children forked by this process are added.
+        self._stdout_pipes = {} #fd: child
+        if getattr(self, '_sigchld_pipe', None) is not None:
+            self.close()
+        self._sigchld_pipe = None
+        self._prev_sigchld_handler = None
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            self._prev_sigchld_handler = signal.signal(signal.SIGCHLD, self._handle_sigchld)
+            # restart system calls rather than fail them with EINTR
+            signal.siginterrupt(signal.SIGCHLD, False)
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            _logger.warning("Unable to install SIGCHLD handler; children will be reaped every wait_interval")
+            os.close(read_fd)
+            os.close(write_fd)
+        else:
+            self._sigchld_pipe = (read_fd, write_fd)
+
+    def close(self):
+        '''Restore the SIGCHLD handler in place before this forker and close
+        the self-pipe.  Children exiting after this are reaped every
+        wait_interval.'''
+        if self._sigchld_pipe is None:
+            return
+        try:
+            # a handler not installed from python is reported as None
+            previous = self._prev_sigchld_handler
+            signal.signal(signal.SIGCHLD, previous if previous is not None else signal.SIG_DFL)
+        except ValueError:
+            _logger.warning("Unable to restore the SIGCHLD handler")
+        read_fd, write_fd = self._sigchld_pipe
+        self._sigchld_pipe = None
+        self._prev_sigchld_handler = None
+        os.close(read_fd)
+        os.close(write_fd)
+
+    def _handle_sigchld(self, signum, frame):
+        '''Note that a child has exited by writing to the self-pipe.'''
+        try:
+            os.write(self._sigchld_pipe[1], '\0')
+        except (OSError, IOError, TypeError):
+            # pipe full, so a wakeup is already pending, or no pipe at all
+            pass
+
+    def _drain_sigchld_pipe(self):
+        '''Empty the SIGCHLD self-pipe.  Returns True if a child exited since
+        the last call.'''
+        exited = False
+        if self._sigchld_pipe is None:
+            return exited
+        while True:
+            try:
+                data = os.read(self._sigchld_pipe[0], 4096)
+            except (OSError, IOError) as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                break
+            if not data:
+                break
+            exited = True
+        return exited
+
+    def wakeup_fds(self):
+        '''Descriptors that signal work for the forker: the SIGCHLD self-pipe
+        and the stdout pipes of running children.'''
+        fds = self._stdout_pipes.keys()
+        if self._sigchld_pipe is not None:
+            fds.append(self._sigchld_pipe[0])
+        return fds
+
+    def do_tasks(self):
+        '''Reap exited children and read child output as soon as either is
+        pending, then run the automatic tasks.'''
+        pending = self._drain_sigchld_pipe()
+        if not pending and self._stdout_pipes:
+            pending = bool(wait_readable(self._stdout_pipes.keys(), 0))
+        if pending:
+            self.component_lock_acquire()
+            try:
+                self._wait()
+            except:
+                _logger.error("Unable to reap children", exc_info=True)
+            finally:
+                self.component_lock_release()
+        Component.do_tasks(self)
 
     def __save_me(self):
         '''Periodically save off a statefile.'''
@@ -787,11 +903,14 @@ class BaseForker (Component):
                         " task initialization.")
 
             if child is not None and child.pid is not None:
-                for c in self.children.itervalues():
-                    if c.pid == child.pid:
-                        if self.marked_for_death.has_key(c.id):
-                            del self.marked_for_death[c.id]
-                        c.pid = None
+                c = self._children_by_pid.get(child.pid, None)
+                if c is not None:
+                    if self.marked_for_death.has_key(c.id):
+                        del self.marked_for_death[c.id]
+                    c.pid = None
+                self._children_by_pid[child.pid] = child
+                if child.use_stdout_string and child.pipe_read is not None:
+                    self._stdout_pipes[child.pipe_read] = child
                 self.children[child.id] = child
                 if child.runid is not None:
                     self.active_runids.append(runid)
@@ -880,13 +999,50 @@ class BaseForker (Component):
 
     cleanup_children = exposed(cleanup_children)
 
+    def wait_children(self, tag, child_ids, timeout=None):
+        '''Like get_children, but wait up to timeout seconds for one of the
+        children in child_ids to complete first.  The wait is capped at
+        wait_children_timeout, and ends early if a request from another
+        client arrives, so callers should call again until their children
+        are complete.  Children are reaped while waiting, so completion is
+        reported as soon as it happens.
+
+        '''
+        if timeout is None:
+            timeout = self.WAIT_CHILDREN_TIMEOUT
+        deadline = time.time() + min(float(timeout), self.WAIT_CHILDREN_TIMEOUT)
+        while True:
+            self.component_lock_acquire()
+            try:
+                self._drain_sigchld_pipe()
+                self._wait()
+                for child_id in child_ids:
+                    child = self.children.get(child_id, None)
+                    if child is None or child.complete:
+                        return self.get_children(tag, child_ids)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return self.get_children(tag, child_ids)
+                wakeup_fds = self.wakeup_fds()
+            finally:
+                self.component_lock_release()
+            ready = wait_readable(wakeup_fds + self.server_fds, remaining)
+            if set(ready).intersection(self.server_fds):
+                self.component_lock_acquire()
+                try:
+                    return self.get_children(tag, child_ids)
+                finally:
+                    self.component_lock_release()
+
+    wait_children = locking(exposed(wait_children))
+
     def _read_stdout_pipe(self, child_pids=None):
         '''Read messages from our children that are using redirected stdout to
         string pipes.
 
         Args:
             child_pids: An optional list of child_pids to fetch information for.
-            Default: None.
+            Default: None, which reads from every child with output waiting.
 
         Returns:
             None
@@ -897,10 +1053,10 @@ class BaseForker (Component):
 
         '''
         if child_pids is None:
-            children = self.children.itervalues()
+            children = [self._stdout_pipes[fd] for fd in wait_readable(self._stdout_pipes.keys(), 0)]
         else:
-            children = [child for child in self.children.itervalues()
-                        if child.pid in child_pids]
+            children = [self._children_by_pid[pid] for pid in child_pids
+                        if pid in self._children_by_pid]
 
         for child in children:
             if child.use_stdout_string and child.exit_status is None:
@@ -924,6 +1080,9 @@ class BaseForker (Component):
                                     exc.strerror, exc_info=True)
                     else:
                         if child_str == '':
+                            # end of output; stop polling the pipe, it is
+                            # closed when the child is reaped.
+                            self._stdout_pipes.pop(child.pipe_read, None)
                             break #we're done
                         child.stdout_string += child_str
 
@@ -962,48 +1121,48 @@ class BaseForker (Component):
                 _logger.info("pid %s died with status %s", pid, exit_status)
 
             found = False
-            for child in self.children.itervalues():
-
-                if child.pid == pid:
-                    _logger.info("task %s: dead pid %s matches child %s", child.label, pid, child.id)
-                    if child.use_stdout_string:
-                        # need to do a final read for anything remaining
-                        # post-exit, then close the fd.
-                        self._read_stdout_pipe([child.pid])
-                        child.close_read_pipe()
-                    child.exit_status = exit_status
-                    child.core_dump = core_dump
-                    child.signum = signum
-                    child.pid = None
-                    child.complete = True
-                    if self.marked_for_death.has_key(child.id):
-                        del self.marked_for_death[child.id]
-                    if child.return_output:
-                        try:
-                            if child.stdout_file:
-                                _logger.info("task %s: reading stdout", child.label)
-                                child.stdout_file.seek(0, 0)
-                                child.stdout_data = [l.rstrip() for l in child.stdout_file.readlines()]
-                                _logger.debug("task %s: stdout:\n%s", child.label, "\n".join(child.stdout_data))
-                        except (OSError, IOError), e:
-                            _logger.error("%s: unable to read stdout: %s", child.label, e)
-                        try:
-                            if child.stderr_file:
-                                _logger.info("task %s: reading stderr", child.label)
-                                child.stderr_file.seek(0, 0)
-                                child.stderr_data = [l.rstrip() for l in child.stderr_file.readlines()]
-                                _logger.debug("task %s: stderr:\n%s", child.label, "\n".join(child.stderr_data))
-                        except (OSError, IOError), e:
-                            _logger.error("%s: unable to read stderr: %s", child.label, e)
-                    found = True
-                    break
+            child = self._children_by_pid.pop(pid, None)
+            if child is not None and self.children.get(child.id, None) is child:
+                _logger.info("task %s: dead pid %s matches child %s", child.label, pid, child.id)
+                if child.use_stdout_string:
+                    # need to do a final read for anything remaining
+                    # post-exit, then close the fd.
+                    self._read_stdout_pipe([child.pid])
+                    self._stdout_pipes.pop(child.pipe_read, None)
+                    child.close_read_pipe()
+                child.exit_status = exit_status
+                child.core_dump = core_dump
+                child.signum = signum
+                child.pid = None
+                child.complete = True
+                if self.marked_for_death.has_key(child.id):
+                    del self.marked_for_death[child.id]
+                if child.return_output:
+                    try:
+                        if child.stdout_file:
+                            _logger.info("task %s: reading stdout", child.label)
+                            child.stdout_file.seek(0, 0)
+                            child.stdout_data = [l.rstrip() for l in child.stdout_file.readlines()]
+                            _logger.debug("task %s: stdout:\n%s", child.label, "\n".join(child.stdout_data))
+                    except (OSError, IOError), e:
+                        _logger.error("%s: unable to read stdout: %s", child.label, e)
+                    try:
+                        if child.stderr_file:
+                            _logger.info("task %s: reading stderr", child.label)
+                            child.stderr_file.seek(0, 0)
+                            child.stderr_data = [l.rstrip() for l in child.stderr_file.readlines()]
+                            _logger.debug("task %s: stderr:\n%s", child.label, "\n".join(child.stderr_data))
+                    except (OSError, IOError), e:
+                        _logger.error("%s: unable to read stderr: %s", child.label, e)
+                found = True
             if not found:
                 _logger.warning("pid %s has no corresponding child object", pid)
-                for child_id in self.marked_for_death.keys():
-                    if self.marked_for_death[child_id].pid == pid:
-                        _logger.info("pid %s found in marked for death list", pid)
-                        del self.marked_for_death[child_id]
-                        break
+                if child is not None and self.marked_for_death.get(child.id, None) is child:
+                    _logger.info("pid %s found in marked for death list", pid)
+                    del self.marked_for_death[child.id]
+                    if child.use_stdout_string:
+                        self._stdout_pipes.pop(child.pipe_read, None)
+                        child.close_read_pipe()
 
         # signal any children marked for death
         for child_id in self.marked_for_death.keys():
@@ -1014,6 +1173,7 @@ class BaseForker (Component):
                 except OSError, e:
                     if e.errno == errno.ESRCH:
                         del self.marked_for_death[child_id]
+                        self._children_by_pid.pop(child.pid, None)
                 else:
                     child.death_timer = Timer(self.DEATH_TIMEOUT)
                     child.death_timer.start()
@@ -1023,6 +1183,7 @@ class BaseForker (Component):
                 except OSError, e:
                     if e.errno == errno.ESRCH:
                         del self.marked_for_death[child_id]
+                        self._children_by_pid.pop(child.pid, None)
                 else:
                     child.death_timer.max_time = child.death_timer.elapsed_time + self.DEATH_TIMEOUT
 
@@ -17,7 +17,7 @@ import Cobalt.Logging
 import Cobalt.Util
 from Cobalt.Util import expand_num_list
 from Cobalt.Data import Data, DataDict, ForeignData, ForeignDataDict, IncrID
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Exceptions import ReservationError, ComponentLookupError
 import Cobalt.accounting as accounting
@@ -45,7 +45,7 @@ def _init_accounting_log():
     '''Initialize PBS-style accounting log for this module'''
     reservation_filename = "%s-%%Y%%m%%d" % get_bgsched_config("accounting_log_prefix", DEFAULT_ACCOUNTING_LOG_PREFIX)
     accounting_logdir = os.path.expandvars(get_bgsched_config("log_dir", Cobalt.DEFAULT_LOG_DIRECTORY))
-    _accounting_logger.addHandler(accounting.DatetimeFileHandler(os.path.join(accounting_logdir, reservation_filename)))
+    _accounting_logger.addHandler(accounting.open_log_handler(os.path.join(accounting_logdir, reservation_filename)))
 
 def _write_to_accounting_log(msg):
     '''Send to PBS-style accounting log for this module to accounting log and syslog'''
@@ -84,6 +84,7 @@ dbwriter = Cobalt.Logging.dbwriter(logger)
 use_db_logging = get_bgsched_config('use_db_logging', 'false')
 if use_db_logging.lower() in ['true', '1', 'yes', 'on']:
     dbwriter.enabled = True
+    dbwriter.batch_size = int(get_bgsched_config('db_batch_size', Cobalt.Logging.DB_BATCH_SIZE))
     overflow_filename = get_bgsched_config('overflow_file', None)
     max_queued = int(get_bgsched_config('max_queued_msgs', '-1'))
     if max_queued <= 0:
@@ -599,6 +600,8 @@ class JobDict(ForeignDataDict):
     key = 'jobid'
     __oserror__ = Cobalt.Util.FailureMode("QM Connection (job)")
     __function__ = ComponentProxy("queue-manager").get_jobs
+    __delta_function__ = ComponentProxy("queue-manager").get_jobs_since
+    __delta_method__ = 'get_jobs_since'
     __fields__ = ['nodes', 'location', 'jobid', 'state', 'index',
                   'walltime', 'queue', 'user', 'submittime', 'starttime',
                   'project', 'is_runnable', 'is_active', 'has_resources',
@@ -695,7 +698,7 @@ class BGSched (Component):
                 'active':self.active,
                 'next_res_id':self.id_gen.idnum + 1,
                 'next_cycle_id':self.cycle_id_gen.idnum + 1,
-                'msg_queue': dbwriter.msg_queue,
+                'msg_queue': dbwriter.queued_messages(),
                 'overflow': dbwriter.overflow})
         return state
 
@@ -727,7 +730,7 @@ class BGSched (Component):
         self.get_current_time = time.time
 
         if state.has_key('msg_queue'):
-            dbwriter.msg_queue = state['msg_queue']
+            dbwriter.restore_messages(state['msg_queue'])
         if state.has_key('overflow') and (dbwriter.max_queued != None):
             dbwriter.overflow = state['overflow']
 
@@ -848,7 +851,7 @@ class BGSched (Component):
 
         '''
         return self.reservations.q_get(specs)
-    get_reservations = exposed(query(get_reservations))
+    get_reservations = exposed(query(readonly(get_reservations)))
 
     def set_reservations(self, specs, updates, user_name):
         '''Exposed method for resetting reservation information from setres.
@@ -1266,7 +1269,11 @@ class BGSched (Component):
     get_next_cycle_id = exposed(get_next_cycle_id)
 
     def __flush_msg_queue(self):
-        """Send queued messages to the database-writer component"""
-        return dbwriter.flush_queue()
+        """Make sure queued messages are on their way to the database-writer component"""
+        dbwriter.start_sender()
     __flush_msg_queue = automatic(__flush_msg_queue,
                 float(get_bgsched_config('db_flush_interval', 10)))
+
+    def close(self):
+        """Deliver the messages still queued for the database-writer component before exiting."""
+        dbwriter.close()
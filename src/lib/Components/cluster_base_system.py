@@ -184,7 +184,7 @@ class ClusterBaseSystem (Component):
         self.accounting_logger = logging.getLogger("system.accounting")
         filename = "%s-%%Y%%m%%d" % get_cluster_system_config("accounting_log_prefix", 'system')
         accounting_logdir = os.path.expandvars(get_cluster_system_config("log_dir", Cobalt.DEFAULT_LOG_DIRECTORY))
-        self.accounting_logger.addHandler(accounting.DatetimeFileHandler(os.path.join(accounting_logdir, filename)))
+        self.accounting_logger.addHandler(accounting.open_log_handler(os.path.join(accounting_logdir, filename)))
 
     def _write_to_accounting_log(self, msg):
         '''Send to PBS-style accounting log for this module to accounting log and syslog'''
@@ -85,15 +85,24 @@ import thread
 import traceback
 import copy
 import string
+import threading
+import itertools
+import numbers
+import random
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import Cobalt
 import Cobalt.Util
 from Cobalt.Util import Timer, disk_writer_thread
 import Cobalt.Cqparse
-from Cobalt.Data import Data, DataList, DataDict, IncrID
+from Cobalt.Data import Data, DataList, DataDict, IncrID, QueryIndex, ChangeFeed, DataSnapshot, match_items, get_spec_fields, \
+        query_items, filter_items
 from Cobalt.StateMachine import StateMachine
-from Cobalt.Components.base import Component, exposed, automatic, query
+from Cobalt.Components.base import Component, exposed, automatic, query, readonly, locking
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Exceptions import (QueueError, ComponentLookupError, DataStateError, DataStateTransitionError, StateMachineError,
     StateMachineIllegalEventError, StateMachineNonexistentEventError, ThreadPickledAliveException, JobProcessingError,
@@ -109,6 +118,9 @@ CLOB_SIZE = 4096
 
 logger = logging.getLogger(__name__.split('.')[-1])
 
+# readonly RPCs share the component lock, so the job index may be rebuilt by several request threads at once
+_job_index_lock = threading.Lock()
+
 cqm_id_gen = None
 run_id_gen = None #IncrID()
 
@@ -147,6 +159,23 @@ def get_histm_config(option, default):
 
 CQM_SCALE_DEP_FRAC = str(get_cqm_config('scale_dep_frac', 'false')).lower() in Cobalt.Util.config_true_values
 
+# the longest a wait_jobs call may block; kept under the 90 second client socket timeout, and so that waiting clients do not
+# hold request threads indefinitely
+WAIT_JOBS_MAX_TIMEOUT = float(get_cqm_config('wait_jobs_max_timeout', 60))
+# the most wait_jobs calls held at once; further calls return at once.  With a pool of request threads the default leaves
+# half the pool for other requests.  0 holds every call.
+_RPC_WORKERS = int(get_config_option('communication', 'rpc_workers', 0))
+WAIT_JOBS_MAX_WAITERS = int(get_cqm_config('wait_jobs_max_waiters', max(_RPC_WORKERS // 2, 1) if _RPC_WORKERS > 0 else 0))
+
+# get_jobs and get_queues are answered from snapshots no older than this many seconds, without taking the component lock.
+# 0 answers them from the live queues.
+SNAPSHOT_MAX_AGE = float(get_cqm_config('snapshot_max_age', 0))
+# queries answered from snapshots take the component lock themselves, and only to retake a stale snapshot
+if SNAPSHOT_MAX_AGE > 0:
+    _query_lock = locking
+else:
+    _query_lock = readonly
+
 walltime_prediction = get_histm_config("walltime_prediction", "False").lower()   # *AdjEst*
 walltime_prediction_configured = False
 walltime_prediction_enabled = False
@@ -159,13 +188,14 @@ prediction_scheme = get_histm_config("prediction_scheme", "combined").lower()  #
 
 accounting_logdir = os.path.expandvars(get_cqm_config("log_dir", Cobalt.DEFAULT_LOG_DIRECTORY))
 accounting_logger = logging.getLogger("cqm.accounting")
-accounting_logger.addHandler( accounting.DatetimeFileHandler(os.path.join(accounting_logdir, "%Y%m%d")))
+accounting_logger.addHandler(accounting.open_log_handler(os.path.join(accounting_logdir, "%Y%m%d")))
 
 
 dbwriter = Cobalt.Logging.dbwriter(logging)
 use_db_logging = get_cqm_config('use_db_logging','false')
 if use_db_logging.lower() in Cobalt.Util.config_true_values:
     dbwriter.enabled = True
+    dbwriter.batch_size = int(get_cqm_config('db_batch_size', Cobalt.Logging.DB_BATCH_SIZE))
     overflow_filename = get_cqm_config('overflow_file', None)
     max_queued = int(get_cqm_config('max_queued_msgs', '-1'))
     if max_queued <= 0:
@@ -197,6 +227,43 @@ def str_elapsed_time(elapsed_time):
     '''print elapsed time in HH:MM:SS format for PBS logging purposes'''
     return "%d:%02d:%02d" % (elapsed_time / 3600, elapsed_time / 60 % 60, elapsed_time % 60)
 
+# job attributes handed to utility functions, in column order.  the numeric columns are converted to arrays when a vectorized
+# utility function is evaluated.
+UTILITY_COLUMNS = ('queued_time', 'wall_time', 'wall_time_p', 'hold_time', 'total_etime', 'size', 'user_name', 'project',
+    'queue_priority', 'jobid', 'score', 'state')
+UTILITY_NUMERIC_COLUMNS = ('queued_time', 'wall_time', 'wall_time_p', 'hold_time', 'total_etime', 'size', 'queue_priority',
+    'jobid', 'score')
+
+def vectorized(func):
+    '''mark a utility function as safe to evaluate once over arrays holding the columns of every job'''
+    func.vectorized = True
+    return func
+
+def evaluate_utility_function(utility_func, columns, count):
+    '''Evaluate a utility function for count jobs whose data is held in columns, returning a list of scores.
+
+    Functions marked as vectorized are called once with numpy arrays bound to the column names when numpy is available.  If
+    that fails, or the function is not vectorized, it is called once per job with that job's values bound instead.
+
+    '''
+    env = utility_func.func_globals
+    if numpy is not None and getattr(utility_func, 'vectorized', False):
+        for name in UTILITY_COLUMNS:
+            if name in UTILITY_NUMERIC_COLUMNS:
+                env[name] = numpy.array(columns[name], dtype=float)
+            else:
+                env[name] = numpy.array(columns[name], dtype=object)
+        try:
+            return (numpy.zeros(count) + utility_func()).tolist()
+        except Exception:
+            logger.debug("vectorized evaluation of utility function '%s' failed; evaluating per job", utility_func.func_name,
+                exc_info=True)
+    scores = []
+    for row in itertools.izip(*[columns[name] for name in UTILITY_COLUMNS]):
+        env.update(itertools.izip(UTILITY_COLUMNS, row))
+        scores.append(utility_func())
+    return scores
+
 def has_private_attr(obj, attr):
     assert attr[0:2] == "__"
     return hasattr(obj, "_" + obj.__class__.__name__ + attr)
@@ -547,6 +614,20 @@ class Job (StateMachine):
         "geometry", 'est_start_time', 'sampled_grp'
     ]
 
+    # fields answered from the JobList indexes; the triggers list the private attributes that the derived (property) fields
+    # are computed from, so the indexes follow state machine transitions and hold changes.
+    indexed = ["jobid", "queue", "user", "state", "is_runnable", "is_active", "has_resources"]
+    index_triggers = {
+        '_DataState__state': ["state", "is_runnable", "is_active", "has_resources"],
+        '_Job__queue': ["queue"],
+        '_Job__admin_hold': ["state"],
+        '_Job__user_hold': ["state"],
+        '_Job__dep_hold': ["state"],
+        'dep_fail': ["state"],
+        'max_running': ["state", "is_runnable"],
+        'user_list': ["user"],
+    }
+
     _states = get_job_sm_states() + StateMachine._states
 
     _transitions = get_job_sm_transitions()
@@ -726,7 +807,7 @@ class Job (StateMachine):
     def __getstate__(self):
         data = {}
         for key, value in self.__dict__.iteritems():
-            if key not in ['log', 'comms', 'acctlog']:
+            if key not in ['log', 'comms', 'acctlog', '_index_owners', '_change_feeds']:
                 data[key] = value
         return data
 
@@ -2750,6 +2831,7 @@ class Job (StateMachine):
     def _sm_set_state(self, state):
         self._sm_log_info("transitioning to the '%s' state" % (state,))
         StateMachine._state.__set__(self, state)
+        job_waits.notify(self.jobid)
 
     _sm_state = property(_sm_get_state, _sm_set_state)
     sm_state = property(_sm_get_state, _sm_set_state)
@@ -3101,6 +3183,12 @@ class Job (StateMachine):
                 return False
         return True
 
+    def index_keys(self, field):
+        '''Jobs are matched on any member of user_list, so index all of them under the user field.'''
+        if field == 'user':
+            return set(self.user_list) | set([self.user])
+        return (getattr(self, field),)
+
     def preempt(self, user = None, force = False):
         '''process a preemption request for a job'''
         args = {}
@@ -3224,6 +3312,42 @@ class JobList(DataList):
         self.queue = q
         self.id_gen = cqm_id_gen
 
+    def __getstate__(self):
+        state = DataList.__getstate__(self)
+        state.pop('job_index', None)
+        state.pop('job_feed', None)
+        return state
+
+    # keep the QueueDict-wide job index and change feed (attached by QueueDict) in step with this list
+    def _items_added(self, items):
+        DataList._items_added(self, items)
+        job_index = self.__dict__.get('job_index')
+        if job_index is not None:
+            for job in items:
+                job_index.add(job)
+        job_feed = self.__dict__.get('job_feed')
+        if job_feed is not None:
+            for job in items:
+                job_feed.add(job)
+
+    def _items_removed(self, items):
+        DataList._items_removed(self, items)
+        for job in items:
+            job_waits.notify(job.jobid)
+        job_index = self.__dict__.get('job_index')
+        if job_index is not None:
+            for job in items:
+                job_index.remove(job)
+        job_feed = self.__dict__.get('job_feed')
+        if job_feed is not None:
+            for job in items:
+                job_feed.remove(job)
+
+    def _items_replaced(self):
+        DataList._items_replaced(self)
+        # detaching forces QueueDict to rebuild its index on the next lookup
+        self.__dict__.pop('job_index', None)
+
     def q_add (self, specs, callback = None, cargs = {}):
         for spec in specs:
             if "jobid" not in spec or spec['jobid'] == "*":
@@ -3523,9 +3647,85 @@ class Queue (Data):
 
 
 class QueueDict(DataDict):
+    '''The set of queues, with an index and a change feed of the jobs across all of them.
+
+    The job index and change feed are attached to every queue's JobList, which keeps them up to date as jobs are added, removed
+    or moved between queues.  The index is rebuilt whenever the set of queues changes; the change feed is carried over so that
+    readers only see the jobs that actually came or went.
+
+    '''
     item_cls = Queue
     key = "name"
 
+    def __getstate__(self):
+        state = DataDict.__getstate__(self)
+        state.pop('_job_index', None)
+        state.pop('_job_index_lists', None)
+        state.pop('_job_feed', None)
+        return state
+
+    def _get_job_index(self):
+        '''Return the index of all jobs in all queues, (re)building it if the queues have changed.'''
+        with _job_index_lock:
+            index = self.__dict__.get('_job_index')
+            job_lists = self.__dict__.get('_job_index_lists')
+            if index is not None and len(job_lists) == len(self):
+                for name, queue in self.iteritems():
+                    if job_lists.get(name) is not queue.jobs or queue.jobs.__dict__.get('job_index') is not index:
+                        break
+                else:
+                    return index
+            if index is not None:
+                index.clear()
+            index = QueryIndex(Job.indexed)
+            feed = self.__dict__.get('_job_feed')
+            if feed is None:
+                feed = ChangeFeed('jobid')
+                # a new feed's generations start over, so they are handed out under a new epoch
+                feed.epoch = '%x%04x' % (int(time.time()), random.getrandbits(16))
+            job_lists = {}
+            for name, queue in self.iteritems():
+                queue.jobs.__dict__['job_index'] = index
+                queue.jobs.__dict__['job_feed'] = feed
+                job_lists[name] = queue.jobs
+                for job in queue.jobs:
+                    index.add(job)
+            feed.reset(self._iter_jobs())
+            self.__dict__['_job_index'] = index
+            self.__dict__['_job_index_lists'] = job_lists
+            self.__dict__['_job_feed'] = feed
+            return index
+
+    def get_job_changes(self, generation):
+        '''Return (generation, complete, jobs, removed jobids) for the jobs added, changed or removed since generation.
+
+        Generations are EPOCH.NUMBER strings, where the epoch names the feed, so one handed out before a restart is never
+        mistaken for a current one.  0, or a generation from another epoch, gets every job with complete True.
+
+        '''
+        feed = self.get_job_feed()
+        number = 0
+        if isinstance(generation, basestring) and '.' in generation:
+            epoch, _, number = generation.partition('.')
+            try:
+                number = int(number)
+            except ValueError:
+                number = 0
+            if epoch != feed.epoch:
+                number = 0
+        number, complete, jobs, removed = feed.since(number)
+        return '%s.%d' % (feed.epoch, number), complete, jobs, removed
+
+    def get_job_feed(self):
+        '''Return the change feed of the jobs in all queues.'''
+        self._get_job_index()
+        return self.__dict__['_job_feed']
+
+    def _iter_jobs(self):
+        for queue in self.itervalues():
+            for job in queue.jobs:
+                yield job
+
     def add_queues(self, specs, callback=None, cargs={}):
         return self.q_add(specs, callback, cargs)
 
@@ -3567,20 +3767,116 @@ class QueueDict(DataDict):
         return results
 
     def get_jobs(self, specs, callback=None, cargs={}):
-        results = []
-        for q in self.itervalues():
-            results += q.jobs.q_get(specs, callback, cargs)
-
+        results = list(match_items(self._iter_jobs, self._get_job_index(), specs))
+        if callback:
+            for job in results:
+                callback(job, cargs)
         return results
 
     def del_jobs(self, specs, callback=None, cargs={}):
-        results = []
-        for q in self.itervalues():
-            results += q.jobs.q_del(specs, callback, cargs)
-
+        results = self.get_jobs(specs, callback, cargs)
+        for job in results:
+            for q in self.itervalues():
+                if job in q.jobs._get_query_index():
+                    q.jobs.remove(job)
+                    break
         return results
 
 
+class JobWaits(object):
+    '''Events of the wait_jobs calls waiting on each job.
+
+    The events for a job are set whenever it changes state or is removed from its queue, so that waiting calls recheck it.
+
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        self.waiters = 0
+
+    def start_wait(self, max_waiters):
+        '''Count a waiting call, unless max_waiters (if not 0) are already waiting.  Returns whether the call may wait.'''
+        with self._lock:
+            if max_waiters > 0 and self.waiters >= max_waiters:
+                return False
+            self.waiters += 1
+            return True
+
+    def end_wait(self):
+        with self._lock:
+            self.waiters -= 1
+
+    def add(self, jobids, event):
+        with self._lock:
+            for jobid in jobids:
+                self._events.setdefault(jobid, set()).add(event)
+
+    def remove(self, jobids, event):
+        with self._lock:
+            for jobid in jobids:
+                events = self._events.get(jobid)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self._events[jobid]
+
+    def notify(self, jobid):
+        if jobid not in self._events:
+            return
+        with self._lock:
+            events = list(self._events.get(jobid, ()))
+        for event in events:
+            event.set()
+
+job_waits = JobWaits()
+
+# conditions wait_jobs can wait for; jobs that have left the queues meet them all
+WAIT_CONDITIONS = {
+    'started': lambda job: job.is_active or job.has_completed,
+    'running': lambda job: job.state == 'running' or job.has_completed,
+    'done': lambda job: job.has_completed,
+}
+
+
+class DependencyGraph(object):
+    '''Reverse dependency edges between jobs.
+
+    Maps the string jobid named in a job's all_dependencies to the set of jobs naming it, so that the jobs affected by a job
+    being added, finishing or being deleted can be found without scanning every queue.
+
+    '''
+
+    def __init__(self):
+        self.dependents = {}
+        self.edges = {}
+
+    def __len__(self):
+        return len(self.edges)
+
+    def update_job(self, job):
+        '''(Re)register the edges for the job's current all_dependencies.'''
+        self.remove_job(job)
+        deps = frozenset([str(dep) for dep in job.all_dependencies])
+        if deps:
+            self.edges[job] = deps
+            for dep in deps:
+                self.dependents.setdefault(dep, set()).add(job)
+
+    def remove_job(self, job):
+        '''Remove the edges registered for a job.'''
+        for dep in self.edges.pop(job, ()):
+            waiting = self.dependents.get(dep)
+            if waiting is not None:
+                waiting.discard(job)
+                if not waiting:
+                    del self.dependents[dep]
+
+    def get_dependents(self, jobid):
+        '''Return the jobs that list jobid as a dependency.'''
+        return list(self.dependents.get(str(jobid), ()))
+
+
 class QueueManager(Component):
     '''Cobalt Queue Manager'''
 
@@ -3611,6 +3907,9 @@ class QueueManager(Component):
         self.define_user_utility_functions()
 
         self.score_timestamp = None
+        self.dep_graph = DependencyGraph()
+        self._snapshots = {}
+        self._snapshot_lock = threading.Lock()
 
         if dbwriter.enabled:
             logger.info("Logging to cdbwriter enabled.")
@@ -3631,7 +3930,7 @@ class QueueManager(Component):
                 'Queues':self.Queues,
                 'next_job_id':self.id_gen.idnum+1,
                 'next_run_id':self.run_id_gen.idnum+1,
-                'msg_queue':dbwriter.msg_queue,
+                'msg_queue':dbwriter.queued_messages(),
                 'overflow': dbwriter.overflow})
         return state
 
@@ -3675,6 +3974,14 @@ class QueueManager(Component):
         self.define_user_utility_functions()
 
         self.score_timestamp = None
+        self._snapshots = {}
+        self._snapshot_lock = threading.Lock()
+
+        # the dependency graph is not saved; rebuild it and resynchronize dep_fail for every job
+        self.dep_graph = DependencyGraph()
+        for job in self.Queues.get_jobs([{'jobid':'*'}]):
+            self.dep_graph.update_job(job)
+        self.check_dep_fail()
 
         if dbwriter.enabled:
             logger.info("Logging to database enabled.")
@@ -3688,19 +3995,27 @@ class QueueManager(Component):
 
         if state.has_key("msg_queue"):
             logger.info("loading pending messages.")
-            dbwriter.msg_queue = state["msg_queue"]
+            dbwriter.restore_messages(state["msg_queue"])
         if state.has_key('overflow') and (dbwriter.max_queued != None):
             dbwriter.overflow = state['overflow']
 
+    def checkpoint_feed(self):
+        '''Jobs are checkpointed individually, as they change.'''
+        return self.Queues.get_job_feed()
+
     def __save_me(self):
         Component.save(self)
     __save_me = automatic(__save_me, float(get_cqm_config('save_me_interval', 10)))
 
 
     def __flush_msg_queue(self):
-        dbwriter.flush_queue()
+        dbwriter.start_sender()
     __flush_msg_queue = automatic(__flush_msg_queue, float(get_cqm_config('db_flush_interval', 10)))
 
+    def close(self):
+        """Deliver the messages still queued for the database-writer component before exiting."""
+        dbwriter.close()
+
     def __progress(self):
         '''Process asynchronous job work'''
         [job.progress() for queue in self.Queues.itervalues() for job in queue.jobs]
@@ -3761,8 +4076,8 @@ class QueueManager(Component):
         # NOTE: this assumes that the system component will return a non-zero exit status if the task was killed by a signal.
         # 'None' is considered to be non-zero and thus would be a valid exit status if the task was terminated.
         if job.exit_status == 0:
-            for waiting_job in self.Queues.get_jobs([{'state':"dep_hold"}]):
-                if str(job.jobid) in waiting_job.all_dependencies:
+            for waiting_job in self.dep_graph.get_dependents(job.jobid):
+                if waiting_job.state == "dep_hold" and str(job.jobid) in waiting_job.all_dependencies:
                     waiting_job.satisfied_dependencies = waiting_job.satisfied_dependencies[:] + [str(job.jobid)]
                     waiting_job.update_dep_state()
                     if not waiting_job.dep_hold:
@@ -3789,6 +4104,7 @@ class QueueManager(Component):
         # could "job.queue.jobs.remove(job)" be used instead or would that make an inappropriate assumption about the
         # implementation of the JobList/DataList?
         self.Queues[job.queue].jobs.q_del([{'jobid':job.jobid}])
+        self._remove_dependency_jobs([job])
 
         # update state of jobs held because the user exceeded the maximum number of running jobs allowed by the queue
         self.Queues[job.queue].update_max_running()
@@ -3819,6 +4135,19 @@ class QueueManager(Component):
 
     test_history_manager = automatic(test_history_manager, 60)
 
+    def update_history_index(self):
+        '''Add the jobs logged since the last pass to the history index read by cqhist.'''
+        # reads only the logs, so the component lock is not needed
+        try:
+            index = Cobalt.Cqparse.HistoryIndex()
+            try:
+                index.update()
+            finally:
+                index.close()
+        except Exception:
+            self.logger.warning("unable to update the history index", exc_info=True)
+    update_history_index = automatic(locking(update_history_index), float(get_cqm_config('history_index_interval', 300)))
+
 
     def get_walltime_Ap(self, spec):
         '''get walltime adjusting parameter from history manager component'''  #*AdjEst*
@@ -3895,12 +4224,128 @@ class QueueManager(Component):
             raise QueueError(failure_msg)
 
         response = self.Queues.add_jobs(specs, self.__add_job_terminal_action)
+        affected = set(response)
+        for job in response:
+            self.dep_graph.update_job(job)
+            affected.update(self.dep_graph.get_dependents(job.jobid))
+        self.check_dep_fail(affected)
         return response
     add_jobs = exposed(query(add_jobs))
 
-    def get_jobs(self, specs):
+    def _get_snapshot(self, name, items, indexed=()):
+        '''Return the named snapshot, retaking it from items under the shared component lock if it is older than
+        SNAPSHOT_MAX_AGE.
+
+        '''
+        with self._snapshot_lock:
+            snapshot = self._snapshots.get(name)
+            if snapshot is None or snapshot.age() > SNAPSHOT_MAX_AGE:
+                acquired = self.component_read_lock_acquire()
+                try:
+                    snapshot = DataSnapshot(items(), indexed)
+                finally:
+                    self.component_read_lock_release(acquired)
+                self.statistics.add_value('%s_snapshot' % name, time.time() - snapshot.time)
+                self._snapshots[name] = snapshot
+        return snapshot
+
+    def _match_jobs(self, specs):
+        if SNAPSHOT_MAX_AGE > 0:
+            return self._get_snapshot('jobs', self.Queues._iter_jobs, Job.indexed).q_get(specs)
         return self.Queues.get_jobs(specs)
-    get_jobs = exposed(query(get_jobs))
+
+    def get_jobs(self, specs, options=None):
+        '''Return the jobs matching any of specs.  options may further filter, sort and page them (see
+        Cobalt.Data.query_items).
+
+        '''
+        jobs = self._match_jobs(specs)
+        if options:
+            jobs = query_items(jobs, options)
+        return jobs
+    get_jobs = exposed(query(_query_lock(get_jobs)))
+
+    def count_jobs(self, specs, options=None):
+        '''Return the number of jobs get_jobs would return, ignoring paging.'''
+        jobs = self._match_jobs(specs)
+        if options:
+            jobs = filter_items(jobs, options.get('where'))
+        return len(jobs)
+    count_jobs = exposed(_query_lock(count_jobs))
+
+    def wait_jobs(self, specs, condition='done', timeout=60):
+        '''Wait until every job matching specs meets condition, or for at most timeout seconds (and no more than
+        [cqm] wait_jobs_max_timeout).  The conditions are 'started' (the job has left the queued and held states),
+        'running' and 'done'; jobs that leave the queues meet all of them.  Returns the jobids of the jobs that have not yet
+        met the condition, so an empty list means the wait is over.
+
+        The call is woken by the job state changes themselves rather than polling.  Once [cqm] wait_jobs_max_waiters calls
+        are waiting, further calls return the pending jobids at once, so that waiters cannot take every request thread.
+
+        '''
+        try:
+            met = WAIT_CONDITIONS[condition]
+        except KeyError:
+            raise QueueError("unknown wait condition '%s'" % (condition,))
+        deadline = time.time() + min(float(timeout), WAIT_JOBS_MAX_TIMEOUT)
+        event = threading.Event()
+        acquired = self.component_read_lock_acquire()
+        try:
+            jobs = self.Queues.get_jobs(specs)
+            jobids = [job.jobid for job in jobs]
+            # registered before checking, and state changes need the lock exclusively, so no change can be missed
+            job_waits.add(jobids, event)
+            pending = self._unmet_jobs(jobs, met)
+        finally:
+            self.component_read_lock_release(acquired)
+        if not pending or not job_waits.start_wait(WAIT_JOBS_MAX_WAITERS):
+            job_waits.remove(jobids, event)
+            return [job.jobid for job in pending]
+        try:
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                event.wait(remaining)
+                event.clear()
+                acquired = self.component_read_lock_acquire()
+                try:
+                    pending = self._unmet_jobs(pending, met)
+                finally:
+                    self.component_read_lock_release(acquired)
+        finally:
+            job_waits.end_wait()
+            job_waits.remove(jobids, event)
+        return [job.jobid for job in pending]
+    wait_jobs = exposed(locking(wait_jobs))
+
+    def _unmet_jobs(self, jobs, met):
+        '''Return the jobs still in the queues that do not meet condition test met.'''
+        current = self.Queues.get_job_feed().items
+        return [job for job in jobs if current.get(job.jobid) is job and not met(job)]
+
+    def get_jobs_since(self, generation, specs):
+        '''Return the jobs matching specs that were added or changed since generation.
+
+        The result is a dictionary holding the generation to pass on the next call, the changed jobs marshalled as get_jobs
+        does ('items'), the jobids of jobs that were removed or no longer match ('deleted'), and whether 'items' is a complete
+        snapshot ('complete').  Generations are opaque strings.  A snapshot is returned for generation 0, or if the
+        generation is too old or not one handed out by this run of the queue manager.
+
+        '''
+        generation, complete, jobs, deleted = self.Queues.get_job_changes(generation)
+        fields = get_spec_fields(specs)
+        items = []
+        for job in jobs:
+            for spec in specs:
+                if job.match(spec):
+                    items.append(job.to_rx(fields))
+                    break
+            else:
+                if not complete:
+                    deleted.append(job.jobid)
+        return {'generation':generation, 'complete':complete, 'items':items, 'deleted':deleted}
+    get_jobs_since = exposed(get_jobs_since)
 
     def set_jobs(self, specs, updates, user_name=None, force=False):
         '''Set attributes contained in updates on jobs specified by specs.
@@ -4000,7 +4445,9 @@ class QueueManager(Component):
                         message = "[]"
                     logger.info("Job %s/%s: dependencies set to %s", job.jobid, job.user, message)
                     job.update_dep_state()
-                self.check_dep_fail()
+                # releasing dep_hold also clears all_dependencies
+                self.dep_graph.update_job(job)
+                self.check_dep_fail([job])
                 # only do this if the new queue can accept this job
                 if new_q_name:
                     new_q = self.Queues[new_q_name]
@@ -4067,27 +4514,36 @@ class QueueManager(Component):
                     job.resid = resid[str(job.jobid)]
             job.run(nodes)
             self.Queues[job.queue].update_max_running()
-        return self.Queues.get_jobs(specs, _run_jobs, nodelist)
+        jobs = self.Queues.get_jobs(specs, _run_jobs, nodelist)
+        self._wake_progress()
+        return jobs
     run_jobs = exposed(query(run_jobs))
 
     def preempt_jobs(self, specs, user = None, force = False):
         def _preempt_jobs(job, args):
             job.preempt(user, force)
-        return self.Queues.get_jobs(specs, _preempt_jobs)
+        jobs = self.Queues.get_jobs(specs, _preempt_jobs)
+        self._wake_progress()
+        return jobs
     preempt_jobs = exposed(query(preempt_jobs))
 
     def del_jobs(self, specs, force = False, user = None, signame = Signal_Map.terminate):
         '''Delete a job'''
         ret = []
         for spec in specs:
-            for job, q in [(job, queue) for queue in self.Queues.itervalues() for job in queue.jobs if job.match(spec)]:
+            for job in self.Queues.get_jobs([spec]):
                 ret.append(job)
                 job.kill(user, signame, force)
                 if force:
                     self._job_terminal_action({'job':job})
+        self._wake_progress()
         return ret
     del_jobs = exposed(query(del_jobs))
 
+    def _wake_progress(self):
+        '''Advance jobs that were just told to run or stop without waiting for the progress interval.'''
+        self.wake_tasks('_QueueManager__progress')
+
     #
     # queue operations
     #
@@ -4097,13 +4553,30 @@ class QueueManager(Component):
         return self.Queues.add_queues(specs)
     add_queues = exposed(query(add_queues))
 
-    def get_queues(self, specs):
+    def _match_queues(self, specs):
+        if SNAPSHOT_MAX_AGE > 0:
+            return self._get_snapshot('queues', self.Queues.itervalues).q_get(specs)
         return self.Queues.get_queues(specs)
-    get_queues = exposed(query(get_queues))
+
+    def get_queues(self, specs, options=None):
+        '''Return the queues matching any of specs, filtered, sorted and paged as for get_jobs.'''
+        queues = self._match_queues(specs)
+        if options:
+            queues = query_items(queues, options)
+        return queues
+    get_queues = exposed(query(_query_lock(get_queues)))
+
+    def count_queues(self, specs, options=None):
+        '''Return the number of queues get_queues would return, ignoring paging.'''
+        queues = self._match_queues(specs)
+        if options:
+            queues = filter_items(queues, options.get('where'))
+        return len(queues)
+    count_queues = exposed(_query_lock(count_queues))
 
     def can_queue(self, job_spec):
         return self.Queues.can_queue(job_spec)
-    can_queue = exposed(can_queue)
+    can_queue = exposed(readonly(can_queue))
 
     def set_queues(self, specs, updates, user_name=None):
         def _setQueues(queue, newattr):
@@ -4130,7 +4603,9 @@ class QueueManager(Component):
         '''Delete queue(s), but check if there are still jobs in the queue'''
         if force:
             logger.info("%s requested force delete of queue %s", user_name, specs)
-            return self.Queues.del_queues(specs)
+            response = self.Queues.del_queues(specs)
+            self._remove_dependency_jobs([job for queue in response for job in queue.jobs])
+            return response
 
         logger.info("%s requested delete of queue %s", user_name, specs)
         queues = self.Queues.get_queues(specs)
@@ -4186,7 +4661,7 @@ class QueueManager(Component):
             self.logger.error("Problem compiling utility function definitions.", exc_info=True)
             return
 
-        globals = {'math':math, 'time':time}
+        globals = {'math':math, 'time':time, 'numpy':numpy, 'vectorized':vectorized}
         locals = {}
         try:
             exec code in globals, locals
@@ -4249,8 +4724,10 @@ class QueueManager(Component):
             val = 1.0
             return val
 
-        self.builtin_utility_functions["default"] = default
-        self.builtin_utility_functions["high_prio"] = high_prio
+        # the builtins get their own globals so that the job values bound to them during scoring stay out of this module
+        for func in [default, high_prio]:
+            func = types.FunctionType(func.func_code, {'__builtins__':__builtins__}, func.func_name)
+            self.builtin_utility_functions[func.func_name] = vectorized(func)
 
     @staticmethod
     def _get_active_machine_seconds(current_time, sys_size, active_jobs):
@@ -4291,35 +4768,41 @@ class QueueManager(Component):
         current_time = time.time()
 
         queued_jobs = self.Queues.get_jobs([{'is_runnable':True}])
+
+        # score the jobs of each policy together so every utility function is evaluated in a single pass over the job data
+        policy_jobs = {}
         for job in queued_jobs:
-            utility_name = self.Queues[job.queue].policy
-            args = {'queued_time':current_time - float(job.submittime),
-                    'wall_time': 60*float(job.walltime),
-                    'wall_time_p': 60*float(job.walltime_p),
-                    'hold_time' : job.hold_time,
-                    'total_etime' : job.total_etime,
-                    'size': float(job.nodes),
-                    'user_name': job.user,
-                    'project': job.project,
-                    'queue_priority': int(self.Queues[job.queue].priority),
-                    #'machine_size': max_nodes,
-                    'jobid': int(job.jobid),
-                    'score': job.score,
-                    'state': job.state,
-                    }
+            policy_jobs.setdefault(self.Queues[job.queue].policy, []).append(job)
+        queue_priorities = dict([(queue.name, int(queue.priority)) for queue in self.Queues.itervalues()])
+
+        scores = []
+        for utility_name, jobs in policy_jobs.iteritems():
+            columns = {'queued_time':[current_time - float(job.submittime) for job in jobs],
+                       'wall_time':[60*float(job.walltime) for job in jobs],
+                       'wall_time_p':[60*float(job.walltime_p) for job in jobs],
+                       'hold_time':[job.hold_time for job in jobs],
+                       'total_etime':[job.total_etime for job in jobs],
+                       'size':[float(job.nodes) for job in jobs],
+                       'user_name':[job.user for job in jobs],
+                       'project':[job.project for job in jobs],
+                       'queue_priority':[queue_priorities[job.queue] for job in jobs],
+                       #'machine_size': max_nodes,
+                       'jobid':[int(job.jobid) for job in jobs],
+                       'score':[job.score for job in jobs],
+                       'state':[job.state for job in jobs],
+                       }
             try:
                 if utility_name in self.builtin_utility_functions:
                     utility_func = self.builtin_utility_functions[utility_name]
                 else:
                     utility_func = self.user_utility_functions[utility_name]
-                utility_func.func_globals.update(args)
-                score = utility_func()
+                policy_scores = evaluate_utility_function(utility_func, columns, len(jobs))
             except KeyError:
                 # do something sensible when the requested utility function doesn't exist
                 # probably go back to the "default" one
 
                 # and if we get here, try to fix it and throw away this scheduling iteration
-                self.logger.error("cannot find utility function '%s' named by queue '%s'", utility_name, job.queue)
+                self.logger.error("cannot find utility function '%s' named by queue '%s'", utility_name, jobs[0].queue)
                 self.user_utility_functions[utility_name] = self.builtin_utility_functions["default"]
                 self.logger.error("falling back to 'default' policy to replace '%s'", utility_name)
                 return
@@ -4328,24 +4811,27 @@ class QueueManager(Component):
                 # probably go back to the "default" one
 
                 # and if we get here, try to fix it and throw away this scheduling iteration
-                self.logger.error("error while executing utility function '%s' named by queue '%s'", utility_name, job.queue,
-                    exc_info=True)
+                self.logger.error("error while executing utility function '%s' named by queue '%s'", utility_name,
+                    jobs[0].queue, exc_info=True)
                 self.user_utility_functions[utility_name] = self.builtin_utility_functions["default"]
                 self.logger.error("falling back to 'default' policy to replace '%s'", utility_name)
                 return
 
-            try:
-                job.score += score
-            except Exception:
-                self.logger.error("utility function '%s' named by queue '%s' returned a non-number", utility_name, job.queue,
-                    exc_info=True)
+            if not all([isinstance(score, numbers.Real) for score in policy_scores]):
+                self.logger.error("utility function '%s' named by queue '%s' returned a non-number", utility_name,
+                    jobs[0].queue)
                 self.user_utility_functions[utility_name] = self.builtin_utility_functions["default"]
                 self.logger.error("falling back to 'default' policy to replace '%s'", utility_name)
                 return
+            scores.append((jobs, policy_scores))
+
+        for jobs, policy_scores in scores:
+            for job, score in itertools.izip(jobs, policy_scores):
+                job.score += score
 
         if self.score_timestamp:
             dt = current_time - self.score_timestamp
-            queued_jobs.sort( lambda left, right: -cmp(left.score, right.score) )
+            queued_jobs.sort(key=lambda job: job.score, reverse=True)
             core_hours = 0.0
             for job in queued_jobs:
                 if job.priority_core_hours is None:
@@ -4370,10 +4856,31 @@ class QueueManager(Component):
 
     compute_utility_scores = automatic(compute_utility_scores, float(get_cqm_config('compute_utility_interval', 10)))
 
-    def check_dep_fail(self):
-        queued_jobs = self.Queues.get_jobs([{'jobid': '*'}])
+    def _remove_dependency_jobs(self, jobs):
+        '''Drop jobs leaving the queues from the dependency graph and recheck the jobs that depended on them.'''
+        affected = set()
+        for job in jobs:
+            self.dep_graph.remove_job(job)
+            affected.update(self.dep_graph.get_dependents(job.jobid))
+        affected.difference_update(jobs)
+        self.check_dep_fail(affected)
+
+    def check_all_dep_fail(self):
+        '''Recheck every job now and then, in case a job left the queues without its dependents being rechecked.'''
+        self.check_dep_fail()
+    check_all_dep_fail = automatic(check_all_dep_fail, float(get_cqm_config('dep_fail_check_interval', 600)))
+
+    def check_dep_fail(self, jobs=None):
+        '''Set dep_fail on jobs that depend on a job that is not queued.
+
+        Only the jobs passed in are checked; the dependency graph is used to find the jobs affected by an addition or removal.
+        If jobs is None, every job is checked.
+
+        '''
+        if jobs is None:
+            jobs = self.Queues.get_jobs([{'jobid': '*'}])
         already_failed = False
-        for job in queued_jobs:
+        for job in jobs:
             already_failed = job.dep_fail
             job.dep_fail = False
             pending = set(job.all_dependencies).difference(set(job.satisfied_dependencies))
@@ -4393,7 +4900,6 @@ class QueueManager(Component):
                 (job.no_holds_left())):
                 dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(job))
                 accounting_logger.info(accounting.hold_release(job.jobid, "all_holds_clear", time.time(), None))
-    check_dep_fail = automatic(check_dep_fail, period=60)
 
     def get_next_id(self):
         '''get the next id, the generator will throw.  Useful for recovery.'''
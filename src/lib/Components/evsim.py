@@ -6,6 +6,7 @@
 
 import ConfigParser
 import copy
+import heapq
 import logging
 import math
 import os
@@ -117,6 +118,101 @@ class SimEvent (Data):
         self.jobid = spec.get("jobid", 0)
         self.location = spec.get("location", {})
 
+class EventQueue(object):
+    """Pending simulated events in time order
+
+    Events are kept in a heap of [unixtime, sequence, event] entries; the
+    sequence keeps events with the same time in the order they were added.
+    An index from (machine, jobid, type) to the latest pending entry with that
+    key lets an event be removed or moved to a new time without a search: the
+    entry is marked removed and skipped when it reaches the top of the heap.
+    Jobids are only unique within a machine, so the machine is part of the
+    key.
+
+    Methods:
+    push -- add an event
+    update -- replace the pending event with the same machine, jobid and type, if any
+    remove -- remove the pending event with a machine, jobid and type
+    peek -- the next event, without removing it
+    pop -- remove and return the next event
+    smallest -- the next n events
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.index = {}
+        self.count = 0
+        self.pending = 0
+        self.first_event = None
+
+    def __len__(self):
+        return self.pending
+
+    def push(self, ev_spec):
+        '''add an event, return its sequence number'''
+        entry = [ev_spec['unixtime'], self.count, ev_spec]
+        self.count += 1
+        heapq.heappush(self.heap, entry)
+        self.index[self._key(ev_spec)] = entry
+        self.pending += 1
+        if self.first_event is None or ev_spec['unixtime'] < self.first_event['unixtime']:
+            self.first_event = ev_spec
+        return entry[1]
+
+    @staticmethod
+    def _key(ev_spec):
+        return (ev_spec.get('machine'), ev_spec.get('jobid'), ev_spec.get('type'))
+
+    def remove(self, machine, jobid, ev_type):
+        '''remove the pending event for machine, jobid and ev_type, return whether there was one'''
+        entry = self.index.pop((machine, jobid, ev_type), None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self.pending -= 1
+        return True
+
+    def update(self, ev_spec):
+        '''add an event in place of the pending one with the same machine, jobid and type'''
+        self.remove(*self._key(ev_spec))
+        return self.push(ev_spec)
+
+    def _top(self):
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0]
+        return None
+
+    def peek(self):
+        entry = self._top()
+        if entry is None:
+            return None
+        return entry[2]
+
+    def pop(self):
+        entry = self._top()
+        if entry is None:
+            return None
+        heapq.heappop(self.heap)
+        ev_spec = entry[2]
+        key = self._key(ev_spec)
+        if self.index.get(key) is entry:
+            del self.index[key]
+        self.pending -= 1
+        return ev_spec
+
+    def smallest(self, n):
+        return [entry[2] for entry in heapq.nsmallest(n, [entry for entry in self.heap if entry[2] is not None])]
+
+    def last_time(self):
+        '''the latest time of the pending events, or None'''
+        times = [entry[0] for entry in self.heap if entry[2] is not None]
+        if times:
+            return max(times)
+        return None
+
 class EventSimulator(Component):
     """Event Simulator. Manages time stamps, events, and the advancing of the clock
 
@@ -135,7 +231,8 @@ class EventSimulator(Component):
     def __init__(self, *args, **kwargs):
 
         Component.__init__(self, *args, **kwargs)
-        self.event_list = [{'unixtime':0}]
+        self.current_event = {'unixtime':0}
+        self.events = EventQueue()   #pending events
         self.time_stamp = 0
 
         self.finished = False
@@ -156,60 +253,45 @@ class EventSimulator(Component):
     get_go_next = exposed(get_go_next)
 
     def events_length(self):
-        return len(self.event_list)
+        '''number of events, past, current and pending'''
+        return self.time_stamp + 1 + len(self.events)
 
-    def update_event(self, ev_spec):
-	time_sec = ev_spec.get('unixtime')
-	if time_sec == None:
+    def _check_event(self, ev_spec):
+        if ev_spec.get('unixtime') == None:
             print "insert time stamp error: no unix time provided"
-            return -1
+            return False
 
-	if not ev_spec.has_key('jobid'):
+        if not ev_spec.has_key('jobid'):
             ev_spec['jobid'] = 0
         if not ev_spec.has_key('location'):
             ev_spec['location'] = []
+        return True
 
-	this_jobid = ev_spec['jobid']
-	this_event = ev_spec['type']
-
-	pos = 0
-	while pos < self.events_length():
-		if this_jobid == self.event_list[pos].get('jobid') and this_event == self.event_list[pos].get('event'):
-			del self.event_list[pos]
-			break
-
-		pos = pos + 1
-
-	self.add_event(ev_spec)
+    def update_event(self, ev_spec):
+        '''move the pending event of the same machine, job and type to a new time stamp'''
+        if not self._check_event(ev_spec):
+            return -1
+        return self.events.update(ev_spec)
     update_event = exposed(update_event)
 
     def add_event(self, ev_spec):
-        '''insert time stamps in the same order'''
-
-        time_sec = ev_spec.get('unixtime')
-        if time_sec == None:
-            print "insert time stamp error: no unix time provided"
+        '''insert time stamps in the same order, return the event's sequence number'''
+        if not self._check_event(ev_spec):
             return -1
-
-        if not ev_spec.has_key('jobid'):
-            ev_spec['jobid'] = 0
-        if not ev_spec.has_key('location'):
-            ev_spec['location'] = []
-
-        pos  = self.events_length()
-
-        while time_sec < self.event_list[pos-1].get('unixtime'):
-            pos = pos - 1
-
-        self.event_list.insert(pos, ev_spec)
-        #print "insert time stamp ", ev_spec, " at pos ", pos
-        return pos
+        return self.events.push(ev_spec)
     add_event = exposed(add_event)
 
+    def _last_time(self):
+        '''the latest event time, pending or not'''
+        last_time = self.events.last_time()
+        if last_time is None or last_time < self.current_event.get('unixtime'):
+            return self.current_event.get('unixtime')
+        return last_time
+
     def get_time_span(self):
         '''return the whole time span'''
-        starttime = self.event_list[1].get('unixtime')
-        endtime = self.event_list[-1].get('unixtime')
+        starttime = self.events.first_event.get('unixtime')
+        endtime = self._last_time()
         timespan = endtime - starttime
         return timespan
     get_time_span = exposed(get_time_span)
@@ -220,40 +302,41 @@ class EventSimulator(Component):
 
     def get_current_time(self):
         '''return current unix time'''
-        return self.event_list[self.time_stamp].get('unixtime')
+        return self.current_event.get('unixtime')
     get_current_time = exposed(get_current_time)
 
     def get_current_date_time(self):
         '''return current date time'''
-        return self.event_list[self.time_stamp].get('datetime')
+        return self.current_event.get('datetime')
     get_current_date_time = exposed(get_current_date_time)
 
     def get_current_event_type(self):
         '''return current event type'''
-        return self.event_list[self.time_stamp].get('type')
+        return self.current_event.get('type')
     get_current_event_type = exposed(get_current_event_type)
 
     def get_current_event_job(self):
         '''return current event job'''
-        return self.event_list[self.time_stamp].get('jobid')
+        return self.current_event.get('jobid')
     get_current_event_job = exposed(get_current_event_job)
 
     def get_current_event_location(self):
-        return self.event_list[self.time_stamp].get('location')
+        return self.current_event.get('location')
     get_current_event_location = exposed(get_current_event_location)
 
     def get_current_event_machine(self):
         '''return machine which the current event belongs to'''
-        return self.event_list[self.time_stamp].get('machine')
+        return self.current_event.get('machine')
 
     def get_current_event_all(self):
         '''return current event'''
-        return self.event_list[self.time_stamp]
+        return self.current_event
 
     def get_next_event_time_sec(self):
         '''return the next event time'''
-        if self.time_stamp < len(self.event_list) - 1:
-            return self.event_list[self.time_stamp + 1].get('unixtime')
+        next_event = self.events.peek()
+        if next_event is not None:
+            return next_event.get('unixtime')
         else:
             return -1
     get_next_event_time_sec = exposed(get_next_event_time_sec)
@@ -265,7 +348,9 @@ class EventSimulator(Component):
 
     def clock_increment(self):
         '''the current time stamp increments by 1'''
-        if self.time_stamp < len(self.event_list) - 1:
+        next_event = self.events.pop()
+        if next_event is not None:
+            self.current_event = next_event
             self.time_stamp += 1
             if SHOW_SCREEN_LOG:
                 print str(self.get_current_date_time()) + \
@@ -295,11 +380,11 @@ class EventSimulator(Component):
 
     def init_unhold_events(self, machine_id):
         """add unholding event"""
-        if not self.event_list:
+        if self.events.first_event is None:
             return
 
-        first_time_sec = self.event_list[1]['unixtime']
-        last_time_sec = self.event_list[-1]['unixtime']
+        first_time_sec = self.events.first_event['unixtime']
+        last_time_sec = self._last_time()
 
         unhold_point = first_time_sec + UNHOLD_INTERVAL + machine_id
         while unhold_point < last_time_sec:
@@ -315,11 +400,11 @@ class EventSimulator(Component):
 
     def init_mmon_events(self):
         """add metrics monitor points into time stamps"""
-        if not self.event_list:
+        if self.events.first_event is None:
             return
 
-        first_time_sec = self.get_first_mmon_point(self.event_list[1]['datetime'])
-        last_time_sec = self.event_list[-1]['unixtime']
+        first_time_sec = self.get_first_mmon_point(self.events.first_event['datetime'])
+        last_time_sec = self._last_time()
         machine_id = MMON
 
         mmon_point = first_time_sec + MMON_INTERVAL
@@ -341,13 +426,9 @@ class EventSimulator(Component):
         return new_epoch
 
     def print_events(self):
-        print "total events:", len(self.event_list)
-        i = 0
-        for event in self.event_list:
+        print "total events:", self.events_length()
+        for event in [self.current_event] + self.events.smallest(24):
             print event
-            i += 1
-            if i == 25:
-                break
 
     def event_driver(self):
         """core part that drives the clock"""
@@ -3,6 +3,8 @@
 # Licensed under a modified BSD 3-clause license. See LICENSE for details.
 
 import sys
+import bisect
+import heapq
 import logging
 import ConfigParser
 import Cobalt
@@ -19,7 +21,7 @@ logger = logging.getLogger('histm')
 def get_histm_config(option, default):
     try:
         value = config.get('histm', option)
-    except ConfigParser.NoOptionError:
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
         value = default
     return value
 
@@ -27,16 +29,42 @@ update_interval = float(get_histm_config('update_interval_hr', 0.5))
 
 def parse_jobinfo(line):
     '''parse a line in job_info file, return a temp
-    dictionary with parsed fields in the line'''
+    dictionary with parsed fields in the line, or None if the line is malformed'''
     temp = {}
     fields = line.split(' ')
+    if len(fields) < 5:
+        return None
     temp['jobid'] = fields[0]
     temp['user'] = fields[1]
     temp['project'] = fields[2]    
     temp['nodes'] = fields[3]
-    temp['Rvalue'] = fields[4]   #Rvalue = runtime / walltime
+    try:
+        temp['Rvalue'] = float(fields[4])   #Rvalue = runtime / walltime
+        if len(fields) > 5:
+            temp['end'] = float(fields[5])   #optional end time, in seconds since the epoch
+    except ValueError:
+        return None
     return temp
 
+class RValues(object):
+    '''R values of the historical jobs under one key, kept sorted so that
+    adding or removing a job and reading the fraction-quantile do not re-sort'''
+
+    def __init__(self):
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        bisect.insort(self.values, value)
+
+    def remove(self, value):
+        del self.values[bisect.bisect_left(self.values, value)]
+
+    def quantile(self, fraction):
+        return self.values[int(fraction * len(self.values))]
+
 class HistoryManager(Component):
     '''Historical Data Manager'''
 
@@ -53,59 +81,121 @@ class HistoryManager(Component):
         self.fraction = float(get_histm_config("fraction", 0.8))
         self.minimum_ap = float(get_histm_config("minimum_ap", 0.5))
         
-        self.job_dict = {}   #historical job dictionary
-        self.project_set = set([])  #distinct project names of historical jobs
-        self.user_set = set([])     #distinct user names of historical jobs
-        self.pair_set = set([])  #distinct (user, project) pair 
-        
         self.Ap_dict_proj = {}  #dictionary of walltime adjusting parameters by project name
         self.Ap_dict_user = {}  #dictionary of walltime adjusting parameters by user name
         self.Ap_dict_paired = {} #dictionary of walltime adjusting parameters by double key (user, project)
         
+        self.reset_history()
         self.update_Ap_Dict()
+
+    def reset_history(self):
+        '''forget all historical jobs; the jobinfo file is read again from the start'''
+        self.job_dict = {}   #historical job dictionary
+        self.project_set = set([])  #distinct project names of historical jobs
+        self.user_set = set([])     #distinct user names of historical jobs
+        self.pair_set = set([])  #distinct (user, project) pair 
+        self.jobinfo_offset = 0  #bytes of jobinfo_file already read
+        #sorted R values of the historical jobs by project, user and (user, project)
+        self.Rvalues = {'project':{}, 'user':{}, 'paired':{}}
+        self.changed_keys = set([])  #(kind, key) whose Ap needs computing again
+        self.expiry = []  #heap of (end time, jobid) of the jobs with an end time
+        self.latest_end = None
+        self.Ap_dict_proj.clear()
+        self.Ap_dict_user.clear()
+        self.Ap_dict_paired.clear()
+
+    def job_keys(self, jobspec):
+        user = jobspec.get('user')
+        project = jobspec.get('project')
+        return [('project', project, self.project_set), ('user', user, self.user_set),
+                ('paired', (user, project), self.pair_set)]
+
+    def add_job(self, jobspec):
+        '''add a historical job, replacing an earlier line for the same jobid'''
+        jobid = jobspec.get('jobid')
+        if self.job_dict.has_key(jobid):
+            self.remove_job(jobid)
+        self.job_dict[jobid] = jobspec
+        rvalue = jobspec['Rvalue']
+        for kind, key, key_set in self.job_keys(jobspec):
+            self.Rvalues[kind].setdefault(key, RValues()).add(rvalue)
+            key_set.add(key)
+            self.changed_keys.add((kind, key))
+        if jobspec.has_key('end'):
+            heapq.heappush(self.expiry, (jobspec['end'], jobid))
+            self.latest_end = max(self.latest_end, jobspec['end'])
+
+    def remove_job(self, jobid):
+        jobspec = self.job_dict.pop(jobid)
+        rvalue = jobspec['Rvalue']
+        for kind, key, key_set in self.job_keys(jobspec):
+            rvalues = self.Rvalues[kind][key]
+            rvalues.remove(rvalue)
+            if not rvalues:
+                del self.Rvalues[kind][key]
+                key_set.discard(key)
+            self.changed_keys.add((kind, key))
+
+    def expire_jobs(self):
+        '''drop jobs that ended more than lastDays before the latest job ended'''
+        # measured from the history itself so that simulations replaying old
+        # jobinfo files keep their window
+        if self.latest_end is None:
+            return
+        cutoff = self.latest_end - self.lastDays * 86400
+        while self.expiry and self.expiry[0][0] < cutoff:
+            end, jobid = heapq.heappop(self.expiry)
+            jobspec = self.job_dict.get(jobid)
+            if jobspec is not None and jobspec.get('end') == end:
+                self.remove_job(jobid)
                 
     def update_job_dict(self):
-        '''initialize/update job_dict from jobinfo_file'''
+        '''initialize/update job_dict from the lines appended to jobinfo_file since the last update'''
         try:
             input_file = open(self.jobinfo_file, "r")
         except IOError:
             logger.error("History manager: unable to open jobinfo file %s", self.jobinfo_file)
             return
-                
-        for line in input_file:
-            line = line.strip('\n')
-            jobspec = parse_jobinfo(line)
-            jobid = jobspec.get('jobid')
-            if not self.job_dict.has_key(jobid):
-                self.job_dict[jobid] = {}
-            self.job_dict[jobid] = jobspec
-            self.project_set.add(jobspec.get('project'))
-            self.user_set.add(jobspec.get('user'))
-            key_pair = (jobspec.get('user'), jobspec.get('project'))
-            self.pair_set.add(key_pair)
-                    
-        input_file.close()            
+
+        try:
+            input_file.seek(0, 2)
+            if input_file.tell() < self.jobinfo_offset:
+                logger.info("History manager: jobinfo file %s was truncated, reading it again", self.jobinfo_file)
+                self.reset_history()
+            input_file.seek(self.jobinfo_offset)
+            for line in iter(input_file.readline, ''):
+                if not line.endswith('\n'):
+                    # still being written; read it on the next update
+                    break
+                self.jobinfo_offset += len(line)
+                jobspec = parse_jobinfo(line.strip('\n'))
+                if jobspec is None:
+                    logger.warning("History manager: skipping malformed jobinfo line %r", line)
+                    continue
+                self.add_job(jobspec)
+        finally:
+            input_file.close()
+        self.expire_jobs()
                         
     def update_Ap_Dict(self):
         '''Update dictionary Adjust Parameter (Ap), including project based Dict and user based Dict'''
         
         self.update_job_dict()
         
-        for projectname in self.project_set:
-            if not self.Ap_dict_proj.has_key(projectname):
-                ap = self.calculate_Ap('project', projectname)
-                self.Ap_dict_proj[projectname] = ap
-                
-        for username in self.user_set:
-            if not self.Ap_dict_proj.has_key(username):
-                ap = self.calculate_Ap('user', username)
-                self.Ap_dict_user[username] = ap
-                
-        for keypair in self.pair_set:
-            if not self.Ap_dict_paired.has_key(keypair):
-                ap = self.calculate_Ap_paired(keypair)
-                keystr = "%s:%s" % (keypair[0], keypair[1])
-                self.Ap_dict_paired[keystr] = ap                
+        for kind, key in self.changed_keys:
+            if kind == 'paired':
+                keystr = "%s:%s" % (key[0], key[1])
+                if self.Rvalues['paired'].has_key(key):
+                    self.Ap_dict_paired[keystr] = self.calculate_Ap_paired(key)
+                else:
+                    self.Ap_dict_paired.pop(keystr, None)
+            else:
+                ap_dict = {'project':self.Ap_dict_proj, 'user':self.Ap_dict_user}[kind]
+                if self.Rvalues[kind].has_key(key):
+                    ap_dict[key] = self.calculate_Ap(kind, key)
+                else:
+                    ap_dict.pop(key, None)
+        self.changed_keys.clear()
       
         print "***********Adjusting Parameter Dict Updated***********"
         
@@ -113,16 +203,10 @@ class HistoryManager(Component):
                         
     def calculate_Ap(self, keyname, valname):
         '''get Adjust Parameter from dict, keyname: either 'project' or 'user', valname: value of the key'''
-        Rlist = []  #list of R values
-               
-        for id in self.job_dict.keys():
-            if self.job_dict[id][keyname] == valname:
-                Rlist.append(float(self.job_dict[id]['Rvalue']))
+        Rlist = self.Rvalues[keyname].get(valname, [])  #R values
                  
         if len(Rlist) > self.least_item:
-            Rlist.sort()
-            pos = int(self.fraction * len(Rlist))
-            Ap = Rlist[pos]
+            Ap = Rlist.quantile(self.fraction)
         else:
             Ap = 1
         if Ap > 1:
@@ -130,18 +214,10 @@ class HistoryManager(Component):
         return Ap
     
     def calculate_Ap_paired(self, keypair):
-        username = keypair[0]
-        projectname = keypair[1]
-        
-        Rlist = [] 
-        for id in self.job_dict.keys():
-            if self.job_dict[id]['user'] == username and self.job_dict[id]['project'] == projectname:
-                Rlist.append(float(self.job_dict[id]['Rvalue']))
+        Rlist = self.Rvalues['paired'].get(tuple(keypair), [])
             
         if len(Rlist) > self.least_item:
-            Rlist.sort()
-            pos = int(self.fraction * len(Rlist))
-            Ap = Rlist[pos]
+            Ap = Rlist.quantile(self.fraction)
         else:
             Ap = 1
         if Ap < self.minimum_ap:
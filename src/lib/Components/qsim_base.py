@@ -65,7 +65,7 @@ if not config.has_section('cqm'):
 def get_histm_config(option, default):
     try:
         value = config.get('histm', option)
-    except ConfigParser.NoOptionError:
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
         value = default
     return value
 
@@ -38,7 +38,7 @@ from xmlrpclib import ServerProxy
 
 import Cobalt.Logging
 from Cobalt.Data import Data, DataDict
-from Cobalt.Components.base import Component, exposed, automatic, query
+from Cobalt.Components.base import Component, exposed, automatic, query, readonly
 from Cobalt.Server import XMLRPCServer
 
 
@@ -153,12 +153,12 @@ class ServiceLocator (Component):
         else:
             self.logger.debug("locate(%r) [registered]" % (service_name))
         return service.location
-    locate = exposed(locate)
+    locate = exposed(readonly(locate))
 
     def get_services (self, specs):
         """Query interface "Get" method."""
         return self.services.q_get(specs)
-    get_services = exposed(query(get_services))
+    get_services = exposed(query(readonly(get_services)))
 
 
 class PollingServiceLocator (ServiceLocator):
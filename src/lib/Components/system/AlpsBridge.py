@@ -7,6 +7,8 @@
 #forker isn't.  These will be able to block for now.
 
 import logging
+import sys
+import threading
 import xml.etree
 import xmlrpclib
 import json
@@ -14,6 +16,7 @@ from cray_messaging import InvalidBasilMethodError, BasilRequest
 from cray_messaging import parse_response, ALPSError
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Data import IncrID
+from Cobalt.Statistics import process_statistics
 from Cobalt.Util import sleep
 from Cobalt.Util import init_cobalt_config, get_config_option
 from Cobalt.Util import compact_num_list, expand_num_list
@@ -29,12 +32,18 @@ CAPMC_PATH = get_config_option('capmc', 'path', '/opt/cray/capmc/default/bin/cap
 _RUNID_GEN = IncrID()
 CHILD_SLEEP_TIMEOUT = float(get_config_option('alps', 'child_sleep_timeout',
                                               1.0))
+# How long to ask the forker to wait for a child to complete per call.
+CHILD_WAIT_TIMEOUT = float(get_config_option('alps', 'child_wait_timeout', 30.0))
 DEFAULT_DEPTH = int(get_config_option('alps', 'default_depth', 72))
 
 class BridgeError(Exception):
     '''Exception class so that we may easily recognize bridge-specific errors.'''
     pass
 
+# Set to False the first time the forker turns out not to support
+# wait_children, after which children are polled with get_children.
+_wait_children_supported = True
+
 def init_bridge():
     '''Initialize the bridge.  This includes purging all old bridge messages
     from the system_script_forker.  On restart or reinitialization, these old
@@ -341,7 +350,7 @@ def _call_sys_forker(path, tag, label, args=None, in_str=None):
         complete = False
         #Is a timeout needed here?
         try:
-            children = ComponentProxy(FORKER).get_children('apbridge', [runid])
+            children = _wait_child(runid)
         except xmlrpclib.Fault as fault:
             _log_xmlrpc_error(runid, fault)
         else:
@@ -364,9 +373,60 @@ def _call_sys_forker(path, tag, label, args=None, in_str=None):
                         complete = True
         if complete:
             break
-        sleep(CHILD_SLEEP_TIMEOUT)
+        if not _wait_children_supported:
+            sleep(CHILD_SLEEP_TIMEOUT)
     return resp
 
+def _wait_child(runid):
+    '''Fetch the state of a child from the forker.  The forker holds the call
+    until the child completes or the wait times out, so completion is seen
+    without polling; forkers without wait_children are polled instead.
+
+    '''
+    global _wait_children_supported
+    if _wait_children_supported:
+        try:
+            return ComponentProxy(FORKER).wait_children('apbridge', [runid], CHILD_WAIT_TIMEOUT)
+        except xmlrpclib.Fault as fault:
+            if fault.faultString != 'wait_children': # NoExposedMethod
+                raise
+            _logger.warning('%s does not support wait_children, polling for child completion instead.', FORKER)
+            _wait_children_supported = False
+    return ComponentProxy(FORKER).get_children('apbridge', [runid])
+
+def call_concurrently(*calls):
+    '''Make several bridge calls at once and wait for all of them.
+
+    Args:
+        calls - callables taking no arguments, such as fetch_reservations.
+
+    Returns:
+        A list of the return values of calls, in order.
+
+    Exceptions:
+        If any call raised, the exception from the first such call is raised
+        once all calls are done.
+
+    '''
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    def run(index):
+        try:
+            results[index] = calls[index]()
+        except Exception:
+            errors[index] = sys.exc_info()
+    threads = [threading.Thread(target=run, args=(index,), name='alps_bridge_call')
+               for index in range(len(calls))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
 def _call_sys_forker_basil(basil_path, in_str):
     '''Make a  call through to BASIL wait until we get output and clean up
     child info.
@@ -389,7 +449,8 @@ def _call_sys_forker_basil(basil_path, in_str):
 
     '''
 
-    resp = _call_sys_forker(basil_path, 'apbridge', 'alps', in_str=in_str)
+    with process_statistics.timing('alps.basil'):
+        resp = _call_sys_forker(basil_path, 'apbridge', 'alps', in_str=in_str)
     parsed_resp = {}
     try:
         parsed_resp = parse_response(resp)
@@ -400,7 +461,8 @@ def _call_sys_forker_basil(basil_path, in_str):
 
 def _call_sys_forker_capmc(capmc_path, args):
     '''Call a CAPMC command and recieve response'''
-    resp = _call_sys_forker(capmc_path, 'apbridge', 'capmc_ssd', args=args)
+    with process_statistics.timing('alps.capmc'):
+        resp = _call_sys_forker(capmc_path, 'apbridge', 'capmc_ssd', args=args)
     parsed_response = {}
     try:
         parsed_response = json.loads(resp)
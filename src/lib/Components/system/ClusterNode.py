@@ -31,6 +31,8 @@ class ClusterNode(Resource):
 
     '''
 
+    _state_index = None #NodeStateIndex tracking this node, if any.
+
     def __init__(self, spec):
         '''Initialize a ClusterNode object.'''
         super(ClusterNode, self).__init__(spec)
@@ -49,6 +51,17 @@ class ClusterNode(Resource):
         self._drain_until = node.drain_until
         self._drain_jobid = node.drain_jobid
 
+    def __getstate__(self):
+        '''The state index is not saved with the node.'''
+        state = dict(self.__dict__)
+        state.pop('_state_index', None)
+        return state
+
+    def _state_changed(self):
+        '''Let the state index know this node's state has changed.'''
+        if self._state_index is not None:
+            self._state_index.update_node(self)
+
     @property
     def drain_until(self):
         '''Time in seconds from epoch that the node will drain for.'''
@@ -103,11 +116,15 @@ class ClusterNode(Resource):
 
         self._drain_until = int(drain_until)
         self._drain_jobid = int(jobid)
+        self._state_changed()
 
     def clear_drain(self):
         '''Clear the draining data from a block.'''
+        draining = self.draining
         self._drain_until = None
         self._drain_jobid = None
+        if draining:
+            self._state_changed()
 
     @property
     def backfill_epsilon(self):
@@ -47,10 +47,10 @@ class CrayNode(ClusterNode):
             The output can be sent via XMLRPC without modificaiton
 
         '''
-        ret_node = self.__dict__
+        ret_node = self.__getstate__()
         if cooked:
             cooked_node = {}
-            for key, val in self.__dict__.items():
+            for key, val in ret_node.items():
                 if key.startswith('_'):
                     cooked_node[key[1:]] = val
                 else:
@@ -83,6 +83,7 @@ class CrayNode(ClusterNode):
         #admin down wins.  If an admin says it's down, it's down.
         if self.admin_down:
             self._status = 'down'
+            self._state_changed()
             return
         if new_status.upper() in self.CRAY_STATE_MAP.keys():
             self._status = self.CRAY_STATE_MAP[new_status.upper()]
@@ -93,4 +94,5 @@ class CrayNode(ClusterNode):
             raise KeyError('%s is not a valid state for Cray Nodes.' % new_status)
         if self._status == 'idle' and self.reserved:
             self.status == 'allocated'
+        self._state_changed()
 
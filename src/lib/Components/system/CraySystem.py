@@ -12,9 +12,11 @@ import ConfigParser
 import Cobalt.Util
 import Cobalt.Components.system.AlpsBridge as ALPSBridge
 from Cobalt.Components.system.AlpsBridge import ALPSError
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
 from Cobalt.Components.system.base_system import BaseSystem
 from Cobalt.Components.system.CrayNode import CrayNode
+from Cobalt.Components.system.NodeStateIndex import NodeStateIndex
+from Cobalt.Components.system.NodeStateIndex import nids_to_bitmap, bitmap_to_nids, bitmap_count
 from Cobalt.Components.system.base_pg_manager import ProcessGroupManager
 from Cobalt.Components.system.ALPSProcessGroup import ALPSProcessGroup
 from Cobalt.Exceptions import ComponentLookupError
@@ -44,6 +46,13 @@ CLEANUP_DRAIN_WINDOW = get_config_option('system', 'cleanup_drain_window', 300)
 #SSD information
 DEFAULT_MIN_SSD_SIZE = int(get_config_option('alpssystem', 'min_ssd_size', -1))
 
+#Maximum number of jobs started by a single find_job_location pass.  0 for no limit.
+MAX_PLACEMENTS_PER_PASS = int(get_config_option('alpssystem', 'max_placements_per_pass', 0))
+
+#Issue the ALPS and CAPMC queries for a state update at the same time rather than one after another.
+CONCURRENT_STATE_QUERIES = get_config_option('alpssystem', 'concurrent_state_queries',
+        'true').lower() in Cobalt.Util.config_true_values
+
 #Epsilon for backfilling.  This system does not do this on a per-node basis.
 BACKFILL_EPSILON = int(get_config_option('system', 'backfill_epsilon', 120))
 ELOGIN_HOSTS = [host for host in get_config_option('system', 'elogin_hosts', '').split(':')]
@@ -170,6 +179,7 @@ class CraySystem(BaseSystem):
         #populate initial state
         #state update thread and lock
         self._node_lock = threading.RLock()
+        self.node_index = NodeStateIndex(DEFAULT_MIN_SSD_SIZE)
         self._gen_node_to_queue()
         self.node_update_thread_kill_queue = Queue()
         self.node_update_thread_dead = False
@@ -327,8 +337,10 @@ class CraySystem(BaseSystem):
         pass
 
     def _gen_node_to_queue(self):
-        '''(Re)Generate a mapping for fast lookup of node-id's to queues.'''
+        '''(Re)Generate a mapping for fast lookup of node-id's to queues, and
+        rebuild the node state index.'''
         with self._node_lock:
+            self.node_index.reset(self.nodes.values())
             self.nodes_by_queue = {}
             for node in self.nodes.values():
                 for queue in node.queues:
@@ -338,6 +350,7 @@ class CraySystem(BaseSystem):
                         self.nodes_by_queue[queue] = set([node.node_id])
 
     @exposed
+    @readonly
     def get_nodes(self, as_dict=False, node_ids=None, params=None, as_json=False):
         '''fetch the node dictionary.
 
@@ -457,6 +470,7 @@ class CraySystem(BaseSystem):
                 self.logger.warning('Node %s marked down.', nid)
         new_node.managed = True
         self.nodes[str(nid)] = new_node
+        self.node_index.update_node(new_node)
         self.logger.warning('Node %s added to tracking.', nid)
 
 
@@ -474,11 +488,14 @@ class CraySystem(BaseSystem):
         fetch_time_start = time.time()
         try:
             #updated for >= 1.6 interface
-            inven_nodes = ALPSBridge.extract_system_node_data(ALPSBridge.system())
-            reservations = ALPSBridge.fetch_reservations()
             # Fetch SSD diagnostic data and enabled flags. I would hope these change in event of dead ssd
-            ssd_enabled = ALPSBridge.fetch_ssd_enable()
-            ssd_diags = ALPSBridge.fetch_ssd_diags()
+            queries = (ALPSBridge.system, ALPSBridge.fetch_reservations, ALPSBridge.fetch_ssd_enable,
+                    ALPSBridge.fetch_ssd_diags)
+            if CONCURRENT_STATE_QUERIES:
+                system, reservations, ssd_enabled, ssd_diags = ALPSBridge.call_concurrently(*queries)
+            else:
+                system, reservations, ssd_enabled, ssd_diags = [query() for query in queries]
+            inven_nodes = ALPSBridge.extract_system_node_data(system)
         except (ALPSBridge.ALPSError, ComponentLookupError):
             _logger.warning('Error contacting ALPS for state update.  Aborting this update',
                     exc_info=True)
@@ -610,6 +627,7 @@ class CraySystem(BaseSystem):
                    #               inven_node['node_id'])
             # Update SSD data:
             self._update_ssd_data(self.nodes, ssd_enabled=ssd_enabled, ssd_diags=ssd_diags)
+            self.node_index.update_nodes(self.nodes.values())
             #should down win over running in terms of display?
             #keep node that are marked for cleanup still in cleanup
             for node in cleanup_nodes:
@@ -785,93 +803,91 @@ class CraySystem(BaseSystem):
         return equiv_class
 
     def _setup_special_locations(self, job):
-        forbidden = set([str(loc) for loc in chain_loc_list(job.get('forbidden', []))])
-        required = set([str(loc) for loc in chain_loc_list(job.get('required', []))])
-        requested_locations = set([str(n) for n in expand_num_list(job['attrs'].get('location', ''))])
+        '''Return bitmaps of the forbidden, required and requested locations
+        for a job, and of the nodes without a usable SSD if the job requires
+        SSDs.'''
+        forbidden = nids_to_bitmap(chain_loc_list(job.get('forbidden', [])))
+        required = nids_to_bitmap(chain_loc_list(job.get('required', [])))
+        requested_locations = nids_to_bitmap(expand_num_list(job['attrs'].get('location', '')))
         # If ssds are required, add nodes without working SSDs to the forbidden list
-        ssd_unavail = set([])
+        ssd_unavail = 0
         if job.get('attrs', {}).get("ssds", "none").lower() == "required":
             ssd_min_size = int(job.get('attrs', {}).get("ssd_size", DEFAULT_MIN_SSD_SIZE)) * 1000000000 #convert to bytes
-            ssd_unavail.update(set([str(node.node_id) for node in self.nodes.values()
-                                  if (node.attributes['ssd_enabled'] == 0 or
-                                      int(node.attributes.get('ssd_info', {'size': DEFAULT_MIN_SSD_SIZE})['size'])  < ssd_min_size)
-                                ]))
+            ssd_unavail = self.node_index.all_nodes & ~self.node_index.ssd_available(ssd_min_size)
         return (forbidden, required, requested_locations, ssd_unavail)
 
-    def _assemble_queue_data(self, job, idle_only=True, drain_time=None):
-        '''put together data for a queue, or queue-like reservation structure.
-
-        Input:
-            job - dictionary of job data.
-            idle_only - [default: True] if True, return only idle nodes.
-                        Otherwise return nodes in any non-down status.
-
-        return count of idle resources, and a list of valid nodes to run on.
-        if idle_only is set to false, returns a set of candidate draining nodes.
+    def _job_node_mask(self, job):
+        '''Return a bitmap of the nodes a job may ever run on given its queue,
+        reservation and location requests, regardless of node status.
 
+        Raises a ValueError if the job requests locations outside of its queue.
 
         '''
         # RESERVATION SUPPORT: Reservation queues are ephemeral, so we will
         # not find the queue normally. In the event of a reservation we'll
         # have to intersect required nodes with the idle and available
         # we also have to forbid a bunch of locations, in  this case.
-        unavailable_nodes = []
         forbidden, required, requested_locations, ssd_unavail = self._setup_special_locations(job)
-        requested_loc_in_forbidden = False
-        for loc in requested_locations:
-            if loc in forbidden:
-                #don't spam the logs.
-                requested_loc_in_forbidden = True
-                break
-        if job['queue'] not in self.nodes_by_queue.keys():
+        queue_nodes = self.node_index.queue(job['queue'])
+        if not queue_nodes:
             # Either a new queue with no resources, or a possible
             # reservation need to do extra work for a reservation
-            node_id_list = list(required - forbidden - ssd_unavail)
+            node_mask = required & ~forbidden & ~ssd_unavail
         else:
-            node_id_list = list(set(self.nodes_by_queue[job['queue']]) - forbidden - ssd_unavail)
-        if requested_locations != set([]): # handle attrs location= requests
-            job_set = set([str(nid) for nid in requested_locations])
-            if job['queue'] not in self.nodes_by_queue.keys():
+            node_mask = queue_nodes & ~forbidden & ~ssd_unavail
+        if requested_locations: # handle attrs location= requests
+            if not queue_nodes:
                 #we're in a reservation and need to further restrict nodes.
-                if job_set <= set(node_id_list):
+                if not requested_locations & ~node_mask:
                     # We are in a reservation there are no forbidden nodes.
-                    node_id_list = list(requested_locations - ssd_unavail)
+                    node_mask = requested_locations & ~ssd_unavail
                 else:
                     # We can't run this job.  Insufficent resources in this
                     # reservation to do so.  Don't risk blocking anything.
-                    node_id_list = []
+                    node_mask = 0
             else:
                 # Check to see if the job is requesting resources that are not
                 # available in the queue specified and raise an exception.  This
                 # results in a warning.
-                if not requested_locations.issubset(set(self.nodes_by_queue[job['queue']])):
+                if requested_locations & ~queue_nodes:
                     raise ValueError("requested locations not in queue")
                 #normal queues.  Restrict to the non-reserved nodes.
-                if job_set <= set([str(node_id) for node_id in
-                                    self.nodes_by_queue[job['queue']]]):
-                    node_id_list = list(requested_locations)
-                    if not set(node_id_list).isdisjoint(forbidden):
-                        # this job has requested locations that are a part of an
-                        # active reservation.  Remove locaitons and drop available
-                        # nodecount appropriately.
-                        node_id_list = list(set(node_id_list) - forbidden - ssd_unavail)
-                    # if not requested_loc_in_forbidden:
-                        # raise ValueError("forbidden locations not in queue")
+                node_mask = requested_locations
+                if requested_locations & forbidden:
+                    # this job has requested locations that are a part of an
+                    # active reservation.  Remove locaitons and drop available
+                    # nodecount appropriately.
+                    node_mask = requested_locations & ~forbidden & ~ssd_unavail
+        return node_mask
+
+    def _assemble_queue_data(self, job, idle_only=True, drain_time=None):
+        '''put together data for a queue, or queue-like reservation structure.
+
+        Input:
+            job - dictionary of job data.
+            idle_only - [default: True] if True, return only idle nodes.
+                        Otherwise return nodes in any non-down status.
+            drain_time - [default: None] if set, drop nodes draining for a job
+                         that would start before drain_time.
+
+        return a list of valid nodes to run on, in nid order.
+        if idle_only is set to false, returns a set of candidate draining nodes.
+
+
+        '''
         with self._node_lock:
-            if idle_only:
-                unavailable_nodes = [node_id for node_id in node_id_list
-                        if self.nodes[str(node_id)].status not in ['idle']]
-            else:
-                unavailable_nodes = [node_id for node_id in node_id_list
-                        if self.nodes[str(node_id)].status in
-                        self.nodes[str(node_id)].DOWN_STATUSES]
-            if drain_time is not None:
-                unavailable_nodes.extend([node_id for node_id in node_id_list
-                    if (self.nodes[str(node_id)].draining and
-                        (self.nodes[str(node_id)].drain_until - BACKFILL_EPSILON) < int(drain_time))])
-        for node_id in set(unavailable_nodes):
-            node_id_list.remove(node_id)
-        return sorted(node_id_list, key=lambda nid: int(nid))
+            return bitmap_to_nids(self._available_nodes(self._job_node_mask(job), idle_only, drain_time))
+
+    def _available_nodes(self, node_mask, idle_only=True, drain_time=None):
+        '''Restrict a bitmap of nodes to those currently usable, as
+        _assemble_queue_data does.'''
+        if idle_only:
+            node_mask &= self.node_index.status('idle')
+        else:
+            node_mask &= self.node_index.all_nodes & ~self.node_index.status(*CrayNode.DOWN_STATUSES)
+        if drain_time is not None:
+            node_mask &= ~self.node_index.draining_before(int(drain_time) + BACKFILL_EPSILON)
+        return node_mask
 
     def _select_first_nodes(self, job, node_id_list):
         '''Given a list of nids, select the first node count nodes fromt the
@@ -879,7 +895,8 @@ class CraySystem(BaseSystem):
 
         Input:
             job - dictionary of job data from the scheduler
-            node_id_list - a list of possible candidate nodes
+            node_id_list - a list of possible candidate nodes, in nid order
+                           as returned by _assemble_queue_data
 
         Return:
             A list of nodes.  [] if insufficient nodes for the allocation.
@@ -891,7 +908,6 @@ class CraySystem(BaseSystem):
         ret_nodes = []
         with self._node_lock:
             if int(job['nodes']) <= len(node_id_list):
-                node_id_list.sort(key=lambda nid: int(nid))
                 ret_nodes = node_id_list[:int(job['nodes'])]
         return ret_nodes
 
@@ -902,7 +918,7 @@ class CraySystem(BaseSystem):
 
         Input:
             job - dictionary of job data from the scheduler
-            node_id_list - a list of possible candidate nodes
+            node_id_list - a list of possible candidate nodes, in nid order
 
         Return:
             A list of nodes.  [] if insufficient nodes for the allocation.
@@ -917,13 +933,13 @@ class CraySystem(BaseSystem):
             return self._select_first_nodes(job, node_id_list)
         ret_nids = []
         with self._node_lock:
-            considered_nodes = [node for node in self.nodes.values() if node.node_id in node_id_list]
+            considered_ids = set([str(nid) for nid in node_id_list])
+            considered_nodes = [node for node in self.nodes.values() if node.node_id in considered_ids]
             for node in considered_nodes:
                 if (node.attributes['hbm_cache_pct'] == MCDRAM_TO_HBMCACHEPCT[job['attrs']['mcdram']] and
                         node.attributes['numa_cfg'] == job['attrs']['numa']):
                     ret_nids.append(int(node.node_id))
             if len(ret_nids) < int(job['nodes']):
-                node_id_list.sort(key=lambda nid: int(nid))
                 for nid in node_id_list:
                     if int(nid) not in ret_nids:
                         ret_nids.append(int(nid))
@@ -985,6 +1001,9 @@ class CraySystem(BaseSystem):
 
         Returns:
         A mapping of jobids to locations to run a job to run immediately.
+        Every job that fits is placed, up to max_placements_per_pass jobs if
+        that is set in the [alpssystem] section.  Nodes are only drained for
+        jobs ahead of the first placement.
 
         Side Effects:
         May set draining flags and backfill windows on nodes.
@@ -1010,36 +1029,40 @@ class CraySystem(BaseSystem):
             #check if we can run immedaitely, if not drain.  Keep going until all
             #nodes are marked for draining or have a pending run.
             best_match = {} #jobid: list(locations)
+            node_masks = {} # distinct queue/location requests seen this pass
             for job in arg_list:
+                if MAX_PLACEMENTS_PER_PASS and len(best_match) >= MAX_PLACEMENTS_PER_PASS:
+                    break
                 label = '%s/%s' % (job['jobid'], job['user'])
                 # walltime is in minutes.  We should really fix the storage of
                 # that --PMR
                 job_endtime = now + (int(job['walltime']) * 60)
                 try:
-                    node_id_list = self._assemble_queue_data(job, drain_time=job_endtime)
-                    available_node_list = self._assemble_queue_data(job, idle_only=False)
+                    node_mask = self._pass_node_mask(job, node_masks)
                 except ValueError:
                     _logger.warning('Job %s: requesting locations that are not in requested queue.',
                             job['jobid'])
                     continue
-                if int(job['nodes']) > len(available_node_list):
+                if int(job['nodes']) > bitmap_count(self._available_nodes(node_mask, idle_only=False)):
                     # Insufficient operational nodes for this job at all
                     continue
-                elif len(node_id_list) == 0:
+                node_id_list = bitmap_to_nids(self._available_nodes(node_mask, drain_time=job_endtime))
+                if len(node_id_list) == 0:
                     pass #allow for draining pass to run.
                 elif int(job['nodes']) <= len(node_id_list):
                     # enough nodes are in a working state to consider the job.
                     # enough nodes are idle that we can run this job
                     compact_locs = self._associate_and_run_immediate(job,
                             resource_until_time, node_id_list)
-                    # do we want to allow multiple placements in a single
-                    # pass? That would likely help startup times.
                     if compact_locs is not None:
                         best_match[job['jobid']] = [compact_locs]
                         _logger.info("%s: Job selected for running on nodes  %s",
                                 label, compact_locs)
-                        break #for now only select one location
-                if DRAIN_MODE in ['backfill', 'drain-only']:
+                        continue
+                # Once a job has been placed, later jobs in this pass may only
+                # backfill.  The end_times we were handed don't know about the
+                # new placements, so draining waits for the next pass.
+                if DRAIN_MODE in ['backfill', 'drain-only'] and not best_match:
                     # drain sufficient nodes for this job to run
                     drain_node_ids = self._select_nodes_for_draining(job,
                             end_times)
@@ -1048,6 +1071,35 @@ class CraySystem(BaseSystem):
                                 compact_num_list(drain_node_ids))
         return best_match
 
+    def _pass_node_mask(self, job, node_masks):
+        '''Return _job_node_mask for a job within a find_job_location pass.
+
+        Input:
+            job - dictionary of job data.
+            node_masks - masks already built this pass, keyed by the parts of
+                         the job that determine them.
+
+        Notes:
+            The mask does not depend on node status, so it is only built once
+            per kind of request in a pass.  Reservations and drains made by
+            the pass are seen through the node index.
+
+        '''
+        attrs = job.get('attrs', {})
+        key = (job['queue'], tuple(job.get('forbidden', [])), tuple(job.get('required', [])),
+               str(attrs.get('location', '')), str(attrs.get('ssds', 'none')).lower(),
+               str(attrs.get('ssd_size', DEFAULT_MIN_SSD_SIZE)))
+        node_mask = node_masks.get(key)
+        if node_mask is None:
+            try:
+                node_mask = self._job_node_mask(job)
+            except ValueError as exc:
+                node_mask = exc
+            node_masks[key] = node_mask
+        if isinstance(node_mask, ValueError):
+            raise node_mask
+        return node_mask
+
     def _ALPS_reserve_resources(self, job, new_time, node_id_list):
         '''Call ALPS to reserve resrources.  Use their allocator.  We can change
         this later to substitute our own allocator if-needed.
@@ -1118,15 +1170,15 @@ class CraySystem(BaseSystem):
         now = int(time.time())
         end_times.sort(key=lambda x: int(x[1]))
         drain_list = []
-        candidate_list = []
         cleanup_statuses = ['cleanup', 'cleanup-pending']
         forbidden, required, requested_locations, ssd_unavail = self._setup_special_locations(job)
         try:
-            node_id_list = self._assemble_queue_data(job, idle_only=False)
+            node_mask = self._job_node_mask(job)
         except ValueError:
             _logger.warning('Job %s: requesting locations that are not in queue.', job['jobid'])
         else:
             with self._node_lock:
+                index = self.node_index
                 drain_time = None
                 candidate_drain_time = None
                 # remove the following from the list:
@@ -1136,51 +1188,37 @@ class CraySystem(BaseSystem):
                 #    jobid. CLEANING_ID is a sentinel jobid value so we can set
                 #    a drain window on cleaning nodes easily.  Not sure if this
                 #    is the right thing to do. --PMR
-                candidate_list = []
-                candidate_list = [str(nid) for nid in node_id_list
-                        if (not self.nodes[str(nid)].draining and
-                            (self.nodes[str(nid)].status in ['idle']) or
-                            (self.nodes[str(nid)].status in cleanup_statuses)
-                            )]
-                for nid in candidate_list:
-                    if self.nodes[str(nid)].status in cleanup_statuses:
-                        candidate_drain_time = now + CLEANUP_DRAIN_WINDOW
+                node_mask = self._available_nodes(node_mask, idle_only=False)
+                cleanup_nodes = node_mask & index.status(*cleanup_statuses)
+                candidates = (node_mask & index.status('idle') & ~index.draining) | cleanup_nodes
+                if cleanup_nodes:
+                    candidate_drain_time = now + CLEANUP_DRAIN_WINDOW
+                drain_mask = (index.queue(job['queue']) | required) & index.all_nodes
                 for loc_time in end_times:
-                    running_nodes = [str(nid) for nid in
-                            expand_num_list(",".join(loc_time[0]))
-                            if ((job['queue'] in self.nodes[str(nid)].queues or
-                                nid in required) and
-                                not self.nodes[str(nid)].draining)]
-                    for nid in running_nodes:
-                        # We set a drain on all running nodes for use in a later
-                        # so that we can "favor" draining on the longest
-                        # running set of nodes.
-                        if (self.nodes[str(nid)].status != 'down' and
-                                self.nodes[str(nid)].managed):
-                            self.nodes[str(nid)].set_drain(loc_time[1], job['jobid'])
-                    # It's a list not a set, need to ensure uniqueness
-                    candidate_list.extend([str(nid) for nid in running_nodes if
-                        self.nodes[str(nid)].draining and str(nid) not in candidate_list])
+                    running_nodes = (nids_to_bitmap(expand_num_list(",".join(loc_time[0]))) &
+                            drain_mask & ~index.draining)
+                    # We set a drain on all running nodes for use in a later
+                    # so that we can "favor" draining on the longest
+                    # running set of nodes.
+                    for nid in bitmap_to_nids(running_nodes & ~index.status('down')):
+                        if self.nodes[nid].managed:
+                            self.nodes[nid].set_drain(loc_time[1], job['jobid'])
+                    candidates |= running_nodes & index.draining
                     candidate_drain_time = int(loc_time[1])
-                    if len(candidate_list) >= int(job['nodes']):
+                    if bitmap_count(candidates) >= int(job['nodes']):
                         # Enough nodes have been found to drain for this job
                         break
-                candidates = set(candidate_list)
                 # We need to further restrict this list based on requested
                 # location and reservation avoidance data:
-                if forbidden != set([]):
-                    candidates = candidates.difference(forbidden)
-                if ssd_unavail != set([]):
-                    candidates = candidates.difference(ssd_unavail)
-                if requested_locations != set([]):
-                    candidates = candidates.intersection(requested_locations)
-                candidate_list = list(candidates)
+                candidates &= ~forbidden & ~ssd_unavail
+                if requested_locations:
+                    candidates &= requested_locations
+                candidate_list = bitmap_to_nids(candidates)
                 if len(candidate_list) >= int(job['nodes']):
                     drain_time = candidate_drain_time
                 if drain_time is not None:
                     # order the node ids by id and drain-time. Longest drain
                     # first
-                    candidate_list.sort(key=lambda nid: int(nid))
                     candidate_list.sort(reverse=True,
                             key=lambda nid: self.nodes[str(nid)].drain_until)
                     drain_list = candidate_list[:int(job['nodes'])]
@@ -1380,6 +1418,7 @@ class CraySystem(BaseSystem):
 
     @exposed
     @query
+    @readonly
     def get_process_groups(self, specs):
         '''Return a list of process groups using specs as a filter'''
         return self.process_manager.process_groups.q_get(specs)
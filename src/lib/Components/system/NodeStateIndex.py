@@ -0,0 +1,181 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+"""Bitmap index of node state for fast candidate node selection.
+
+Node ids are used as bit positions in Python integers, so the set of nodes
+in a status, in a queue, draining before a given time or with a usable SSD
+is a single integer, and candidate node sets for a job are built with
+bitwise operations rather than by walking every node.
+
+"""
+import binascii
+import itertools
+import threading
+
+_nid_names = [] # str(nid) for each bit position, shared by bitmap_to_nids
+
+
+def nids_to_bitmap(node_ids):
+    '''Return a bitmap with the bit for each node id in node_ids set.'''
+    nids = [int(nid) for nid in node_ids]
+    if not nids:
+        return 0
+    bits = bytearray(max(nids) // 8 + 1)
+    for nid in nids:
+        bits[nid >> 3] |= 1 << (nid & 7)
+    bits.reverse()
+    return int(binascii.hexlify(bytes(bits)), 16)
+
+def bitmap_to_nids(bitmap):
+    '''Return the node ids set in bitmap as strings, in ascending order.'''
+    global _nid_names
+    bits = bin(bitmap)[:1:-1]
+    nid_names = _nid_names
+    if len(nid_names) < len(bits):
+        nid_names = [str(nid) for nid in xrange(2 * len(bits))]
+        _nid_names = nid_names
+    return list(itertools.compress(nid_names, bytearray(bits.replace('0', '\0'))))
+
+def bitmap_count(bitmap):
+    '''Return the number of nodes set in bitmap.'''
+    return bin(bitmap).count('1')
+
+
+class NodeStateIndex(object):
+    '''Bitmaps of node ids by status, queue, drain time and SSD size.
+
+    Nodes are added with update_node, which also registers the index with the
+    node so that status and drain changes made on the node are reflected here
+    as they happen.  Queue and attribute (SSD) changes are picked up the next
+    time update_node is called for the node.
+
+    all_nodes - every indexed node
+    draining - nodes with a drain time set
+
+    '''
+
+    def __init__(self, default_ssd_size=0):
+        self.default_ssd_size = default_ssd_size
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        '''Drop all indexed nodes.'''
+        self.all_nodes = 0
+        self.draining = 0
+        self.by_status = {}
+        self.by_queue = {}
+        self.by_drain_until = {}
+        self.by_ssd_size = {}
+        self._node_keys = {} #nid: (status, queues, drain_until, ssd_size)
+
+    def reset(self, nodes):
+        '''Rebuild the index from an iterable of nodes.'''
+        with self._lock:
+            self._clear()
+            self.update_nodes(nodes)
+
+    def update_nodes(self, nodes):
+        '''Update the index entries for an iterable of nodes.'''
+        with self._lock:
+            for node in nodes:
+                self.update_node(node)
+
+    def update_node(self, node):
+        '''Update the index entry for a node, adding it if it is new.'''
+        nid = int(node.node_id)
+        key = self._node_key(node)
+        with self._lock:
+            old_key = self._node_keys.get(nid, None)
+            node._state_index = self
+            if key == old_key:
+                return
+            bit = 1 << nid
+            if old_key is None:
+                self.all_nodes |= bit
+            else:
+                self._unset(bit, old_key)
+            self._set(bit, key)
+            self._node_keys[nid] = key
+
+    def remove_node(self, node):
+        '''Remove a node from the index.'''
+        nid = int(node.node_id)
+        with self._lock:
+            old_key = self._node_keys.pop(nid, None)
+            if old_key is not None:
+                bit = 1 << nid
+                self.all_nodes &= ~bit
+                self._unset(bit, old_key)
+            node._state_index = None
+
+    def _node_key(self, node):
+        '''The indexed state of a node.  ssd_size is None if the node has no
+        usable SSD.'''
+        ssd_size = None
+        if node.attributes.get('ssd_enabled', 0) != 0:
+            ssd_size = int(node.attributes.get('ssd_info', {'size': self.default_ssd_size})['size'])
+        return (node.status, tuple(node.queues), node.drain_until, ssd_size)
+
+    def _set(self, bit, key):
+        '''Set a node's bit in the maps for key.'''
+        status, queues, drain_until, ssd_size = key
+        _set_bit(self.by_status, status, bit)
+        for queue in queues:
+            _set_bit(self.by_queue, queue, bit)
+        if drain_until is not None:
+            self.draining |= bit
+            _set_bit(self.by_drain_until, drain_until, bit)
+        if ssd_size is not None:
+            _set_bit(self.by_ssd_size, ssd_size, bit)
+
+    def _unset(self, bit, key):
+        '''Clear a node's bit from the maps for key.'''
+        status, queues, drain_until, ssd_size = key
+        _unset_bit(self.by_status, status, bit)
+        for queue in queues:
+            _unset_bit(self.by_queue, queue, bit)
+        if drain_until is not None:
+            self.draining &= ~bit
+            _unset_bit(self.by_drain_until, drain_until, bit)
+        if ssd_size is not None:
+            _unset_bit(self.by_ssd_size, ssd_size, bit)
+
+    def status(self, *statuses):
+        '''Bitmap of nodes in any of the given statuses.'''
+        bitmap = 0
+        for status in statuses:
+            bitmap |= self.by_status.get(status, 0)
+        return bitmap
+
+    def queue(self, queue):
+        '''Bitmap of nodes in a queue.'''
+        return self.by_queue.get(queue, 0)
+
+    def draining_before(self, when):
+        '''Bitmap of draining nodes whose drain time is before when.'''
+        bitmap = 0
+        for drain_until, nodes in self.by_drain_until.items():
+            if drain_until < when:
+                bitmap |= nodes
+        return bitmap
+
+    def ssd_available(self, min_size):
+        '''Bitmap of nodes with an enabled SSD of at least min_size bytes.'''
+        bitmap = 0
+        for ssd_size, nodes in self.by_ssd_size.items():
+            if ssd_size >= min_size:
+                bitmap |= nodes
+        return bitmap
+
+def _set_bit(bitmaps, key, bit):
+    '''Set bit in the bitmap stored under key.'''
+    bitmaps[key] = bitmaps.get(key, 0) | bit
+
+def _unset_bit(bitmaps, key, bit):
+    '''Clear bit in the bitmap stored under key, dropping empty bitmaps.'''
+    bitmap = bitmaps.get(key, 0) & ~bit
+    if bitmap:
+        bitmaps[key] = bitmap
+    else:
+        bitmaps.pop(key, None)
@@ -25,6 +25,11 @@ import time
 import ConfigParser
 import math
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 import Cobalt
 import Cobalt.Proxy
 import Cobalt.Data
@@ -42,6 +47,13 @@ try:
 except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
     DEFAULT_LOG_DIRECTORY = Cobalt.DEFAULT_LOG_DIRECTORY
 
+# The SQLite index of the logs kept by HistoryIndex.  Defaults to history.db
+# in the log directory.
+try:
+    DEFAULT_INDEX_FILE = os.path.expandvars(CP.get('cqm', 'history_index'))
+except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+    DEFAULT_INDEX_FILE = None
+
 # Default number of previous days to include when examining logs. This must
 # be greater than the maximum walltime in days + 1 so we are sure to catch the
 # start and the end of every job.
@@ -204,6 +216,44 @@ re_pbs_e = re.compile("""(?P<date>\d\d/\d\d/\d\d\d\d\s+
                          (?P<jobid>\d+);
                          (?P<attributes>.*)$""", re.VERBOSE)
 
+def parse_exit_record(line):
+    """
+    Return the job spec of a PBS-style exit log record, or None if the line
+    is not one.
+    """
+    m_pbs_e = re_pbs_e.match(line)
+    if not m_pbs_e:
+        return None
+    jobid = long(m_pbs_e.group("jobid"))
+    if not jobid:
+        return None
+
+    job = {'jobid':jobid}
+
+    # the attributes regex group consists of all the job attributes
+    # listed after the jobid on the log line
+    job_attributes = m_pbs_e.group("attributes")
+    attribute_dict = dict()
+    for item in re.split(r'\s+(?=[a-zA-Z0-9_.]+=)', job_attributes):
+        attribute_dict.update([item.split("=", 1)])
+    job['user'] = attribute_dict['user']
+    job['nodes'] = attribute_dict['Resource_List.nodect']
+    job['procs'] = attribute_dict['Resource_List.ncpus']
+    job['mode'] = attribute_dict['mode']
+    job['runtime'] = attribute_dict['resources_used.walltime']
+    job['walltime'] = attribute_dict['Resource_List.walltime']
+    job['queue'] = attribute_dict['queue']
+    job['location'] = attribute_dict['exec_host']
+    job['account'] = attribute_dict.get('account', 'N/A')
+    job['exit'] = attribute_dict.get('Exit_status', 'N/A')
+
+    # stats
+    job['submit_time'] = float(attribute_dict['ctime'])
+    job['start_time'] = float(attribute_dict['start'])
+    job['queued_time'] = float(attribute_dict['start']) - float(attribute_dict['ctime'])
+    job['end_time'] = float(attribute_dict['end'])
+    return job
+
 def _time_property(time_field):
     """
     The "private" time_field attribute of an object may contain some sort of time object.
@@ -387,50 +437,12 @@ class CobaltLogParser(Cobalt.Data.DataDict):
             "Filename %s was not in format 'qm-yyyy_mm_dd'" % \
             (filename)
         
-        # Read the log file
+        # Read the log file.  Currently just looking for the PBS exit line.
         logfile = open( filename, "r" )
         for line in logfile:
-            # Try the line against the regular expressions we're looking
-            # for. Currently just looking for the PBS exit line.
-            
-            # If the line matches the regular expressions, extract the jobid.
-            # This is a bit kludgy, but we'll want separate match objects
-            # later so we can set parameters.
-            jobid = None
-            m_pbs_e = re_pbs_e.match(line)
-            if m_pbs_e:
-                jobid = long(m_pbs_e.group("jobid"))
-            
-            # If none matched, then get the next line
-            if not jobid:
-                continue
-            
-            job = {'jobid':jobid}
-            
-            # the attributes regex group consists of all the job attributes
-            # listed after the jobid on the log line
-            job_attributes = m_pbs_e.group("attributes")
-            attribute_dict = dict()
-            for item in re.split(r'\s+(?=[a-zA-Z0-9_.]+=)', job_attributes):
-                attribute_dict.update([item.split("=", 1)])
-            job['user'] = attribute_dict['user']
-            job['nodes'] = attribute_dict['Resource_List.nodect']
-            job['procs'] = attribute_dict['Resource_List.ncpus']
-            job['mode'] = attribute_dict['mode']
-            job['runtime'] = attribute_dict['resources_used.walltime']
-            job['walltime'] = attribute_dict['Resource_List.walltime']
-            job['queue'] = attribute_dict['queue']
-            job['location'] = attribute_dict['exec_host']
-            job['account'] = attribute_dict.get('account', 'N/A')
-            job['exit'] = attribute_dict.get('Exit_status', 'N/A')
-            
-            # stats
-            job['submit_time'] = float(attribute_dict['ctime'])
-            job['start_time'] = float(attribute_dict['start'])
-            job['queued_time'] = float(attribute_dict['start']) - float(attribute_dict['ctime'])
-            job['end_time'] = float(attribute_dict['end'])
-            
-            self.q_add([job])
+            job = parse_exit_record(line)
+            if job is not None:
+                self.q_add([job])
         
         logfile.close()
     
@@ -489,3 +501,212 @@ class CobaltLogParser(Cobalt.Data.DataDict):
         self.finalize_parse()
     
 
+
+# ----------------------------------------------------------------------------
+#
+# Log Index
+#
+# ----------------------------------------------------------------------------
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, offset INTEGER);
+CREATE TABLE IF NOT EXISTS jobs (file TEXT, jobid INTEGER, user TEXT, queue TEXT, account TEXT, nodes TEXT, procs TEXT,
+    mode TEXT, runtime TEXT, walltime TEXT, location TEXT, exit TEXT, exit_status INTEGER, submit_time REAL,
+    start_time REAL, end_time REAL);
+CREATE INDEX IF NOT EXISTS jobs_end_time ON jobs (end_time);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, end_time);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (queue, end_time);
+CREATE INDEX IF NOT EXISTS jobs_account ON jobs (account, end_time);
+CREATE INDEX IF NOT EXISTS jobs_exit_status ON jobs (exit_status, end_time);
+CREATE INDEX IF NOT EXISTS jobs_file ON jobs (file);
+"""
+
+_JOB_COLUMNS = ["jobid", "user", "queue", "account", "nodes", "procs", "mode", "runtime", "walltime", "location",
+                "exit", "submit_time", "start_time", "end_time"]
+
+def _exit_status(exit):
+    """The exit status as finalize reports it, or None if there is none."""
+    if not exit.isdigit():
+        return None
+    if int(exit) > 255:
+        return int(exit) / 256
+    return int(exit)
+
+
+class HistoryIndex(object):
+    """
+    A persistent SQLite index of the job exit records in the accounting logs.
+
+    update only reads what was appended to each log file since the previous
+    update, so history over any range of dates can be queried without
+    rereading the logs.  cqm updates the index periodically.  If the index
+    cannot be written (it is normally owned by the user cqm runs as), the
+    records of the last DEFAULT_DAYS log files that the index lacks are
+    read and kept in memory, and queries include them.
+    """
+
+    def __init__(self, index_file=None, log_dir=None):
+        if sqlite3 is None:
+            raise IOError("the sqlite3 module is required for the history index")
+        self.log_dir = os.path.abspath(log_dir or DEFAULT_LOG_DIRECTORY)
+        self.index_file = index_file or DEFAULT_INDEX_FILE or os.path.join(self.log_dir, "history.db")
+        self.db = sqlite3.connect(self.index_file, timeout=30)
+        # log lines are not necessarily ASCII
+        self.db.text_factory = str
+        self.db.executescript(_INDEX_SCHEMA)
+        # records read but not written to the index, and files they replace
+        self.unsaved_rows = []
+        self.unsaved_offsets = {}
+        self.stale_files = set()
+
+    def close(self):
+        self.db.close()
+
+    def writable(self):
+        """Return whether the index can be written."""
+        try:
+            with self.db:
+                # takes the write lock without changing anything
+                self.db.execute("DELETE FROM files WHERE 0")
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def update(self):
+        """
+        Index the exit records appended to the log files since the last
+        update.  Returns the number of records added.
+        """
+        if not os.path.exists(self.log_dir):
+            raise IOError("Log directory %s not found. Check the " % (self.log_dir) + \
+                "log_dir parameter for [cqm] in cobalt.conf." )
+        files = [ filename for filename in os.listdir(self.log_dir)
+                  if re.match("^\d{8,8}$", filename) and
+                  os.path.isfile(os.path.join(self.log_dir, filename)) ]
+        files.sort()
+        writable = self.writable()
+        if not writable:
+            # the index may be far behind, and what is read now is read again by every run until it is written
+            files = files[-DEFAULT_DAYS:]
+        offsets = dict(self.db.execute("SELECT name, offset FROM files"))
+        offsets.update(self.unsaved_offsets)
+        changes = []
+        for filename in files:
+            path = os.path.join(self.log_dir, filename)
+            size = os.path.getsize(path)
+            offset = offsets.get(filename, 0)
+            rewritten = size < offset
+            if rewritten:
+                # the file was rewritten; index it again from the start
+                offset = 0
+            if size == offset:
+                continue
+            logfile = open(path, "rb")
+            try:
+                logfile.seek(offset)
+                data = logfile.read(size - offset)
+            finally:
+                logfile.close()
+            # a partly written last line is left for the next update
+            complete = data.rfind("\n") + 1
+            rows = []
+            for line in data[:complete].splitlines():
+                try:
+                    job = parse_exit_record(line)
+                except (KeyError, ValueError):
+                    logger.warning("skipping malformed exit record in %s: %s", path, line)
+                    continue
+                if job is not None:
+                    rows.append([filename] + [job[column] for column in _JOB_COLUMNS] + [_exit_status(job['exit'])])
+            changes.append((filename, rewritten, offset + complete, rows))
+        if not writable:
+            self._keep_unsaved(changes)
+        elif changes:
+            try:
+                with self.db:
+                    for filename, rewritten, offset, rows in changes:
+                        if rewritten or filename in self.stale_files:
+                            self.db.execute("DELETE FROM jobs WHERE file = ?", (filename,))
+                        self.db.executemany("INSERT INTO jobs (file, %s, exit_status) VALUES (%s)" %
+                                (", ".join(_JOB_COLUMNS), ", ".join(["?"] * (len(_JOB_COLUMNS) + 2))), rows)
+                        self.db.execute("INSERT OR REPLACE INTO files (name, offset) VALUES (?, ?)", (filename, offset))
+            except sqlite3.OperationalError, err:
+                logger.warning("history index %s not updated, keeping new records in memory: %s", self.index_file, err)
+                self._keep_unsaved(changes)
+        return sum([len(rows) for _, _, _, rows in changes])
+
+    def _keep_unsaved(self, changes):
+        for filename, rewritten, offset, rows in changes:
+            if rewritten:
+                self.stale_files.add(filename)
+                self.unsaved_rows = [row for row in self.unsaved_rows if row[0] != filename]
+            self.unsaved_rows.extend(rows)
+            self.unsaved_offsets[filename] = offset
+
+    def _where(self, user, queue, project, exit_status, start, end):
+        """The SQL conditions for a query, their arguments, and a test of the unsaved rows."""
+        clauses = []
+        args = []
+        matches = []
+        for column, value in [("user", user), ("queue", queue), ("account", project), ("exit_status", exit_status)]:
+            if value is not None:
+                clauses.append("%s = ?" % column)
+                args.append(value)
+                matches.append((column, value))
+        if start is not None:
+            clauses.append("end_time >= ?")
+            args.append(start)
+        if end is not None:
+            clauses.append("end_time < ?")
+            args.append(end)
+        if self.stale_files:
+            clauses.append("file NOT IN (%s)" % ", ".join(["?"] * len(self.stale_files)))
+            args.extend(sorted(self.stale_files))
+        where = ""
+        if clauses:
+            where = " WHERE " + " AND ".join(clauses)
+        columns = ["file"] + _JOB_COLUMNS + ["exit_status"]
+        def unsaved_match(unsaved):
+            spec = dict(zip(columns, unsaved))
+            return ([spec[column] for column, _ in matches] == [value for _, value in matches] and
+                    (start is None or spec['end_time'] >= start) and (end is None or spec['end_time'] < end))
+        return where, args, unsaved_match
+
+    def count(self, user=None, queue=None, project=None, exit_status=None, start=None, end=None):
+        """Return the number of jobs query would return without a limit."""
+        where, args, unsaved_match = self._where(user, queue, project, exit_status, start, end)
+        (count,) = self.db.execute("SELECT COUNT(*) FROM jobs" + where, args).fetchone()
+        return count + len([unsaved for unsaved in self.unsaved_rows if unsaved_match(unsaved)])
+
+    def query(self, user=None, queue=None, project=None, exit_status=None, start=None, end=None, limit=None):
+        """
+        Return the finalized CobaltJobs that match all of the given criteria,
+        in order of end time.  start and end bound the end time (seconds
+        since the epoch; end is exclusive), and limit keeps only the jobs
+        that ended last.
+        """
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be at least 1")
+        where, args, unsaved_match = self._where(user, queue, project, exit_status, start, end)
+        sql = "SELECT %s FROM jobs%s ORDER BY end_time DESC, jobid DESC" % (", ".join(_JOB_COLUMNS), where)
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        rows = self.db.execute(sql, args).fetchall()
+        if self.unsaved_rows:
+            for unsaved in self.unsaved_rows:
+                if unsaved_match(unsaved):
+                    rows.append(tuple(unsaved[1:-1]))
+            end_time, jobid = _JOB_COLUMNS.index("end_time"), _JOB_COLUMNS.index("jobid")
+            rows.sort(key=lambda row: (row[end_time], row[jobid]), reverse=True)
+            if limit is not None:
+                rows = rows[:limit]
+        jobs = []
+        for row in rows:
+            spec = dict(zip(_JOB_COLUMNS, row))
+            spec['queued_time'] = spec['start_time'] - spec['submit_time']
+            job = CobaltJob(spec)
+            job.finalize()
+            jobs.append(job)
+        jobs.reverse()
+        return jobs
@@ -9,9 +9,14 @@ import random
 import warnings
 import sys
 import socket
+import xmlrpclib
+import weakref
+import copy
+import operator
+from collections import deque
 
 import Cobalt.Util
-from Cobalt.Exceptions import DataCreationError, IncrIDError, DataStateError, DataStateTransitionError
+from Cobalt.Exceptions import DataCreationError, IncrIDError, DataStateError, DataStateTransitionError, QueryError
 
 DB_SECTION = "cdbwriter"
 DB_COMMON_SCHEMA = "COMMON"
@@ -25,6 +30,254 @@ def get_spec_fields (specs):
     return fields
 
 
+class QueryIndex (object):
+
+    """Secondary hash indexes over the items of a Cobalt container.
+
+    The indexed fields are declared by the item class (Data.indexed).  Each
+    field maps a value to the set of items holding that value, so equality
+    specs can be answered without calling match on every item.  Items whose
+    value for a field is not hashable are kept aside and always treated as
+    candidates for that field.
+
+    Methods:
+    add -- index an item
+    remove -- drop an item from the indexes
+    update -- re-index some fields of an item after they changed
+    candidates -- set of items that may match a spec (None if unconstrained)
+    """
+
+    def __init__ (self, fields):
+        self.fields = tuple(fields)
+        self.buckets = dict([(field, {}) for field in self.fields])
+        self.unhashable = dict([(field, set()) for field in self.fields])
+        self.entries = {}
+
+    def __len__ (self):
+        return len(self.entries)
+
+    def __contains__ (self, item):
+        return item in self.entries
+
+    def _insert (self, item, field):
+        """Add item to the buckets of field and return the keys used."""
+        try:
+            keys = item.index_keys(field)
+        except Exception:
+            # hasattr() in Data.match treats any error as a missing field
+            return ()
+        bucket = self.buckets[field]
+        stored = []
+        for key in keys:
+            try:
+                bucket.setdefault(key, set()).add(item)
+            except TypeError:
+                self.unhashable[field].add(item)
+                continue
+            stored.append(key)
+        return tuple(stored)
+
+    def _discard (self, item, field, keys):
+        bucket = self.buckets[field]
+        for key in keys:
+            items = bucket.get(key)
+            if items is not None:
+                items.discard(item)
+                if not items:
+                    del bucket[key]
+        self.unhashable[field].discard(item)
+
+    def add (self, item):
+        """Index all declared fields of item."""
+        if item in self.entries:
+            return
+        self.entries[item] = dict([(field, self._insert(item, field)) for field in self.fields])
+        item._add_index_owner(self)
+
+    def remove (self, item):
+        """Remove item from every index."""
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return
+        for field, keys in entry.iteritems():
+            self._discard(item, field, keys)
+        item._remove_index_owner(self)
+
+    def update (self, item, fields):
+        """Recompute the index entries of fields on item."""
+        entry = self.entries.get(item)
+        if entry is None:
+            return
+        for field in fields:
+            self._discard(item, field, entry[field])
+            entry[field] = self._insert(item, field)
+
+    def candidates (self, spec):
+        """Return a set of items that may match spec.
+
+        None is returned when no indexed field constrains the spec, in which
+        case the caller must scan every item.  The returned items still need
+        to be checked with match for the remaining fields.
+        """
+        matches = []
+        for field, value in spec.iteritems():
+            if field not in self.buckets or value == "*":
+                continue
+            try:
+                items = self.buckets[field].get(value, ())
+            except TypeError:
+                continue
+            if self.unhashable[field]:
+                items = self.unhashable[field].union(items)
+            matches.append(items)
+        if not matches:
+            return None
+        matches.sort(key=len)
+        result = set(matches[0])
+        for items in matches[1:]:
+            if not result:
+                break
+            result.intersection_update(items)
+        return result
+
+    def clear (self):
+        for item in self.entries.keys():
+            item._remove_index_owner(self)
+        self.entries.clear()
+        for field in self.fields:
+            self.buckets[field].clear()
+            self.unhashable[field].clear()
+
+
+def _index_watch_map (cls):
+    """Map attribute names to the indexed fields that depend on them."""
+    watch = cls.__dict__.get('_index_watch')
+    if watch is None:
+        watch = {}
+        for field in cls.indexed:
+            watch.setdefault(field, set()).add(field)
+        for attr, fields in cls.index_triggers.iteritems():
+            for field in fields:
+                if field in cls.indexed:
+                    watch.setdefault(attr, set()).add(field)
+        watch = dict([(attr, tuple(fields)) for attr, fields in watch.iteritems()])
+        type.__setattr__(cls, '_index_watch', watch)
+    return watch
+
+
+class ChangeFeed (object):
+
+    """Generation-stamped record of the items added to, changed in and
+    removed from a Cobalt container.
+
+    Registered items report every attribute they set to the feed, which
+    stamps them with the current generation.  The generation advances each
+    time the feed is read, so a reader that keeps the generation returned
+    by its last read can fetch only what changed since.  Removals are
+    remembered for the last max_removed items; readers further behind than
+    that (or holding a generation from another feed) are handed a complete
+    snapshot instead.
+
+    Methods:
+    add -- start tracking an item
+    remove -- stop tracking an item and record its removal
+    touch -- mark an item as changed
+    reset -- track exactly the given items
+    since -- items changed and keys removed since a generation
+    """
+
+    def __init__ (self, key, generation=0, max_removed=10000):
+        self.key = key
+        self.max_removed = max_removed
+        self.horizon = generation
+        self.generation = generation + 1
+        self.items = {}
+        self.stamps = {}
+        self.changes = {}
+        self.removed = {}
+        self.removals = deque()
+
+    def __len__ (self):
+        return len(self.items)
+
+    def add (self, item):
+        key = getattr(item, self.key)
+        if self.items.get(key) is item:
+            return
+        self.items[key] = item
+        self.removed.pop(key, None)
+        item._add_change_feed(self)
+        self.touch(item)
+
+    def remove (self, item):
+        key = getattr(item, self.key)
+        if self.items.get(key) is not item:
+            return
+        del self.items[key]
+        self._unstamp(key)
+        item._remove_change_feed(self)
+        self.removed[key] = self.generation
+        self.removals.append((self.generation, key))
+        while len(self.removals) > self.max_removed:
+            generation, key = self.removals.popleft()
+            if self.removed.get(key) == generation:
+                del self.removed[key]
+            self.horizon = max(self.horizon, generation)
+
+    def _unstamp (self, key):
+        stamp = self.stamps.pop(key, None)
+        if stamp is not None:
+            keys = self.changes[stamp]
+            keys.discard(key)
+            if not keys:
+                del self.changes[stamp]
+
+    def touch (self, item):
+        key = getattr(item, self.key)
+        if self.stamps.get(key) == self.generation:
+            return
+        self._unstamp(key)
+        self.stamps[key] = self.generation
+        self.changes.setdefault(self.generation, set()).add(key)
+
+    def reset (self, items):
+        current = dict([(getattr(item, self.key), item) for item in items])
+        for key, item in self.items.items():
+            if current.get(key) is not item:
+                self.remove(item)
+        for item in current.itervalues():
+            self.add(item)
+
+    def since (self, generation):
+        """Return (generation, complete, items, removed_keys) for the changes since generation.
+
+        The returned generation is the one to pass on the next call.  If
+        complete is True, items holds every tracked item and the reader
+        should drop anything else it holds.
+        """
+        if generation <= self.horizon or generation > self.generation:
+            complete = True
+            items = self.items.values()
+            removed = []
+        else:
+            complete = False
+            if self.generation - generation < len(self.changes):
+                stamps = xrange(generation, self.generation + 1)
+            else:
+                stamps = [stamp for stamp in self.changes if stamp >= generation]
+            keys = set()
+            for stamp in stamps:
+                keys.update(self.changes.get(stamp, ()))
+            items = [self.items[key] for key in keys]
+            removed = []
+            for stamp, key in reversed(self.removals):
+                if stamp < generation:
+                    break
+                if self.removed.get(key) == stamp:
+                    removed.append(key)
+        self.generation += 1
+        return self.generation, complete, items, removed
+
 
 class IncrID (object):
     
@@ -172,6 +425,9 @@ class Data (object):
     inherent -- a list of fields that cannot be included in the spec
     required -- a list of fields required in the spec
     explicit -- fields that are only returned when explicitly listed in the spec
+    indexed -- fields that containers index to answer equality specs
+    index_triggers -- maps attribute names to indexed fields computed from
+                      them (e.g. properties), so the index follows changes
 
     Attributes:
     tag -- Misc. label.
@@ -186,6 +442,8 @@ class Data (object):
     inherent = []
     required = []
     explicit = []
+    indexed = []
+    index_triggers = {}
 
     def __init__ (self, spec):
         
@@ -205,6 +463,71 @@ class Data (object):
             raise DataCreationError, "Specified inherent field %s" \
                   % (":".join(inherent))
 
+    def __setattr__ (self, name, value):
+        object.__setattr__(self, name, value)
+        owners = self.__dict__.get('_index_owners')
+        if owners:
+            fields = _index_watch_map(self.__class__).get(name)
+            if fields:
+                for ref in owners[:]:
+                    index = ref()
+                    if index is None:
+                        owners.remove(ref)
+                    else:
+                        index.update(self, fields)
+        feeds = self.__dict__.get('_change_feeds')
+        if feeds:
+            for ref in feeds[:]:
+                feed = ref()
+                if feed is None:
+                    feeds.remove(ref)
+                else:
+                    feed.touch(self)
+
+    def __getstate__ (self):
+        state = dict(self.__dict__)
+        state.pop('_index_owners', None)
+        state.pop('_change_feeds', None)
+        return state
+
+    def _add_index_owner (self, index):
+        """Register a QueryIndex to be told about changes to indexed fields."""
+        owners = self.__dict__.get('_index_owners')
+        if owners is None:
+            owners = []
+            self.__dict__['_index_owners'] = owners
+        owners.append(weakref.ref(index))
+
+    def _remove_index_owner (self, index):
+        owners = self.__dict__.get('_index_owners')
+        if owners:
+            for ref in owners[:]:
+                if ref() is index or ref() is None:
+                    owners.remove(ref)
+
+    def _add_change_feed (self, feed):
+        """Register a ChangeFeed to be told about every attribute change."""
+        feeds = self.__dict__.get('_change_feeds')
+        if feeds is None:
+            feeds = []
+            self.__dict__['_change_feeds'] = feeds
+        feeds.append(weakref.ref(feed))
+
+    def _remove_change_feed (self, feed):
+        feeds = self.__dict__.get('_change_feeds')
+        if feeds:
+            for ref in feeds[:]:
+                if ref() is feed or ref() is None:
+                    feeds.remove(ref)
+
+    def index_keys (self, field):
+        """Return the values under which the entity is indexed for field.
+
+        An entity matches a spec value for field if the value is one of the
+        keys returned here.
+        """
+        return (getattr(self, field),)
+
     def match (self, spec):
         """True if every field in spec == the same field on the entity.
         
@@ -334,6 +657,192 @@ Set -- set state to new value, ensuring it is a proper state and respects the st
 """)
 
 
+def match_items (items, index, specs):
+    """Return the set of items matching any of specs.
+
+    Arguments:
+    items -- callable returning an iterator over every item, used for specs
+             that must be answered by a scan
+    index -- a QueryIndex over the items, or None
+    specs -- a list of dictionaries specifying the objects to match
+    """
+    matched_items = set()
+    for spec in specs:
+        candidates = None
+        if index is not None:
+            candidates = index.candidates(spec)
+        if candidates is None:
+            candidates = items()
+        for item in candidates:
+            if item not in matched_items and item.match(spec):
+                matched_items.add(item)
+    return matched_items
+
+
+def _prefix (value, prefix):
+    return isinstance(value, basestring) and value.startswith(prefix)
+
+QUERY_OPERATORS = {
+    '==':operator.eq,
+    '!=':operator.ne,
+    '<':operator.lt,
+    '<=':operator.le,
+    '>':operator.gt,
+    '>=':operator.ge,
+    'in':lambda value, values: value in values,
+    'not in':lambda value, values: value not in values,
+    'prefix':_prefix,
+}
+
+def filter_items (items, where):
+    """Return the items satisfying every predicate in where.
+
+    Arguments:
+    items -- items to filter
+    where -- list of [field, operator, value] predicates, with operator one
+             of QUERY_OPERATORS.  The value of an 'in' or 'not in'
+             predicate must be a list.  Items without the field never
+             satisfy a predicate on it.
+    """
+    predicates = []
+    for predicate in where or []:
+        try:
+            field, op, value = predicate
+            predicates.append((field, QUERY_OPERATORS[op], value))
+        except (TypeError, ValueError, KeyError):
+            raise QueryError("bad predicate %r" % (predicate,))
+        # a string would otherwise be searched for substrings, and other values fail while filtering
+        if op in ('in', 'not in') and not isinstance(value, (list, tuple, set, frozenset)):
+            raise QueryError("'%s' needs a list of values: %r" % (op, predicate))
+    if not predicates:
+        return list(items)
+    missing = object()
+    results = []
+    for item in items:
+        for field, test, value in predicates:
+            if field not in item.fields:
+                break
+            item_value = getattr(item, field, missing)
+            if item_value is missing or not test(item_value, value):
+                break
+        else:
+            results.append(item)
+    return results
+
+def query_items (items, options):
+    """Filter, sort and page items as a query's options ask.
+
+    Arguments:
+    items -- items matched by the query's specs
+    options -- dictionary that may hold
+               where -- predicates, as for filter_items
+               sort -- list of fields to sort on, each prefixed with '-'
+                       to sort in descending order
+               offset -- number of items to skip
+               limit -- maximum number of items to return
+    """
+    items = filter_items(items, options.get('where'))
+    sort = options.get('sort') or []
+    if isinstance(sort, basestring):
+        sort = [sort]
+    # stable sorts from the last key to the first give a multi-key sort with per-key direction
+    for key in reversed(sort):
+        if not isinstance(key, basestring) or not key.lstrip('-'):
+            raise QueryError("bad sort field %r" % (key,))
+        field = key.lstrip('-')
+        items.sort(key=lambda item: getattr(item, field, None), reverse=key.startswith('-'))
+    try:
+        offset = int(options.get('offset') or 0)
+        limit = options.get('limit')
+        if limit is not None:
+            limit = int(limit)
+    except (TypeError, ValueError):
+        raise QueryError("bad offset or limit")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise QueryError("offset and limit may not be negative")
+    if limit is None:
+        return items[offset:]
+    return items[offset:offset + limit]
+
+
+class ItemSnapshot (object):
+
+    """Frozen copy of the fields of a Data item.
+
+    Records answer match, to_rx and index_keys with the methods of the class
+    they were taken from, so queries over a snapshot behave like queries
+    over the live items.  Use snapshot_class to get the record class for an
+    item class.
+    """
+
+    fields = []
+    explicit = []
+
+    def __init__ (self, item):
+        for field in self.fields:
+            try:
+                value = getattr(item, field)
+            except AttributeError:
+                continue
+            if isinstance(value, (list, dict, set)):
+                # the live item may change these in place after the snapshot
+                value = copy.copy(value)
+            self.__dict__[field] = value
+
+    def _add_index_owner (self, index):
+        pass
+
+    def _remove_index_owner (self, index):
+        pass
+
+
+_snapshot_classes = {}
+
+def snapshot_class (cls):
+    """Return the ItemSnapshot class for records of items of class cls."""
+    snapshot_cls = _snapshot_classes.get(cls)
+    if snapshot_cls is None:
+        snapshot_cls = type(cls.__name__ + 'Snapshot', (ItemSnapshot,), {
+            'fields':list(cls.fields),
+            'explicit':list(cls.explicit),
+            'match':cls.match.im_func,
+            'to_rx':cls.to_rx.im_func,
+            'index_keys':cls.index_keys.im_func})
+        _snapshot_classes[cls] = snapshot_cls
+    return snapshot_cls
+
+
+class DataSnapshot (object):
+
+    """Immutable, time-stamped copy of a set of Data items.
+
+    Queries against a snapshot never touch the live items, so they may be
+    answered without holding the lock that protects them.
+
+    Methods:
+    age -- seconds since the snapshot was taken
+    q_get -- records matching any of a list of specs
+    """
+
+    def __init__ (self, items, indexed=()):
+        self.time = time.time()
+        self.records = [snapshot_class(item.__class__)(item) for item in items]
+        self.index = None
+        if indexed:
+            self.index = QueryIndex(indexed)
+            for record in self.records:
+                self.index.add(record)
+
+    def __len__ (self):
+        return len(self.records)
+
+    def age (self):
+        return time.time() - self.time
+
+    def q_get (self, specs):
+        return list(match_items(lambda: iter(self.records), self.index, specs))
+
+
 class DataList (list):
     
     """A Python list with the Cobalt query interface.
@@ -345,9 +854,94 @@ class DataList (list):
     q_add -- construct new items in the list
     q_get -- retrieve items from the list
     q_del -- remove items from the list
+
+    If item_cls declares indexed fields, a QueryIndex is built on the first
+    query and kept up to date as items are added, removed or modified.
     """
     
     item_cls = Data
+
+    def __getstate__ (self):
+        state = dict(self.__dict__)
+        state.pop('_query_index', None)
+        return state
+
+    def _get_query_index (self):
+        """Return the QueryIndex for the list, building it if needed."""
+        if not self.item_cls.indexed:
+            return None
+        index = self.__dict__.get('_query_index')
+        if index is None:
+            index = QueryIndex(self.item_cls.indexed)
+            for item in list.__iter__(self):
+                index.add(item)
+            self.__dict__['_query_index'] = index
+        return index
+
+    def _drop_query_index (self):
+        index = self.__dict__.pop('_query_index', None)
+        if index is not None:
+            index.clear()
+
+    def _items_added (self, items):
+        """Hook run after items are added to the list."""
+        index = self.__dict__.get('_query_index')
+        if index is not None:
+            for item in items:
+                index.add(item)
+
+    def _items_removed (self, items):
+        """Hook run after items are removed from the list."""
+        index = self.__dict__.get('_query_index')
+        if index is not None:
+            for item in items:
+                index.remove(item)
+
+    def _items_replaced (self):
+        """Hook run after an arbitrary (slice or positional) change to the list."""
+        self._drop_query_index()
+
+    def append (self, item):
+        list.append(self, item)
+        self._items_added([item])
+
+    def extend (self, items):
+        items = list(items)
+        list.extend(self, items)
+        self._items_added(items)
+
+    def __iadd__ (self, items):
+        self.extend(items)
+        return self
+
+    def insert (self, position, item):
+        list.insert(self, position, item)
+        self._items_added([item])
+
+    def remove (self, item):
+        list.remove(self, item)
+        self._items_removed([item])
+
+    def pop (self, *args):
+        item = list.pop(self, *args)
+        self._items_removed([item])
+        return item
+
+    def __setitem__ (self, position, value):
+        list.__setitem__(self, position, value)
+        self._items_replaced()
+
+    def __delitem__ (self, position):
+        list.__delitem__(self, position)
+        self._items_replaced()
+
+    def __setslice__ (self, start, stop, values):
+        list.__setslice__(self, start, stop, values)
+        self._items_replaced()
+
+    def __delslice__ (self, start, stop):
+        list.__delslice__(self, start, stop)
+        self._items_replaced()
     
     def q_add (self, specs, callback=None, cargs={}):
         """Construct new items of type self.item_cls in the list.
@@ -377,12 +971,7 @@ class DataList (list):
         callback -- applied to each matched item (optional)
         cargs -- a tuple of arguments to pass to callback after the item
         """
-        matched_items = set()
-        for item in self:
-            for spec in specs:
-                if item.match(spec):
-                    matched_items.add(item)
-                    break
+        matched_items = match_items(lambda: list.__iter__(self), self._get_query_index(), specs)
         if callback:
             for item in matched_items:
                 callback(item, cargs)
@@ -414,10 +1003,80 @@ class DataDict (dict):
     q_add -- construct new items in the dict
     q_get -- retrieve items from the dict
     q_del -- remove items from the dict
+
+    If item_cls declares indexed fields, a QueryIndex is built on the first
+    query and kept up to date as items are added, removed or modified.
     """
     
     item_cls = Data
     key = None
+
+    def __getstate__ (self):
+        state = dict(self.__dict__)
+        state.pop('_query_index', None)
+        return state
+
+    def _get_query_index (self):
+        """Return the QueryIndex for the dict, building it if needed."""
+        if not self.item_cls.indexed:
+            return None
+        index = self.__dict__.get('_query_index')
+        if index is None:
+            index = QueryIndex(self.item_cls.indexed)
+            for item in dict.itervalues(self):
+                index.add(item)
+            self.__dict__['_query_index'] = index
+        return index
+
+    def _drop_query_index (self):
+        index = self.__dict__.pop('_query_index', None)
+        if index is not None:
+            index.clear()
+
+    def __setitem__ (self, key, item):
+        index = self.__dict__.get('_query_index')
+        if index is not None and key in self:
+            index.remove(dict.__getitem__(self, key))
+        dict.__setitem__(self, key, item)
+        if index is not None:
+            index.add(item)
+
+    def __delitem__ (self, key):
+        item = dict.__getitem__(self, key)
+        dict.__delitem__(self, key)
+        index = self.__dict__.get('_query_index')
+        if index is not None:
+            index.remove(item)
+
+    def update (self, *args, **kwargs):
+        if self.__dict__.get('_query_index') is None:
+            dict.update(self, *args, **kwargs)
+            return
+        for key, item in dict(*args, **kwargs).iteritems():
+            self[key] = item
+
+    def setdefault (self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop (self, key, *args):
+        if key not in self:
+            return dict.pop(self, key, *args)
+        item = dict.__getitem__(self, key)
+        del self[key]
+        return item
+
+    def popitem (self):
+        key, item = dict.popitem(self)
+        index = self.__dict__.get('_query_index')
+        if index is not None:
+            index.remove(item)
+        return key, item
+
+    def clear (self):
+        dict.clear(self)
+        self._drop_query_index()
     
     def q_add (self, specs, callback=None, cargs={}):
         """Construct new items of type self.item_cls in the dict.
@@ -450,12 +1109,7 @@ class DataDict (dict):
         callback -- applied to each matched item (optional)
         cargs -- a tuple of arguments to pass to callback after the item
         """
-        matched_items = set()
-        for item in self.itervalues():
-            for spec in specs:
-                if item.match(spec):
-                    matched_items.add(item)
-                    break
+        matched_items = match_items(lambda: dict.itervalues(self), self._get_query_index(), specs)
         if callback:
             for item in matched_items:
                 callback(item, cargs)
@@ -495,33 +1149,76 @@ class ForeignData (Data):
 
 
 class ForeignDataDict(DataDict):
+    """Local cache of items owned by another component.
+
+    Sync refreshes the cache through __function__, which returns every
+    item.  If __delta_function__ is set it is tried first: it is called
+    with the generation returned by the previous call and returns only
+    what changed since (see ChangeFeed), so a pass costs in proportion to
+    the churn rather than to the number of items.  __delta_method__ names
+    the remote method; only a fault saying the other component has no such
+    method falls back to __function__.
+    """
     __oserror__ = Cobalt.Util.FailureMode("ForeignData connection")
     __function__ = lambda x:[]
+    __delta_function__ = None
+    __delta_method__ = None
     __procedure__ = None
     __fields__ = []
+    generation = 0
     
     def Sync(self):
         spec = dict([(field, "*") for field in self.__fields__])
+        if self.__delta_function__ is not None:
+            try:
+                delta = self.__delta_function__(self.generation, [spec])
+            except xmlrpclib.Fault as fault:
+                if fault.faultString != self.__delta_method__: # NoExposedMethod
+                    self.__oserror__.Fail()
+                    return
+                # the other component does not provide the delta call; fall back to a full fetch
+                self.generation = 0
+            except:
+                self.__oserror__.Fail()
+                return
+            else:
+                self.__oserror__.Pass()
+                self.SyncDelta(delta)
+                return
         try:
             foreign_data = self.__function__([spec])
         except:
             self.__oserror__.Fail()
             return
         self.__oserror__.Pass()
-        
-        local_ids = [getattr(item, self.key) for item in self.itervalues()]
-        foreign_ids = [item_dict[self.key] for item_dict in foreign_data]
-        
+        self._sync_items(foreign_data, [], True)
+
+    def SyncDelta(self, delta):
+        """Apply a change set returned by __delta_function__.
+
+        Arguments:
+        delta -- dictionary with the new 'generation', the changed 'items',
+                 the 'deleted' item keys, and 'complete', which is True if
+                 the items are the whole set.
+        """
+        self._sync_items(delta['items'], delta['deleted'], delta['complete'])
+        self.generation = delta['generation']
+
+    def _sync_items(self, foreign_data, deleted, complete):
+        foreign_ids = set([item_dict[self.key] for item_dict in foreign_data])
+
         # sync removed items
-        for item in local_ids:
-            if item not in foreign_ids:
-                del self[item]
-        
+        if complete:
+            deleted = [item_id for item_id in self.keys() if item_id not in foreign_ids]
+        for item_id in deleted:
+            if item_id in self:
+                del self[item_id]
+
         # sync new items
         for item_dict in foreign_data:
-            if item_dict[self.key] not in local_ids:
+            if item_dict[self.key] not in self:
                 self.q_add([item_dict])
-        
+
         # sync all items
         for item_dict in foreign_data:
             item_id = item_dict[self.key]
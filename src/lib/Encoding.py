@@ -0,0 +1,176 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+"""Alternate wire encodings for component RPC.
+
+XML-RPC is always understood.  Clients list the other encodings they can
+read in the Accept header of each request, and servers that know one of
+them answer with it, naming the encoding in the Content-Type of the
+response.  Servers also accept request bodies in any of these encodings,
+selected by Content-Type.  Large bodies may additionally be gzip compressed
+(Content-Encoding: gzip) when the other side has said it accepts that.
+
+Classes:
+JSONCodec -- JSON encoding of calls and results
+MsgpackCodec -- msgpack encoding of calls and results (needs msgpack)
+
+Functions:
+get_codec -- the codec for a content type
+choose_codec -- the codec to answer a request with, from its Accept header
+parse_encodings -- the available codecs named in a configuration value
+compress, decompress -- gzip a body and back
+"""
+
+__revision__ = '$Revision$'
+
+import json
+import xmlrpclib
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+XMLRPC_CONTENT_TYPE = 'text/xml'
+DEFAULT_ENCODINGS = 'msgpack json'
+DEFAULT_COMPRESS_THRESHOLD = 65536
+
+
+def _ascii(value):
+    '''Return unicode value as a str if it is plain ASCII, as xmlrpclib does.'''
+    try:
+        return value.encode('ascii')
+    except UnicodeError:
+        return value
+
+def _ascii_list(values):
+    return [_ascii(value) if value.__class__ is unicode else
+            (_ascii_list(value) if value.__class__ is list else value) for value in values]
+
+
+class JSONCodec(object):
+    '''JSON encoding.  Requests are {"method": name, "params": [...]} and
+    responses {"result": value} or {"fault": {"faultCode": code,
+    "faultString": string}}.  Strings are decoded to str where they are ASCII,
+    so results look like those from xmlrpclib.
+
+    '''
+    name = 'json'
+    content_type = 'application/json'
+
+    def __init__(self):
+        self._keys = {}
+
+    def _object_hook(self, pairs):
+        keys = self._keys
+        result = {}
+        for key, value in pairs:
+            if value.__class__ is unicode:
+                value = _ascii(value)
+            elif value.__class__ is list:
+                value = _ascii_list(value)
+            str_key = keys.get(key)
+            if str_key is None:
+                # dictionary keys repeat from one record to the next
+                if len(keys) > 10000:
+                    keys.clear()
+                str_key = keys[key] = _ascii(key)
+            result[str_key] = value
+        return result
+
+    def _loads(self, data):
+        value = json.loads(data, object_pairs_hook=self._object_hook)
+        if value.__class__ is unicode:
+            return _ascii(value)
+        if value.__class__ is list:
+            return _ascii_list(value)
+        return value
+
+    def dumps_request(self, params, method):
+        return json.dumps({'method':method, 'params':list(params)})
+
+    def loads_request(self, data):
+        request = self._loads(data)
+        return tuple(request['params']), request['method']
+
+    def dumps_response(self, result):
+        return json.dumps({'result':result})
+
+    def dumps_fault(self, fault):
+        return json.dumps({'fault':{'faultCode':fault.faultCode, 'faultString':fault.faultString}})
+
+    def loads_response(self, data):
+        response = self._loads(data)
+        if 'fault' in response:
+            raise xmlrpclib.Fault(response['fault']['faultCode'], response['fault']['faultString'])
+        return response['result']
+
+
+class MsgpackCodec(JSONCodec):
+    '''msgpack encoding of the same messages as JSONCodec.  Strings are sent
+    as raw bytes and decoded to str.
+
+    '''
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+
+    def _dumps(self, value):
+        return msgpack.packb(value, use_bin_type=False)
+
+    def _loads(self, data):
+        return msgpack.unpackb(data, raw=True)
+
+    def dumps_request(self, params, method):
+        return self._dumps({'method':method, 'params':list(params)})
+
+    def dumps_response(self, result):
+        return self._dumps({'result':result})
+
+    def dumps_fault(self, fault):
+        return self._dumps({'fault':{'faultCode':fault.faultCode, 'faultString':fault.faultString}})
+
+
+codecs = {}
+for _codec in [JSONCodec(), MsgpackCodec()]:
+    if _codec.name != 'msgpack' or msgpack is not None:
+        codecs[_codec.name] = _codec
+_codecs_by_type = dict([(codec.content_type, codec) for codec in codecs.itervalues()])
+
+def parse_encodings(value):
+    '''Return the available codecs named in value (e.g. "msgpack json"), in
+    order.  Unknown names and codecs whose modules are missing are skipped.
+
+    '''
+    return [codecs[name] for name in value.replace(',', ' ').split() if name in codecs]
+
+def _media_types(header):
+    return [item.split(';')[0].strip().lower() for item in (header or '').split(',')]
+
+def get_codec(content_type):
+    '''Return the codec for content_type, or None for XML-RPC and anything unknown.'''
+    return _codecs_by_type.get(_media_types(content_type)[0])
+
+def choose_codec(accept, enabled):
+    '''Return the first codec in enabled listed in the Accept header accept, or None to answer with XML-RPC.'''
+    accepted = _media_types(accept)
+    for media_type in accepted:
+        if media_type == XMLRPC_CONTENT_TYPE:
+            break
+        codec = _codecs_by_type.get(media_type)
+        if codec in enabled:
+            return codec
+    return None
+
+def accept_header(enabled):
+    '''The Accept header a client sends to ask for one of the enabled codecs.'''
+    return ', '.join([codec.content_type for codec in enabled] + [XMLRPC_CONTENT_TYPE])
+
+def accepts_gzip(accept_encoding):
+    return 'gzip' in _media_types(accept_encoding)
+
+def compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
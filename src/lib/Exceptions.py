@@ -175,3 +175,8 @@ class UnschedulableNodeError(RuntimeError):
     '''Raise if an action isn't valid on a node marked "unscheduled"'''
     log = True
     fault_code = fault_code_counter.next()
+
+class QueryError(ValueError):
+    '''Raised for a malformed predicate, sort or paging option in a query.'''
+    log = False
+    fault_code = fault_code_counter.next()
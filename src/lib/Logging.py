@@ -23,6 +23,8 @@ import threading
 import time
 import Queue
 import traceback
+import xmlrpclib
+from collections import deque
 
 import Cobalt.JSONEncoders
 import Cobalt.Proxy
@@ -31,6 +33,8 @@ from Cobalt.Exceptions import ComponentLookupError
 
 
 SYSLOG_LEVEL_DEFAULT = "DEBUG"
+DB_BATCH_SIZE = 500 #messages per add_messages call to cdbwriter
+DB_RETRY_INTERVAL = 10 #seconds between attempts to reach cdbwriter
 CONSOLE_LEVEL_DEFAULT = "INFO"
 
 LOGGING_LEVELS = {
@@ -298,29 +302,37 @@ def log_to_syslog (logger_name, level=SYSLOG_LEVEL, format='%(name)s[%(process)d
 # Log-to-database utilities are below.
 class dbwriter(object):
 
-    """I am intending this to involve a singleton IO thread going to the
-    database"""
+    """Queue messages for the database writer component (cdbwriter).
 
-    def __init__(self, logger, queue=None, overflow_filename=None, max_queued=None):
+    Messages are encoded and queued by log_to_db and delivered in batches
+    through cdbwriter's add_messages call by a background sender thread, so
+    a component logging a burst of messages never waits on the writer.
+    Should the writer be unreachable, messages are held, spilling to the
+    overflow file past max_queued messages, and resent once it is back.
+
+    """
+
+    def __init__(self, logger, queue=None, overflow_filename=None, max_queued=None, batch_size=DB_BATCH_SIZE):
 
         self.logger = logger
         self.enabled = False
         self.cdbwriter_alive = False
         self.cdbwriter = None
-        self.flushing = False
+        self.batch_size = batch_size
+        self.batch_supported = True #cdbwriter has add_messages
+        self.retry_interval = DB_RETRY_INTERVAL
 
         self.overflow = False
         self.overflow_filename = overflow_filename
         self.overflow_file = None
-        self.clearing_overflow = False
         self.max_queued = max_queued
 
-        if queue:
-            self.msg_queue = queue
-        else:
-            self.msg_queue = []
-
-
+        self.msg_queue = deque(queue or [])
+        self._sending = [] # the batch flush_queue is delivering
+        self._queue_cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._sender = None
+        self._closing = False
 
     def connect(self):
         '''Establish connection.  Should attempt succeed, mark communication as alive to prevent needless connection retries.
@@ -336,107 +348,167 @@ class dbwriter(object):
         try:
             self.cdbwriter = Cobalt.Proxy.ComponentProxy('cdbwriter', defer=False)
             self.cdbwriter_alive = True
+            self.batch_supported = True
         except:
             self.logger.warning("Unable to connect to cdbwriter")
             self.logger.warning(traceback.format_exc())
 
     def log_to_db(self, user, event, msg_type, obj, timestamp=None):
-        '''If database logging is enabled, send messages to the database writer component.
-        Message delivery failure is assumed to be a connection failure, buffer until we get a good connection.
+        '''If database logging is enabled, queue a message for the database writer component.
+        Delivery happens in the sender thread.
 
         '''
         if not self.enabled:
             return
 
-        #if a queue gets too large, save messages to disk for later writiing.
-        if ((self.max_queued != None) and 
-            (len(self.msg_queue) >= self.max_queued) and 
-            not self.clearing_overflow):
-            self.overflow = True
-            self.open_overflow('a')
-            if self.overflow_file == None:
-                #we have too many messages and cannot write to disk
-                #This message has to be dropped.
-                #Of course, a lot of somethings would have to go critically
-                #wrong to need this.  The logfile message may fail as well.
-
-                try:
-                    message = Cobalt.JSONEncoders.ReportObject(user, event, msg_type, obj, timestamp).encode()
-                except Exception as e:
-                    self.logger.error("Error encoding message to send to cdbwriter.")
-                    self.logger.error(traceback.format_exc())
-                else:
-                    #done just about all I can.  At this point, I don't have much choice (out of disk, for instance).
-                    self.logger.critical("MESSAGE DROPPED: %s" % message)
-            else:
-                self.queue_to_overflow()
-                self.close_overflow()
-
-        #end queue overflow handling
-
         try:
-            message = Cobalt.JSONEncoders.ReportObject(user, event, 
+            message = Cobalt.JSONEncoders.ReportObject(user, event,
                                                            msg_type, obj, timestamp).encode()
         except Exception as e:
             self.logger.error("Error encoding message to send to cdbwriter.")
             self.logger.debug(traceback.format_exc())
+            return
 
-        else:
+        with self._queue_cond:
             self.msg_queue.append(message)
+        self.start_sender()
 
+    def start_sender(self):
+        '''Wake the sender thread, starting it if it isn't running yet.'''
+        if not self.enabled:
+            return
+        with self._queue_cond:
+            if self._sender is None and not self._closing:
+                self._sender = threading.Thread(target=self._run_sender, name='dbwriter')
+                self._sender.daemon = True
+                self._sender.start()
+            self._queue_cond.notify()
+
+    def _run_sender(self):
+        '''Deliver queued messages until closed.  While cdbwriter is down,
+        retry every retry_interval seconds, spilling to the overflow file as
+        messages arrive.'''
+        while True:
+            with self._queue_cond:
+                while not (self.msg_queue or self._closing):
+                    self._queue_cond.wait()
+                if self._closing:
+                    break
+            self.flush_queue()
+            if not self.cdbwriter_alive:
+                retry_time = time.time() + self.retry_interval
+                with self._queue_cond:
+                    while not self._closing and time.time() < retry_time:
+                        self._queue_cond.wait(retry_time - time.time())
+                        self._check_overflow()
+
+    def queued_messages(self):
+        '''Return a list of the messages not yet delivered, including the batch
+        being sent, for saving state.'''
+        with self._queue_cond:
+            return self._sending + list(self.msg_queue)
+
+    def restore_messages(self, messages):
+        '''Queue undelivered messages loaded from saved state.'''
+        with self._queue_cond:
+            self.msg_queue.extendleft(reversed(messages))
+
+    def close(self):
+        '''Stop the sender thread and make a last attempt to deliver whatever
+        is still queued.'''
+        with self._queue_cond:
+            self._closing = True
+            self._queue_cond.notify()
+            sender = self._sender
+        if sender is not None:
+            sender.join()
         self.flush_queue()
 
     def flush_queue(self):
-        """send a series of messages to the writer component."""
-        if not (self.enabled or self.flushing or self.clearing_overflow):
+        """send the queued messages to the writer component in batches."""
+        if not self.enabled:
             return
 
-        self.flushing = True
-        if not self.cdbwriter_alive:
-            self.connect()
-
-        #we're connected and have an "overflow file", we should flush 
-        #that first.
-        if self.overflow and self.cdbwriter_alive:
-            self.clearing_overflow = True
-            #Shove out as many to the writer component as we can.  Save the rest.
-            self.open_overflow('r')
-            if self.overflow_file:
-                #we prepend to the message queue.
-                overflow_queue = [line for line in self.overflow_file]
-                overflow_queue.extend(self.msg_queue)
-                self.msg_queue = overflow_queue
-                self.close_overflow()
-                self.del_overflow() #Now that it is back in memory, we dump if needed.
-                self.overflow = False
-
-        #drain the queue, if we have one.
-        while self.msg_queue and self.cdbwriter_alive:
-            msg = self.msg_queue[0]
-            try:
-                self.cdbwriter.add_message(msg)
-            except:
-                self.logger.error("dbwriter.flush_queue: Unable to contact "\
-                        "database writer when sending message.")
-                self.cdbwriter_alive = False
-
-                #if the cdbwriter falls over while dealing with overflow.
-                if ((self.max_queued != None) and
-                    (len(self.msg_queue) >= self.max_queued)):
-                    self.overflow = True
-                    self.open_overflow('a')
-                    if self.overflow_file != None:
-                        self.queue_to_overflow()
-                        self.close_overflow()
-                break
-            else:
+        with self._flush_lock:
+            if not self.cdbwriter_alive:
+                self.connect()
+            if not self.cdbwriter_alive:
+                self._check_overflow()
+                return
+
+            #we're connected and have an "overflow file", we should flush
+            #that first.
+            if self.overflow:
+                self.open_overflow('r')
+                if self.overflow_file:
+                    #we prepend to the message queue.
+                    overflow_queue = [line for line in self.overflow_file]
+                    with self._queue_cond:
+                        self.msg_queue.extendleft(reversed(overflow_queue))
+                    self.close_overflow()
+                    self.del_overflow() #Now that it is back in memory, we dump if needed.
+                    self.overflow = False
+
+            #drain the queue, if we have one.
+            while self.cdbwriter_alive:
+                with self._queue_cond:
+                    batch = [self.msg_queue.popleft() for _ in xrange(min(self.batch_size, len(self.msg_queue)))]
+                    self._sending = batch
+                if not batch:
+                    break
+                sent = self._send_batch(batch)
+                with self._queue_cond:
+                    self._sending = []
+                    if sent < len(batch):
+                        self.msg_queue.extendleft(reversed(batch[sent:]))
+                if sent < len(batch):
+                    self.logger.error("dbwriter.flush_queue: Unable to contact "\
+                            "database writer when sending message.")
+                    self.cdbwriter_alive = False
+                    #if the cdbwriter falls over while dealing with overflow.
+                    self._check_overflow()
+
+    def _send_batch(self, batch):
+        '''Send a batch of messages.  Fall back to one message per call for a
+        cdbwriter without add_messages.  Return how many were delivered.'''
+        sent = 0
+        try:
+            if self.batch_supported:
                 try:
-                    self.msg_queue.pop(0)
-                except IndexError:
-                    self.logger.error("dbwriter.flush_queue: Queue already empty.")
+                    self.cdbwriter.add_messages(batch)
+                except xmlrpclib.Fault as fault:
+                    if fault.faultString != 'add_messages': # NoExposedMethod
+                        # any other fault may come after part of the batch was queued; resend it later
+                        # as a whole, like a lost connection, rather than again message by message
+                        raise
+                    self.logger.warning("cdbwriter does not accept add_messages.  Sending messages singly.")
+                    self.batch_supported = False
+                else:
+                    return len(batch)
+            for msg in batch:
+                self.cdbwriter.add_message(msg)
+                sent += 1
+        except:
+            self.logger.debug(traceback.format_exc())
+        return sent
 
-        self.clearing_overflow = False
-        self.flushing = False
+    def _check_overflow(self):
+        '''if a queue gets too large, save messages to disk for later writing.'''
+        with self._queue_cond:
+            if self.max_queued is None or len(self.msg_queue) < self.max_queued:
+                return
+            self.overflow = True
+            self.open_overflow('a')
+            if self.overflow_file == None:
+                #we have too many messages and cannot write to disk
+                #These messages have to be dropped.
+                #Of course, a lot of somethings would have to go critically
+                #wrong to need this.  The logfile message may fail as well.
+                while len(self.msg_queue) >= self.max_queued:
+                    self.logger.critical("MESSAGE DROPPED: %s" % self.msg_queue.popleft())
+            else:
+                self.queue_to_overflow()
+                self.close_overflow()
 
     def open_overflow(self, mode):
         try:
@@ -454,21 +526,15 @@ class dbwriter(object):
 
     def queue_to_overflow(self):
         elements_written = 0
-        if len(self.msg_queue) == 0:
-            return
-
         while self.msg_queue:
-            msg = self.msg_queue.pop(0)
+            msg = self.msg_queue[0]
             try:
-                self.overflow_file.write(msg+'\n')
-                elements_written += 1
+                self.overflow_file.write(msg.rstrip('\n')+'\n')
             except IOError:
                 self.logger.error('Could only partially empty queue, %d messages written' % \
                              elements_written)
-                self.msg_queue.insert(0, msg)
-
-        if elements_written > 0:
-            del self.msg_queue[0:elements_written-1] #empty the queue of what we have written
+                break
+            self.msg_queue.popleft()
+            elements_written += 1
 
         return len(self.msg_queue)
-
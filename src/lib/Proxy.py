@@ -7,6 +7,13 @@ ComponentProxy -- an RPC client proxy to Cobalt components
 
 Functions:
 load_config -- read configuration files
+
+Connections to components are HTTP/1.1 keep-alive connections shared through
+a pool, and component locations from the service-location component are
+cached for [communication] locate_cache_ttl seconds, so repeated calls to a
+component do not pay for a service lookup and a TCP and SSL handshake each.
+Responses are requested in the [communication] encodings, and large bodies
+are gzipped, as described in Cobalt.Encoding.
 """
 
 __revision__ = '$Revision: 2130 $'
@@ -26,9 +33,13 @@ import os.path
 import traceback
 import datetime
 import inspect
+import errno
+import threading
 
 import Cobalt
+import Cobalt.Encoding
 from Cobalt.Exceptions import ComponentLookupError, ComponentOperationError
+from Cobalt.Statistics import process_statistics
 __all__ = [
     "ComponentProxy", "ComponentLookupError", "RetryMethod",
     "register_component", "find_configured_servers",
@@ -87,6 +98,8 @@ def get_caller(jump_back_count=1):
 
 local_components = dict()
 known_servers = dict()
+located_servers = dict() # component name: (url, time the entry expires)
+gzip_servers = set() # hosts that accept gzipped requests
 
 log = logging.getLogger("Proxy")
 # To see errors with proxy in the clients, you should turn this on.
@@ -124,19 +137,32 @@ class RetryMethod(_Method):
     """Method with error handling and retries built in."""
     max_retries = 4
     def __call__(self, *args):
+        with process_statistics.timing('call.%s' % self._Method__name):
+            return self._call(*args)
+
+    def _call(self, *args):
         for retry in range(self.max_retries):
             try:
                 retval = _Method.__call__(self, *args)
                 return retval
             except xmlrpclib.ProtocolError as err:
+                if err.errcode == 503 and retry < (self.max_retries - 1):
+                    # the server is busy; try again after the pause it asked for
+                    log.warning("Server busy(#%s)[%s]: retrying", retry, get_caller(jump_back_count=3))
+                    try:
+                        delay = float(err.headers.getheader('retry-after', 0.5))
+                    except (AttributeError, ValueError):
+                        delay = 0.5
+                    time.sleep(delay)
+                    continue
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
                 log.error("ProtocolError(#%s)[%s]: code:%s msg:%s headers:%s "
-                          "error:%s", retry, get_caller(jump_back_count=2), err.errcode, err.errmsg, err.headers, tb_str)
+                          "error:%s", retry, get_caller(jump_back_count=3), err.errcode, err.errmsg, err.headers, tb_str)
                 raise xmlrpclib.Fault(20, "Server Failure")
             except xmlrpclib.Fault as fault:
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
                 log.error("xmlrpclib.Fault(#%s)[%s]: faultCode:%s faultString:%s "
-                          "error:%s", retry, get_caller(jump_back_count=2), fault.faultCode, fault.faultString, tb_str)
+                          "error:%s", retry, get_caller(jump_back_count=3), fault.faultCode, fault.faultString, tb_str)
                 fault.faultString = sanitize_password(fault.faultString)
                 # due to clients using the same code, the error was too verbose and had to be reduced but still sanitized.
                 raise fault
@@ -144,7 +170,7 @@ class RetryMethod(_Method):
             except socket.error as err:
                 # this is the only path that retries
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
-                log.error("socket.error(#%s)[%s]:errno%s error:%s", retry, get_caller(jump_back_count=2), err.errno, tb_str)
+                log.error("socket.error(#%s)[%s]:errno%s error:%s", retry, get_caller(jump_back_count=3), err.errno, tb_str)
                 if hasattr(err, 'errno') and err.errno == 336265218:
                     log.error("SSL Key error")
                     break
@@ -153,23 +179,23 @@ class RetryMethod(_Method):
             except CertificateError as ce:
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
                 log.error("CertificateError(#%s)[%s]: invalid commonName %s from server.  error:%s",
-                          retry, get_caller(jump_back_count=2), ce.commonName, tb_str)
+                          retry, get_caller(jump_back_count=3), ce.commonName, tb_str)
                 break
             except KeyError:
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
                 log.error("KeyError(#%s)[%s]: Server disallowed connection.  error:%s",
-                          retry, get_caller(jump_back_count=2), tb_str)
+                          retry, get_caller(jump_back_count=3), tb_str)
                 break
             except Exception:
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
-                log.error("KeyError(#%s)[%s]: error:%s", retry, get_caller(jump_back_count=2), tb_str)
+                log.error("KeyError(#%s)[%s]: error:%s", retry, get_caller(jump_back_count=3), tb_str)
                 break
 
             try:
                 time.sleep(0.5)
             except IOError:
                 tb_str = sanitize_password('\n'.join(extract_traceback()))
-                log.error("time.sleep/IOERROR(#%s)[%s]: error:%s", retry, get_caller(jump_back_count=2), tb_str)
+                log.error("time.sleep/IOERROR(#%s)[%s]: error:%s", retry, get_caller(jump_back_count=3), tb_str)
                 #Yes, you can get an IOError from ppc64 linux kernels
                 #It has to do with the select that is used to get sub-second
                 #sleeps. We just ignore this attempt if the exception gets
@@ -281,8 +307,64 @@ class SSLHTTPConnection(httplib.HTTPConnection):
         self.sock.closeSocket = True
 
 
+class ConnectionPool(object):
+    """Idle keep-alive connections, shared by all transports in a process.
+
+    Connections are keyed by host and SSL parameters, and are closed rather
+    than reused once they have been idle for idle_timeout seconds, which
+    should be less than the time servers keep idle connections open.
+    """
+
+    def __init__(self, max_idle=8, idle_timeout=5.0):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {} # key: [(connection, time returned to the pool)]
+
+    def get(self, key):
+        """Return an idle connection for key, or None."""
+        now = time.time()
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    connection = conn
+                    break
+                stale.append(conn)
+        for conn in stale:
+            conn.close()
+        return connection
+
+    def put(self, key, connection):
+        """Return a connection with no request outstanding to the pool."""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+connection_pool = ConnectionPool()
+
+# errors from a pooled connection that the server has since closed.  The
+# request never reached the server, so it is sent again on a new connection.
+_STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+
 class XMLRPCTransport(xmlrpclib.Transport):
-    def __init__(self, key=None, cert=None, ca=None, scns=None, use_datetime=0, timeout=90):
+    def __init__(self, key=None, cert=None, ca=None, scns=None, use_datetime=0, timeout=90,
+            component_name=None, keepalive=True, encodings=None, compress_threshold=0):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self, use_datetime)
         self.key = key
@@ -290,72 +372,167 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.ca = ca
         self.scns = scns
         self.timeout = timeout
+        self.component_name = component_name
+        self.keepalive = keepalive
+        self.encodings = encodings or []
+        self.compress_threshold = compress_threshold
+
+    def _pool_key(self, host):
+        return (host, self.key, self.cert, self.ca, tuple(self.scns or ()), self.timeout)
 
     def make_connection(self, host):
-        #this is a hack
-        try:
-            #python 2.7
-            self._connection
-        except AttributeError:
-            #python not 2.7
-            host = self.get_host_info(host)[0]
-            http = SSLHTTPConnection(host, key=self.key, cert=self.cert, ca=self.ca,
-                                 scns=self.scns, timeout=self.timeout)
-            https = httplib.HTTP()
-            https._setup(http)
-        else:
-            host, self._extra_headers, x509 = self.get_host_info(host)
-            http = SSLHTTPConnection(host, key=self.key, cert=self.cert, ca=self.ca,
-                                 scns=self.scns, timeout=self.timeout)
-            self._connection = host, http
-            https = self._connection[1]
-            https = httplib.HTTP()
-            https._setup(http)
-        return https
+        """Return a connection to host and whether it is a reused one."""
+        if self.keepalive:
+            connection = connection_pool.get(self._pool_key(host))
+            if connection is not None:
+                return connection, True
+        return SSLHTTPConnection(host, key=self.key, cert=self.cert, ca=self.ca,
+                                 scns=self.scns, timeout=self.timeout), False
 
     def request(self, host, handler, request_body, verbose=0):
         """Send request to server and return response."""
-        h = self.make_connection(host)
-        self.send_request(h, handler, request_body)
-        self.send_host(h, host)
-        self.send_user_agent(h)
-        self.send_content(h, request_body)
-
-        errcode, errmsg, headers = h.getreply()
-
-        if errcode != 200:
-            raise xmlrpclib.ProtocolError(host + handler, errcode, errmsg, headers)
-
         self.verbose = verbose
-        msglen = int(headers.dict['content-length'])
-        response = self._get_response(h.getfile(), msglen)
-        return response
-
-    def _get_response(self, fd, length):
-        # read response from input file/socket, and parse it
-        recvd = 0
-
+        host, extra_headers, x509 = self.get_host_info(host)
+        while True:
+            connection, reused = self.make_connection(host)
+            try:
+                return self._request(connection, host, handler, request_body, extra_headers)
+            except (socket.error, httplib.BadStatusLine) as err:
+                connection.close()
+                if reused and (isinstance(err, httplib.BadStatusLine) or
+                        getattr(err, 'errno', None) in _STALE_CONNECTION_ERRNOS):
+                    continue
+                if not reused and self.component_name is not None:
+                    # the component may have moved; look it up again next time
+                    forget_location(self.component_name)
+                raise
+            except:
+                connection.close()
+                raise
+
+    def _request(self, connection, host, handler, request_body, extra_headers):
+        """Make a request over connection and parse the response."""
+        connection.putrequest("POST", handler, skip_accept_encoding=True)
+        for header, value in extra_headers or []:
+            connection.putheader(header, value)
+        connection.putheader("User-Agent", self.user_agent)
+        connection.putheader("Content-Type", Cobalt.Encoding.XMLRPC_CONTENT_TYPE)
+        if self.encodings:
+            connection.putheader("Accept", Cobalt.Encoding.accept_header(self.encodings))
+        if self.compress_threshold > 0:
+            connection.putheader("Accept-Encoding", "gzip")
+            if len(request_body) > self.compress_threshold and host in gzip_servers:
+                request_body = Cobalt.Encoding.compress(request_body)
+                connection.putheader("Content-Encoding", "gzip")
+        connection.putheader("Content-Length", str(len(request_body)))
+        if not self.keepalive:
+            connection.putheader("Connection", "close")
+        connection.endheaders(request_body)
+
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            connection.close()
+            raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
+        if self.keepalive and not response.will_close:
+            connection_pool.put(self._pool_key(host), connection)
+        else:
+            connection.close()
+        if self.compress_threshold > 0 and Cobalt.Encoding.accepts_gzip(response.getheader("accept-encoding")):
+            gzip_servers.add(host)
+        if self.verbose:
+            print "body:", repr(body), len(body)
+        return self._parse_response(body, response.getheader("content-type"), response.getheader("content-encoding"))
+
+    def _parse_response(self, body, content_type, content_encoding=None):
+        """Decode a response body as the server encoded it."""
+        if content_encoding and content_encoding.lower() == "gzip":
+            body = Cobalt.Encoding.decompress(body)
+        codec = Cobalt.Encoding.get_codec(content_type)
+        if codec is not None:
+            return (codec.loads_response(body),)
         p, u = self.getparser()
-
-        while recvd < length:
-            rlen = min(length - recvd, 1024)
-            response = fd.read(rlen)
-            recvd += len(response)
-            if not response:
-                break
-            if self.verbose:
-                print "body:", repr(response), len(response)
-            p.feed(response)
-
-        fd.close()
+        p.feed(body)
         p.close()
-
         return u.close()
 
 
 def register_component (component):
     local_components[component.name] = component
 
+_communication_config = None # (config file mtimes, settings)
+
+def _get_communication_config():
+    """Return the [communication] settings, rereading the configuration
+    files only when they have changed."""
+    global _communication_config
+    mtimes = []
+    for config_file in Cobalt.CONFIG_FILES:
+        try:
+            mtimes.append((config_file, os.stat(config_file).st_mtime))
+        except OSError:
+            mtimes.append((config_file, None))
+    if _communication_config is not None and _communication_config[0] == mtimes:
+        return _communication_config[1]
+    settings = {'passwd': 'default', 'keypath': None, 'certpath': None, 'capath': None,
+                'locate_cache_ttl': 60.0, 'keepalive': True,
+                'encodings': Cobalt.Encoding.parse_encodings(Cobalt.Encoding.DEFAULT_ENCODINGS),
+                'compress_threshold': Cobalt.Encoding.DEFAULT_COMPRESS_THRESHOLD}
+    config = SafeConfigParser()
+    config.read(Cobalt.CONFIG_FILES)
+    try:
+        passwd = config.get('communication', 'password')
+        keypath = os.path.expandvars(config.get('communication', 'key'))
+        certpath = os.path.expandvars(config.get('communication', 'cert'))
+        capath = os.path.expandvars(config.get('communication', 'ca'))
+    except:
+        pass
+    else:
+        settings.update({'passwd': passwd, 'keypath': keypath, 'certpath': certpath, 'capath': capath})
+    try:
+        settings['locate_cache_ttl'] = config.getfloat('communication', 'locate_cache_ttl')
+    except:
+        pass
+    try:
+        settings['keepalive'] = config.getboolean('communication', 'keepalive')
+    except:
+        pass
+    try:
+        settings['encodings'] = Cobalt.Encoding.parse_encodings(config.get('communication', 'encodings'))
+    except:
+        pass
+    try:
+        settings['compress_threshold'] = config.getint('communication', 'compress_threshold')
+    except:
+        pass
+    _communication_config = (mtimes, settings)
+    return settings
+
+def locate(component_name, ttl):
+    """Return the url of a component from the service-location component,
+    using an earlier answer if it is less than ttl seconds old."""
+    now = time.time()
+    url, expires = located_servers.get(component_name, (None, 0))
+    if url is not None and now < expires:
+        return url
+    try:
+        slp = ComponentProxy("service-location")
+    except ComponentLookupError:
+        raise ComponentLookupError("%s:cn:%s" % (get_caller(2), component_name))
+    try:
+        url = slp.locate(component_name)
+    except:
+        raise ComponentLookupError("%s:cn:%s" % (get_caller(2), component_name))
+    if not url:
+        raise ComponentLookupError("%s:cn:%s" % (get_caller(2), component_name))
+    if ttl > 0:
+        located_servers[component_name] = (url, now + ttl)
+    return url
+
+def forget_location(component_name):
+    """Drop the cached location of a component."""
+    located_servers.pop(component_name, None)
+
 def _ComponentProxy(component_name, **kwargs):
     
     """Constructs proxies to components.
@@ -372,39 +549,24 @@ def _ComponentProxy(component_name, **kwargs):
         return DeferredProxy(component_name, enable_retry)
 
     user = 'root'
-    try:
-        config = SafeConfigParser()
-        config.read(Cobalt.CONFIG_FILES)
-        passwd = config.get('communication', 'password')
-        keypath = os.path.expandvars(config.get('communication', 'key'))
-        certpath = os.path.expandvars(config.get('communication', 'cert'))
-        capath = os.path.expandvars(config.get('communication', 'ca'))
-    except:
-        passwd = 'default'
-        keypath = None
-        certpath = None
-        capath = None
+    settings = _get_communication_config()
+    passwd = settings['passwd']
 
-    ssl_trans = XMLRPCTransport(keypath, certpath, capath, timeout=90)    
-    
     if component_name in local_components:
         return LocalProxy(local_components[component_name])
     elif component_name in known_servers:
         method, path = urlparse.urlparse(known_servers[component_name])[:2]
         newurl = "%s://%s:%s@%s" % (method, user, passwd, path)
+        ssl_trans = XMLRPCTransport(settings['keypath'], settings['certpath'], settings['capath'], timeout=90,
+                keepalive=settings['keepalive'], encodings=settings['encodings'],
+                compress_threshold=settings['compress_threshold'])
     elif component_name != "service-location":
-        try:
-            slp = ComponentProxy("service-location")
-        except ComponentLookupError:
-            raise ComponentLookupError("%s:cn:%s" % (get_caller(), component_name))
-        try:
-            address = slp.locate(component_name)
-        except:
-            raise ComponentLookupError("%s:cn:%s" % (get_caller(), component_name))
-        if not address:
-            raise ComponentLookupError("%s:cn:%s" % (get_caller(), component_name))
+        address = locate(component_name, settings['locate_cache_ttl'])
         method, path = urlparse.urlparse(address)[:2]
         newurl = "%s://%s:%s@%s" % (method, user, passwd, path)
+        ssl_trans = XMLRPCTransport(settings['keypath'], settings['certpath'], settings['capath'], timeout=90,
+                component_name=component_name, keepalive=settings['keepalive'], encodings=settings['encodings'],
+                compress_threshold=settings['compress_threshold'])
     else:
         raise ComponentLookupError("%s:cn:%s" % (get_caller(), component_name))
 
@@ -5,7 +5,7 @@
 __revision__ = '$Revision: 2179 $'
 
 __all__ = [
-    "TCPServer", "XMLRPCRequestHandler", "XMLRPCServer",
+    "TCPServer", "XMLRPCRequestHandler", "XMLRPCServer", "PooledXMLRPCServer",
     "find_intended_location",
 ]
 
@@ -24,8 +24,13 @@ import urlparse
 import threading
 import time
 import ssl
+import errno
+import fcntl
+import Queue
 
 import Cobalt
+import Cobalt.Encoding
+import Cobalt.Util
 from Cobalt.Util import extract_traceback, sanitize_password
 from Cobalt.Proxy import ComponentProxy
 
@@ -70,28 +75,73 @@ class CobaltXMLRPCDispatcher (SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
         self.encoding = encoding
 
     def _marshaled_dispatch (self, data):
-        method_func = None
-        params, method = xmlrpclib.loads(data)
-        #print method, "\n" ,params
+        return self._encoded_dispatch(data)[0]
+
+    def _encoded_dispatch (self, data, request_codec=None, response_codec=None):
+        '''Dispatch a request and return the response and its content type.
+
+        The request is decoded with request_codec and the response encoded with
+        response_codec (Cobalt.Encoding codecs), using XML-RPC where either is
+        None.  Responses response_codec cannot encode are sent as XML-RPC.
 
+        '''
+        start = time.time()
+        if request_codec is None:
+            params, method = xmlrpclib.loads(data)
+        else:
+            params, method = request_codec.loads_request(data)
+        self._record_latency('rpc.unmarshal', time.time() - start)
+        #print method, "\n" ,params
+        response = self._encode_response(method, params, response_codec)
+        self._record_latency('%s.request' % method, time.time() - start)
+        return response
+
+    def _record_latency (self, name, value):
+        '''Add a timing to the instance's statistics, if it keeps them.'''
+        statistics = getattr(self.instance, 'statistics', None)
+        if statistics is not None and hasattr(statistics, 'add_latency'):
+            statistics.add_latency(name, value)
+
+    def _encode_response (self, method, params, response_codec):
+        response = None
         try:
             #print "%s: %s being poked" % (time.ctime(), method)
             #time.sleep(120)
             response = self.instance._dispatch(method, params, self.funcs)
-            response = (response,)
-            raw_response = xmlrpclib.dumps(response, methodresponse=1,
-                                           allow_none=self.allow_none,
-                                           encoding=self.encoding)
         except xmlrpclib.Fault, fault:
-            raw_response = xmlrpclib.dumps(fault,
-                                           allow_none=self.allow_none,
-                                           encoding=self.encoding)
+            pass
         except:
             # report exception back to server
-            raw_response = xmlrpclib.dumps(
-                xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value)),
-                allow_none=self.allow_none, encoding=self.encoding)
-        return raw_response
+            fault = xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value))
+        else:
+            fault = None
+        start = time.time()
+        try:
+            return self._marshal_response(method, response, fault, response_codec)
+        finally:
+            self._record_latency('rpc.marshal', time.time() - start)
+
+    def _marshal_response (self, method, response, fault, response_codec):
+        if response_codec is not None:
+            try:
+                if fault is None:
+                    return response_codec.dumps_response(response), response_codec.content_type
+                return response_codec.dumps_fault(fault), response_codec.content_type
+            except (TypeError, ValueError), err:
+                self.logger.debug("%s response not encodable as %s, sending XML-RPC: %s", method,
+                        response_codec.name, err)
+        if fault is None:
+            try:
+                raw_response = xmlrpclib.dumps((response,), methodresponse=1,
+                                               allow_none=self.allow_none,
+                                               encoding=self.encoding)
+                return raw_response, Cobalt.Encoding.XMLRPC_CONTENT_TYPE
+            except:
+                fault = xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value))
+        raw_response = xmlrpclib.dumps(fault,
+                                       allow_none=self.allow_none,
+                                       encoding=self.encoding)
+        return raw_response, Cobalt.Encoding.XMLRPC_CONTENT_TYPE
 
 
 
@@ -168,10 +218,13 @@ class SSLServer (SocketServer.TCPServer, object):
     def get_request(self):
         (sock, sockinfo) = self.socket.accept()
         sock.settimeout(self.timeout)
-        sslsock = ssl.wrap_socket(sock, server_side=True, certfile=self.certfile,
-                                  keyfile=self.keyfile, cert_reqs=self.mode,
-                                  ca_certs=self.ca, ssl_version=self.ssl_protocol)
-        return sslsock, sockinfo
+        return self.wrap_request(sock), sockinfo
+
+    def wrap_request(self, sock):
+        """Perform the SSL handshake on an accepted connection."""
+        return ssl.wrap_socket(sock, server_side=True, certfile=self.certfile,
+                               keyfile=self.keyfile, cert_reqs=self.mode,
+                               ca_certs=self.ca, ssl_version=self.ssl_protocol)
 
     def close_request(self, request):
         # request.unwrap()
@@ -203,20 +256,38 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     Methods:
     authenticate -- prompt a check of a client's provided username and password
     handle_one_request -- handle a single rpc (optionally authenticating)
+
+    Connections are kept open between requests if the server allows it
+    (server.keepalive) and the client has not asked to close them.
+
+    Responses are encoded with the first of the [communication] encodings
+    the client accepts, and gzipped if larger than compress_threshold
+    bytes and the client accepts gzip (see Cobalt.Encoding).
     """
     logger = logging.getLogger("Cobalt.Server.XMLRPCRequestHandler")
+    protocol_version = "HTTP/1.1"
     
     class CouldNotAuthenticate (Exception):
         """Client did not present acceptible authentication information."""
     
     require_auth = True
     credentials = {'root':'default'}
+    encodings = Cobalt.Encoding.parse_encodings(Cobalt.Encoding.DEFAULT_ENCODINGS)
+    compress_threshold = Cobalt.Encoding.DEFAULT_COMPRESS_THRESHOLD
     try:
         config = SafeConfigParser()
         config.read(Cobalt.CONFIG_FILES)
         credentials['root'] = config.get('communication', 'password')
     except:
         pass
+    try:
+        encodings = Cobalt.Encoding.parse_encodings(config.get('communication', 'encodings'))
+    except:
+        pass
+    try:
+        compress_threshold = config.getint('communication', 'compress_threshold')
+    except:
+        pass
     
     def authenticate (self):
         """Authenticate the credentials of the latest client."""
@@ -269,8 +340,16 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 L.append(self.rfile.read(chunk_size))
                 size_remaining -= len(L[-1])
             data = ''.join(L)
-
-            response = self.server._marshaled_dispatch(data)
+            if self.headers.get("content-encoding", "").lower() == "gzip":
+                data = Cobalt.Encoding.decompress(data)
+
+            request_codec = Cobalt.Encoding.get_codec(self.headers.get("content-type"))
+            response_codec = Cobalt.Encoding.choose_codec(self.headers.get("accept"), self.encodings)
+            response, content_type = self.server._encoded_dispatch(data, request_codec, response_codec)
+            compressed = (self.compress_threshold > 0 and len(response) > self.compress_threshold and
+                    Cobalt.Encoding.accepts_gzip(self.headers.get("accept-encoding")))
+            if compressed:
+                response = Cobalt.Encoding.compress(response)
         except:
             tb_str = sanitize_password('\n'.join(extract_traceback()))
             self.logger.error("Exception: error:%s", tb_str)
@@ -279,15 +358,32 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             self.end_headers()
         else:
             # got a valid XML RPC response
+            if not getattr(self.server, "keepalive", False):
+                self.close_connection = 1
             self.send_response(200)
-            self.send_header("Content-type", "text/xml")
+            self.send_header("Content-type", content_type)
             self.send_header("Content-length", str(len(response)))
+            if compressed:
+                self.send_header("Content-Encoding", "gzip")
+            if self.compress_threshold > 0:
+                # tell the client it may compress large requests
+                self.send_header("Accept-Encoding", "gzip")
+            if self.close_connection:
+                self.send_header("Connection", "close")
             self.end_headers()
             self.wfile.write(response)
-
-            # shut down the connection
             self.wfile.flush()
-            self.connection.shutdown(1)
+
+            if self.close_connection:
+                # shut down the connection
+                self.connection.shutdown(1)
+
+    def log_error (self, format, *args):
+        """Idle keep-alive connections timing out are not errors."""
+        if format.startswith("Request timed out"):
+            self.logger.debug(format, *args)
+        else:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.log_error(self, format, *args)
    
 
 class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
@@ -308,7 +404,12 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
     Properties:
     require_auth -- the request handler is requiring authorization
     credentials -- valid credentials being used for authentication
+    keepalive -- connections may be kept open between requests.  Only for
+                 servers that handle each connection in its own thread, as
+                 an idle connection would otherwise hold up the server.
     """
+
+    keepalive = False
     
     def __init__ (self, server_address, RequestHandlerClass=None,
                   keyfile=None, certfile=None,
@@ -357,6 +458,8 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
             name = instance.name
         except AttributeError:
             name = "unknown"
+        if hasattr(instance, "server_fds"):
+            instance.server_fds = [self.fileno()]
         if self.register:
             self.register_with_slp()
         self.logger.info("serving %s at %s" % (name, self.url))
@@ -411,8 +514,7 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
                         self.instance.do_tasks()
                 except:
                     self.logger.error("Unexpected task failure", exc_info=1)
-                # this causes delays such as in control-c
-                Cobalt.Util.sleep(self.sleeptime)
+                self._wait_for_tasks()
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
 
@@ -440,6 +542,38 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
         self.RequestHandlerClass.credentials = value
     credentials = property(_get_credentials, _set_credentials)
     
+    def handle_request (self):
+        """Handle one request, or time out.
+
+        If the registered instance has a wakeup_fds method, the descriptors
+        it returns are waited on along with the listening socket, and this
+        returns as soon as any of them is readable so that serve_forever
+        can run the instance's tasks without waiting for the timeout.  It
+        also returns when the instance's next automatic task is due.
+        """
+        wakeup_fds = []
+        if self.instance and hasattr(self.instance, "wakeup_fds"):
+            wakeup_fds = self.instance.wakeup_fds()
+        task_due = None
+        if self.instance and hasattr(self.instance, "next_task_due"):
+            task_due = self.instance.next_task_due()
+        if not wakeup_fds and task_due is None:
+            return SSLServer.handle_request(self)
+        timeout = self.socket.gettimeout()
+        if timeout is None:
+            timeout = self.timeout
+        elif self.timeout is not None:
+            timeout = min(timeout, self.timeout)
+        if task_due is not None:
+            task_delay = max(self.sleeptime, task_due - time.time())
+            if timeout is None or task_delay < timeout:
+                timeout = task_delay
+        ready = Cobalt.Util.wait_readable([self.fileno()] + list(wakeup_fds), timeout)
+        if self.fileno() in ready:
+            self._handle_request_noblock()
+        elif not ready:
+            self.handle_timeout()
+
     def serve_forever (self, frequency=120):
         """Serve single requests until (self.serve == False)."""
         self.serve = True
@@ -475,9 +609,19 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
         finally:
             self.logger.info("serve_forever() [stop]")
     
+    def _wait_for_tasks (self):
+        """Sleep until the instance's next automatic task is due."""
+        if self.instance and hasattr(self.instance, "wait_for_tasks"):
+            self.instance.wait_for_tasks(min_wait=self.sleeptime)
+        else:
+            # this causes delays such as in control-c
+            Cobalt.Util.sleep(self.sleeptime)
+
     def shutdown (self):
         """Signal that automatic service should stop."""
         self.serve = False
+        if self.instance and hasattr(self.instance, "wake_tasks"):
+            self.instance.wake_tasks()
     
     def _handle_shutdown_signal (self, signum, frame):
         self.shutdown()
@@ -488,6 +632,9 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
         return args
 
 class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer): 
+
+    keepalive = True
+    daemon_threads = True
     
     def __init__ (self, server_address, RequestHandlerClass=None,
                   keyfile=None, certfile=None,
@@ -533,7 +680,7 @@ class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer):
                         self.instance.do_tasks()
                 except:
                     self.logger.error("Unexpected task failure", exc_info=1)
-                Cobalt.Util.sleep(self.sleeptime)
+                self._wait_for_tasks()
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
     
@@ -560,3 +707,197 @@ class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer):
         finally:
             self.logger.info("serve_forever() [stop]")
     
+
+
+class PooledRequestHandler (XMLRPCRequestHandler):
+
+    """Request handler for PooledXMLRPCServer.
+
+    Handles a single request and returns, leaving a kept-alive connection
+    open for the server to wait on until the next request arrives.
+    """
+
+    def handle (self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+
+class PooledXMLRPCServer (XMLRPCServer):
+
+    """XMLRPCServer handling requests on a fixed pool of worker threads.
+
+    One thread waits on the listening socket and on every idle kept-alive
+    connection, and queues connections that have a request waiting for the
+    workers.  SSL handshakes happen on the workers.  When queue_depth
+    connections are already waiting, further requests are answered with 503
+    (Service Unavailable), which clients retry after a pause.  The time
+    requests wait in the queue is recorded in the instance's statistics as
+    rpc_queue_wait.
+    """
+
+    retry_after = 1
+
+    def __init__ (self, server_address, RequestHandlerClass=None,
+                  keyfile=None, certfile=None,
+                  timeout=10,
+                  logRequests=False,
+                  register=True, allow_none=True, encoding=None, cafile=None,
+                  sleeptime=10.0, workers=16, queue_depth=256):
+        if not RequestHandlerClass:
+            class RequestHandlerClass (PooledRequestHandler):
+                """A subclassed request handler to prevent class-attribute conflicts."""
+        XMLRPCServer.__init__(self, server_address, RequestHandlerClass, keyfile, certfile, timeout, logRequests,
+                register, allow_none, encoding, cafile, sleeptime)
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._work = Queue.Queue(queue_depth)
+        self._worker_threads = []
+        self._idle = {} # fd: (connection, client address, time it went idle)
+        self._idle_lock = threading.Lock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def get_request (self):
+        """Accept a connection, leaving the SSL handshake to a worker."""
+        (sock, sockinfo) = self.socket.accept()
+        sock.settimeout(self.timeout)
+        return sock, sockinfo
+
+    def _wakeup (self):
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup (self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _queue_connection (self, request, client_address):
+        try:
+            self._work.put_nowait((request, client_address, time.time()))
+        except Queue.Full:
+            self._reject(request, client_address)
+
+    def _reject (self, request, client_address):
+        """Answer a connection with 503 and close it."""
+        self._record_latency('rpc_rejected', 0)
+        try:
+            request.settimeout(1)
+            if not isinstance(request, ssl.SSLSocket):
+                request = self.wrap_request(request)
+            request.sendall("HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: %d\r\n"
+                    "Connection: close\r\n\r\n" % self.retry_after)
+        except (socket.error, ssl.SSLError), err:
+            self.logger.debug("failed to reject request from %s: %s", client_address, err)
+        self.shutdown_request(request)
+
+    def _keep_idle (self, request, client_address):
+        """Wait for the next request on a kept-alive connection."""
+        if isinstance(request, ssl.SSLSocket) and request.pending():
+            # already read from the socket, so waiting on it would not see it
+            self._queue_connection(request, client_address)
+            return
+        with self._idle_lock:
+            self._idle[request.fileno()] = (request, client_address, time.time())
+        self._wakeup()
+
+    def _worker (self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            request, client_address, queued = item
+            self._record_latency('rpc_queue_wait', time.time() - queued)
+            keep = False
+            try:
+                if not isinstance(request, ssl.SSLSocket):
+                    request = self.wrap_request(request)
+                    if not request.pending() and not Cobalt.Util.wait_readable([request.fileno()], 0):
+                        # no request yet; wait for it with the other idle connections
+                        self._keep_idle(request, client_address)
+                        continue
+                handler = self.RequestHandlerClass(request, client_address, self)
+                keep = self.serve and not handler.close_connection
+            except:
+                self.handle_error(request, client_address)
+            if keep:
+                self._keep_idle(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def start_workers (self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._worker_threads.append(thread)
+
+    def stop_workers (self):
+        for _ in self._worker_threads:
+            self._work.put(None)
+        self._worker_threads = []
+
+    def _poll (self):
+        """Wait for new connections and requests on idle connections, and queue them for the workers."""
+        listen_fd = self.socket.fileno()
+        with self._idle_lock:
+            fds = [listen_fd, self._wakeup_read] + self._idle.keys()
+        ready = Cobalt.Util.wait_readable(fds, 1.0)
+        for fd in ready:
+            if fd == listen_fd:
+                try:
+                    request, client_address = self.get_request()
+                except socket.error:
+                    continue
+                self._queue_connection(request, client_address)
+            elif fd == self._wakeup_read:
+                self._drain_wakeup()
+            else:
+                with self._idle_lock:
+                    entry = self._idle.pop(fd, None)
+                if entry is not None:
+                    self._queue_connection(entry[0], entry[1])
+        # close connections left idle longer than the handler timeout
+        expired = []
+        now = time.time()
+        with self._idle_lock:
+            for fd, (request, client_address, idle_since) in self._idle.items():
+                if self.timeout is not None and now - idle_since > self.timeout:
+                    expired.append(request)
+                    del self._idle[fd]
+        for request in expired:
+            self.shutdown_request(request)
+
+    def serve_forever (self):
+        """Serve requests on the worker pool until (self.serve == False)."""
+        self.serve = True
+        self.task_thread.start()
+        self.start_workers()
+        self.logger.info("serve_forever() [start] with %d workers", self.workers)
+        signal.signal(signal.SIGINT, self._handle_shutdown_signal)
+        signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+        try:
+            while self.serve:
+                try:
+                    self._poll()
+                except:
+                    self.logger.error("Got unexpected error waiting for requests", exc_info=1)
+        finally:
+            self.stop_workers()
+            self.logger.info("serve_forever() [stop]")
+
+    def server_close (self):
+        XMLRPCServer.server_close(self)
+        with self._idle_lock:
+            idle, self._idle = self._idle, {}
+        for request, _, _ in idle.values():
+            self.shutdown_request(request)
+        for fd in (self._wakeup_read, self._wakeup_write):
+            os.close(fd)
@@ -1,5 +1,11 @@
 # Copyright 2017 UChicago Argonne, LLC. All rights reserved.
 # Licensed under a modified BSD 3-clause license. See LICENSE for details.
+import bisect
+import math
+import time
+import threading
+from contextlib import contextmanager
+
 class Statistic(object):
     def __init__(self, name, initial_value):
         self.name = name
@@ -19,16 +25,220 @@ class Statistic(object):
     def get_value(self):
         return (self.name, (self.min, self.max, self.ave))
 
+# bucket bounds, in seconds, of the cumulative counts reported for latencies
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class LatencyHistogram(object):
+    '''Counts of values in log-linear buckets, HDR histogram style: each
+    power of two is split into sub_buckets equal parts, so percentiles are
+    within 1/sub_buckets of the true value whatever its size.'''
+
+    sub_buckets = 32
+
+    def __init__(self):
+        self.counts = dict()
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= 0:
+            return None
+        mantissa, exponent = math.frexp(value)
+        return exponent, int((mantissa - 0.5) * 2 * self.sub_buckets)
+
+    def _upper(self, bucket):
+        if bucket is None:
+            return 0.0
+        exponent, sub = bucket
+        return math.ldexp(0.5 + (sub + 1) / (2.0 * self.sub_buckets), exponent)
+
+    def add_value(self, value):
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentiles(self, fractions):
+        '''Return the value at or below which each fraction of the values fall.'''
+        results = []
+        if not self.count:
+            return [0.0] * len(fractions)
+        # None (values <= 0) sorts before every bucket
+        buckets = sorted(self.counts.items())
+        seen = 0
+        index = 0
+        for fraction in sorted(fractions):
+            target = max(1, int(math.ceil(fraction * self.count)))
+            while seen + buckets[index][1] < target:
+                seen += buckets[index][1]
+                index += 1
+            results.append(min(self._upper(buckets[index][0]), self.max))
+        return results
+
+    def cumulative_counts(self, bounds=LATENCY_BOUNDS):
+        '''Return the count of values at or below each bound, ending with
+        "+Inf" for all values.  Values are placed by their bucket's upper
+        edge, so a value within a bucket width above a bound may be
+        counted at the next bound.'''
+        buckets = []
+        pending = sorted(self.counts.items())
+        total = 0
+        for bound in bounds:
+            while pending and self._upper(pending[0][0]) <= bound:
+                total += pending.pop(0)[1]
+            buckets.append([str(bound), total])
+        buckets.append(["+Inf", self.count])
+        return buckets
+
+    def get_value(self):
+        p50, p95, p99 = self.percentiles((0.5, 0.95, 0.99))
+        return {'count':self.count, 'sum':self.sum, 'min':self.min or 0.0, 'max':self.max or 0.0,
+                'p50':p50, 'p95':p95, 'p99':p99}
+
+class Metric(object):
+    '''Latencies since startup and in slots of slot_seconds covering the last
+    slots * slot_seconds, for percentiles over a sliding window.'''
+
+    slot_seconds = 10
+    slots = 30
+
+    def __init__(self):
+        self.total = LatencyHistogram()
+        self.recent = dict()
+
+    def add_value(self, value, now=None):
+        self.total.add_value(value)
+        slot = int((now or time.time()) // self.slot_seconds)
+        if slot not in self.recent:
+            for old in [old for old in self.recent if old <= slot - self.slots]:
+                del self.recent[old]
+            self.recent[slot] = LatencyHistogram()
+        self.recent[slot].add_value(value)
+
+    def window(self, seconds, now=None):
+        '''Return a LatencyHistogram of the values from about the last seconds.'''
+        first = int((now or time.time()) // self.slot_seconds) - int(math.ceil(seconds / float(self.slot_seconds))) + 1
+        histogram = LatencyHistogram()
+        for slot, recent in self.recent.items():
+            if slot >= first:
+                histogram.merge(recent)
+        return histogram
+
 class Statistics(object):
     def __init__(self):
         self.data = dict()
+        self.metrics = dict()
+        # values are added from request threads, not all of which hold the
+        # component lock exclusively.
+        self._lock = threading.Lock()
 
     def add_value(self, name, value):
-        if name not in self.data:
-            self.data[name] = Statistic(name, value)
-        else:
-            self.data[name].add_value(value)
+        with self._lock:
+            if name not in self.data:
+                self.data[name] = Statistic(name, value)
+            else:
+                self.data[name].add_value(value)
+
+    def add_latency(self, name, value):
+        '''Add a value to the named statistic and to its latency metric.'''
+        with self._lock:
+            if name not in self.data:
+                self.data[name] = Statistic(name, value)
+            else:
+                self.data[name].add_value(value)
+            if name not in self.metrics:
+                self.metrics[name] = Metric()
+            self.metrics[name].add_value(value)
+
+    @contextmanager
+    def timing(self, name):
+        '''Add the time spent in a with block as a latency.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_latency(name, time.time() - start)
+
+    def get_metrics(self, window=60):
+        '''Return count, sum, min, max and p50/p95/p99 of each latency since
+        startup, with the same for the last window seconds under "window".'''
+        now = time.time()
+        metrics = dict()
+        with self._lock:
+            for name, metric in self.metrics.items():
+                value = metric.total.get_value()
+                value['window'] = metric.window(window, now).get_value()
+                metrics[name] = value
+        return metrics
+
+    def latency_histograms(self, window=60, now=None):
+        '''Return (name, histogram since startup, histogram of the last window
+        seconds) for each latency, copied so that values may go on being added.'''
+        histograms = []
+        with self._lock:
+            for name, metric in self.metrics.items():
+                total = LatencyHistogram()
+                total.merge(metric.total)
+                histograms.append((name, total, metric.window(window, now)))
+        return histograms
+
+    def display_histograms(self):
+        with self._lock:
+            return dict([(name, {'buckets':metric.total.cumulative_counts(), 'count':metric.total.count,
+                'sum':metric.total.sum}) for name, metric in self.metrics.items()])
 
     def display(self):
         return dict([value.get_value() for value in self.data.values()])
-            
+
+def _prometheus_labels(labels, name):
+    items = sorted(labels.items()) + [('name', name)]
+    return ','.join(['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in items])
+
+def prometheus_text(statistics, labels, window=60):
+    '''Return the latencies of each of statistics in the Prometheus text
+    format, each with labels (a dict) and its name as the "name" label.
+    Latencies with the same name are merged, and each family's samples
+    follow its HELP and TYPE lines.'''
+    now = time.time()
+    totals = dict()
+    windows = dict()
+    for stats in statistics:
+        for name, total, recent in stats.latency_histograms(window, now):
+            totals.setdefault(name, LatencyHistogram()).merge(total)
+            windows.setdefault(name, LatencyHistogram()).merge(recent)
+    lines = ['# HELP cobalt_latency_seconds Time taken by requests, methods, tasks, locks and calls out.',
+             '# TYPE cobalt_latency_seconds histogram']
+    for name in sorted(totals):
+        label_text = _prometheus_labels(labels, name)
+        histogram = totals[name]
+        for bound, count in histogram.cumulative_counts():
+            lines.append('cobalt_latency_seconds_bucket{%s,le="%s"} %d' % (label_text, bound, count))
+        lines.append('cobalt_latency_seconds_sum{%s} %r' % (label_text, histogram.sum))
+        lines.append('cobalt_latency_seconds_count{%s} %d' % (label_text, histogram.count))
+    lines.extend(['# HELP cobalt_latency_window_seconds Latency quantiles over the last %s seconds.' % window,
+                  '# TYPE cobalt_latency_window_seconds gauge'])
+    for name in sorted(windows):
+        label_text = _prometheus_labels(labels, name)
+        for quantile, value in zip(('0.5', '0.95', '0.99'), windows[name].percentiles((0.5, 0.95, 0.99))):
+            lines.append('cobalt_latency_window_seconds{%s,quantile="%s"} %r' % (label_text, quantile, value))
+    return lines
+
+# latencies of calls out of the process (other components, ALPS, forkers)
+process_statistics = Statistics()
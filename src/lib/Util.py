@@ -159,7 +159,33 @@ def sleep(t):
         time.sleep(t)
     except IOError:
         logger.warning("IOError trapped from time.sleep() and ignored.")
-    
+
+
+def wait_readable(fds, timeout):
+    '''Wait up to timeout seconds (None to block) for any of fds to become
+    readable and return the list of those that are.  Uses poll where it is
+    available so large numbers of descriptors are not a problem.  An
+    interrupted wait returns an empty list.
+
+    '''
+    if not fds:
+        if timeout:
+            sleep(timeout)
+        return []
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            return [fd for fd, _ in poller.poll(timeout)]
+        return select.select(fds, [], [], timeout)[0]
+    except (select.error, OSError, IOError) as err:
+        if err.args[0] == errno.EINTR:
+            return []
+        raise
+
 
 def check_dependencies(dependency_string):
 
@@ -760,6 +786,51 @@ class Timer (object):
 
     elapsed_times = property(__get_elapsed_times, doc = "list of elapsed times")
 
+class ReadWriteLock (object):
+    '''A lock held either by any number of readers or by a single writer.
+
+    acquire and release take the lock exclusively, so this may stand in for
+    a threading.Lock.  Writers waiting for the lock hold off new readers, so
+    a steady stream of reads cannot starve writers.  The lock is not
+    reentrant in either mode.
+    '''
+    def __init__(self):
+        self.__cond = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__writers_waiting = 0
+
+    def acquire_read(self):
+        '''acquire the lock shared with other readers'''
+        with self.__cond:
+            while self.__writer or self.__writers_waiting:
+                self.__cond.wait()
+            self.__readers += 1
+
+    def release_read(self):
+        '''release a shared hold on the lock'''
+        with self.__cond:
+            self.__readers -= 1
+            if not self.__readers:
+                self.__cond.notify_all()
+
+    def acquire(self):
+        '''acquire the lock exclusively'''
+        with self.__cond:
+            self.__writers_waiting += 1
+            try:
+                while self.__writer or self.__readers:
+                    self.__cond.wait()
+            finally:
+                self.__writers_waiting -= 1
+            self.__writer = True
+
+    def release(self):
+        '''release an exclusive hold on the lock'''
+        with self.__cond:
+            self.__writer = False
+            self.__cond.notify_all()
+
 def getattrname(clsname, attrname):
     '''return mangled private attribute names so that they may be looked up in the dictionary or using getattr()'''
     if attrname[0:2] != "__" or attrname[-2:] == "__":
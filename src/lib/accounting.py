@@ -1,9 +1,14 @@
 # Copyright 2017 UChicago Argonne, LLC. All rights reserved.
 # Licensed under a modified BSD 3-clause license. See LICENSE for details.
-from datetime import datetime
+from datetime import datetime, timedelta, time as dtime
 from time import mktime
 from logging.handlers import BaseRotatingHandler
+from collections import deque
+import codecs
 import os
+import re
+import threading
+import traceback
 from Cobalt.Util import get_config_option
 
 RESOURCE_NAME = get_config_option('system', 'resource_name', 'NOTSET')
@@ -31,9 +36,12 @@ RECORD_MAPPING = {'abort': 'A',
                   'node_down': 'ND',
                   }
 
+RECORD_TYPES = frozenset(RECORD_MAPPING.values())
+
 __all__ = ["abort", "begin", "checkpoint", "delete", "end", "finish",
            "system_remove", "remove", "queue", "rerun", "start", "unconfirmed",
            "confirmed", "task_start", "task_end", "DatetimeFileHandler",
+           "BufferedDatetimeFileHandler", "open_log_handler",
            "modify", 'hold_acquire', 'hold_release', 'reservation_altered',
            'node_up', 'node_down']
 
@@ -637,6 +645,19 @@ def node_down(node, reason, job_id=None, user=None, resource=RESOURCE_NAME):
     return entry("ND", node, message)
 
 
+# strftime directives by the period over which they change, shortest first
+_PATTERN_PERIODS = [(1, "cSsTXrf"), (60, "MR"), (3600, "HIp")]
+
+def _pattern_period (file_pattern):
+    """Return the seconds between possible changes of a strftime pattern: a
+    second, minute or hour if it names one, otherwise a day."""
+    directives = set(re.findall("%(.)", file_pattern.replace("%%", "")))
+    for period, changing in _PATTERN_PERIODS:
+        if directives.intersection(changing):
+            return period
+    return 86400
+
+
 class DatetimeFileHandler (BaseRotatingHandler):
 
     """A log file handler that rotates logs based on the current date/time.
@@ -646,7 +667,9 @@ class DatetimeFileHandler (BaseRotatingHandler):
 
         DatetimeFileHandler("/var/log/%Y-%m-%d")
 
-    The log will be rotated any time the intended filename changes.
+    The log will be rotated any time the intended filename changes.  The
+    name is only recomputed once the second, minute, hour or day named by
+    the pattern's smallest unit has passed.
 
     Arguments:
     file_pattern -- the pattern to be passed to datetime.now().strftime()
@@ -657,24 +680,150 @@ class DatetimeFileHandler (BaseRotatingHandler):
 
     def __init__ (self, file_pattern, encoding=None):
         self.file_pattern = file_pattern
+        self.period = _pattern_period(file_pattern)
         BaseRotatingHandler.__init__(self, self.get_baseFilename(),
             "a", encoding)
+        self.rollover_at = self.next_rollover(mktime(datetime.now().timetuple()))
 
-    def get_baseFilename (self):
-        return os.path.abspath(datetime.now().strftime(self.file_pattern))
+    def get_baseFilename (self, when=None):
+        if when is None:
+            now = datetime.now()
+        else:
+            now = datetime.fromtimestamp(when)
+        return os.path.abspath(now.strftime(self.file_pattern))
+
+    def next_rollover (self, when):
+        """Return the next time after when that the file name may change."""
+        if self.period < 3600:
+            # every time zone is offset by whole minutes
+            return (int(when) // self.period + 1) * self.period
+        current = datetime.fromtimestamp(when)
+        if self.period == 3600:
+            boundary = current.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        else:
+            boundary = datetime.combine(current.date() + timedelta(days=1), dtime())
+        return mktime(boundary.timetuple())
 
-    def doRollover (self):
+    def doRollover (self, when=None):
         self.stream.close()
-        self.baseFilename = self.get_baseFilename()
+        self.baseFilename = self.get_baseFilename(when)
         if self.encoding:
             self.stream = codecs.open(self.baseFilename, 'w', self.encoding)
         else:
             self.stream = open(self.baseFilename, 'w')
 
     def shouldRollover (self, record):
+        if record.created < self.rollover_at:
+            return False
+        self.rollover_at = self.next_rollover(record.created)
         return self.baseFilename != self.get_baseFilename()
 
 
+class BufferedDatetimeFileHandler (DatetimeFileHandler):
+
+    """A DatetimeFileHandler that leaves writing the log to a thread.
+
+    Records are formatted as they are logged and queued.  The writer thread
+    writes whatever has queued at least every flush_interval seconds, each
+    record to the file named for the time it was logged, so a record is on
+    disk (or, without fsync, with the OS) at most about flush_interval
+    seconds after it was logged.  flush waits for everything queued so far.
+
+    Arguments:
+    file_pattern -- the pattern to be passed to datetime.now().strftime()
+
+    Keyword arguments:
+    flush_interval -- most seconds a record waits to be written
+    fsync -- sync the file to disk after each write
+    encoding -- see FileHandler
+    """
+
+    def __init__ (self, file_pattern, flush_interval=1.0, fsync=False, encoding=None):
+        DatetimeFileHandler.__init__(self, file_pattern, encoding)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._pending = deque()
+        self._queued = 0
+        self._written = 0
+        self._flush_target = 0
+        self._closing = False
+        self._cond = threading.Condition(threading.Lock())
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def emit (self, record):
+        try:
+            text = self.format(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+            return
+        with self._cond:
+            self._pending.append((record.created, text))
+            self._queued += 1
+
+    def flush (self):
+        """Wait until the records queued so far are written."""
+        with self._cond:
+            target = self._queued
+            # the writer may not be waiting yet; it checks the target before it does
+            self._flush_target = max(self._flush_target, target)
+            self._cond.notify_all()
+            while self._written < target and self._writer.isAlive():
+                self._cond.wait(self.flush_interval)
+
+    def close (self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._writer.join()
+        DatetimeFileHandler.close(self)
+
+    def _write_loop (self):
+        while True:
+            with self._cond:
+                if not self._closing and self._flush_target <= self._written:
+                    self._cond.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = deque()
+                closing = self._closing
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    # as logging does for a failing handler, report and carry on
+                    traceback.print_exc()
+            with self._cond:
+                self._written += len(batch)
+                self._cond.notify_all()
+            if closing:
+                return
+
+    def _write (self, batch):
+        for created, text in batch:
+            if created >= self.rollover_at:
+                self.rollover_at = self.next_rollover(created)
+                if self.baseFilename != self.get_baseFilename(created):
+                    self.doRollover(created)
+            self.stream.write(text + "\n")
+        self.stream.flush()
+        if self.fsync:
+            os.fsync(self.stream.fileno())
+
+
+def open_log_handler (file_pattern):
+    """Return the handler for an accounting log, as configured in the
+    [accounting] section: buffered by a writer thread when flush_interval is
+    greater than 0, otherwise written as each record is logged."""
+    flush_interval = float(get_config_option('accounting', 'flush_interval', 0))
+    if flush_interval > 0:
+        fsync = str(get_config_option('accounting', 'fsync', 'false')).lower() in ('true', 'yes', '1', 'on')
+        return BufferedDatetimeFileHandler(file_pattern, flush_interval, fsync)
+    return DatetimeFileHandler(file_pattern)
+
+
 def entry (record_type, id_string, message=None):
 
     """Generate an entry in a PBS accounting log.
@@ -701,37 +850,42 @@ def entry_ (datetime_, record_type, id_string, message):
     message -- dictionary containing appropriate message data
     """
 
-    assert record_type in RECORD_MAPPING.values(), "invalid record_type %r" % record_type
+    assert record_type in RECORD_TYPES, "invalid record_type %r" % record_type
     datetime_s = datetime_.strftime("%m/%d/%Y %H:%M:%S")
     message_text = serialize_message(message)
     return "%s;%s;%s;%s" % (datetime_s, record_type, id_string, message_text)
 
 
 def serialize_message (message):
-    message = message.copy()
-    for keyword, value in message.items():
-        try:
-            items = value.items()
-        except AttributeError:
-            pass
-        else:
-            del message[keyword]
-            for keyword_, value_ in items:
-                message['%s.%s' % (keyword, keyword_)] = value_
-    for keyword, value in message.items():
-        if isinstance(value, basestring):
-            if ' ' in value or '"' in value or "," in value:
-                message[keyword] = '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    fields = []
+    for keyword, value in message.iteritems():
+        items = getattr(value, 'items', None)
+        if items is None:
+            fields.append((keyword, serialize_value(value)))
         else:
-            for f in (serialize_list, serialize_dt, serialize_td):
-                try:
-                    message[keyword] = f(message[keyword])
-                except ValueError:
-                    continue
-                else:
-                    break
-    return " ".join("%s=%s" % (keyword, value)
-        for (keyword, value) in sorted(message.items()))
+            # nested dictionaries are flattened to keyword.keyword_
+            for keyword_, value_ in items():
+                fields.append(('%s.%s' % (keyword, keyword_), serialize_value(value_)))
+    fields.sort()
+    return " ".join(["%s=%s" % field for field in fields])
+
+
+# values written as they are, without trying each serializer
+_PLAIN_TYPES = frozenset([int, long, float, bool, type(None)])
+
+def serialize_value (value):
+    if isinstance(value, basestring):
+        if ' ' in value or '"' in value or "," in value:
+            return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return value
+    if type(value) in _PLAIN_TYPES:
+        return value
+    for f in (serialize_list, serialize_dt, serialize_td):
+        try:
+            return f(value)
+        except ValueError:
+            continue
+    return value
 
 
 def serialize_list (list_):
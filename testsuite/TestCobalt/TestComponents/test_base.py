@@ -1,9 +1,15 @@
 # Copyright 2017 UChicago Argonne, LLC. All rights reserved.
 # Licensed under a modified BSD 3-clause license. See LICENSE for details.
 import logging
+import threading
+import os
+import tempfile
+import shutil
 
-from Cobalt.Components.base import Component, exposed, automatic
+from Cobalt.Components.base import Component, exposed, automatic, readonly
+from Cobalt.Statistics import Statistics, process_statistics
 import Cobalt.Proxy
+import Cobalt.Util
 import time, random
 from TestCobalt.Utilities.Time import timeout
 
@@ -35,8 +41,8 @@ class TestComponent (object):
         assert component.method2.exposed
         assert not getattr(component.method3, "exposed", False)
         exposed_methods = component.listMethods()
-        assert set(exposed_methods) == set(['get_implementation', 'get_name', 'get_statistics', 'listMethods', 'method1',
-            'method2', 'methodHelp', 'save'])
+        assert set(exposed_methods) == set(['get_implementation', 'get_latency_histograms', 'get_metrics', 'get_name',
+            'get_statistics', 'listMethods', 'method1', 'method2', 'methodHelp', 'save'])
         assert component._dispatch("method1", (), {}) == "return1"
         assert component._dispatch("method2", (), {}) == "return2"
         try:
@@ -69,3 +75,159 @@ class TestComponent (object):
         while len(component.m4data) > 1:
             assert component.m4data[1] - component.m4data[0] > 4
             component.m4data = component.m4data[1:]
+
+    def test_task_scheduler (self):
+
+        class TestComponent (Component):
+
+            runs = dict(fast=0, slow=0)
+
+            # when the export last ran is shared by every component in the
+            # process, so it could fall due in the middle of this test
+            def _export_metrics (self):
+                pass
+
+            def fast (self):
+                self.runs['fast'] += 1
+            fast = automatic(fast, 0.5)
+
+            def slow (self):
+                self.runs['slow'] += 1
+            slow = automatic(slow, 3600)
+
+        component = TestComponent(register=False)
+        component.do_tasks()
+        assert component.runs == dict(fast=1, slow=1)
+        assert 0 < component.next_task_due() - time.time() <= 0.5
+        start = time.time()
+        component.wait_for_tasks()
+        assert 0.3 < time.time() - start < 2, "did not wait for the next task"
+        component.do_tasks()
+        assert component.runs == dict(fast=2, slow=1)
+        component.wake_tasks('slow')
+        start = time.time()
+        component.wait_for_tasks()
+        assert time.time() - start < 0.3, "wait not interrupted"
+        component.do_tasks()
+        assert component.runs['slow'] == 2
+        stats = component.statistics.data
+        assert stats['fast.lateness'].count == 2
+        assert 'fast' in component.get_latency_histograms()
+
+    def test_readonly_shares_lock (self):
+
+        class TestComponent (Component):
+
+            def __init__ (self, **kwargs):
+                Component.__init__(self, **kwargs)
+                self.entered = dict(first=threading.Event(), second=threading.Event())
+                self.release = threading.Event()
+
+            def read (self, name):
+                self.entered[name].set()
+                self.release.wait(10)
+                return "read"
+            read = exposed(readonly(read))
+
+            def write (self):
+                return "write"
+            write = exposed(write)
+
+        component = TestComponent(register=False)
+        readers = [threading.Thread(target=component._dispatch, args=("read", (name,), {}))
+                for name in ['first', 'second']]
+        for reader in readers:
+            reader.start()
+        try:
+            assert component.entered['first'].wait(10), "first reader did not run"
+            assert component.entered['second'].wait(10), "readers did not share the lock"
+        finally:
+            component.release.set()
+            for reader in readers:
+                reader.join()
+        assert component._dispatch("write", (), {}) == "write"
+        stats = component.statistics.data
+        for name in ['read', 'read.lock_wait', 'read.lock_held', 'write.lock_wait', 'write.lock_held',
+                'component_read_lock_wait', 'component_lock_wait']:
+            assert name in stats, "missing statistic %s" % name
+        assert stats['read.lock_wait'].count == 2
+
+    def test_latency_histograms (self):
+
+        class TestComponent (Component):
+
+            def method (self):
+                return "method"
+            method = exposed(method)
+
+        component = TestComponent(register=False)
+        for _ in range(3):
+            component._dispatch("method", (), {})
+        histogram = component.get_latency_histograms()['method']
+        assert histogram['count'] == 3
+        assert histogram['buckets'][-1] == ["+Inf", 3]
+        assert [count for _, count in histogram['buckets']] == sorted(count for _, count in histogram['buckets'])
+
+    def test_metrics (self):
+
+        class TestComponent (Component):
+
+            name = 'metrics-test'
+
+            def method (self, value):
+                return value
+            method = exposed(method)
+
+        component = TestComponent(register=False)
+        for _ in range(3):
+            component._dispatch("method", (1,), {})
+        metrics = component.get_metrics()
+        for name in ['method', 'method.lock_wait', 'component_lock_wait']:
+            assert name in metrics, "missing metric %s" % name
+        assert metrics['method']['count'] == 3
+        assert metrics['method']['window']['count'] == 3
+        statistics = Statistics()
+        for value in range(1, 1001):
+            statistics.add_latency('latency', value / 1000.0)
+        latency = statistics.get_metrics()['latency']
+        for name, expected in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)]:
+            assert abs(latency[name] - expected) <= expected / 16, "bad %s %s" % (name, latency[name])
+        assert latency['window']['count'] == 1000
+        assert statistics.metrics['latency'].window(60, time.time() + 3600).count == 0
+
+    def test_export_metrics (self):
+
+        class TestComponent (Component):
+
+            name = 'metrics-test'
+
+        directory = tempfile.mkdtemp()
+        Cobalt.Util.init_cobalt_config()
+        config = Cobalt.Util.config
+        try:
+            if not config.has_section('metrics'):
+                config.add_section('metrics')
+            config.set('metrics', 'prometheus_dir', directory)
+            component = TestComponent(register=False)
+            component.statistics.add_latency('method', 0.02)
+            # the process statistics are shared by every run of this test
+            latency = process_statistics.metrics.get('call.export-test')
+            calls = latency.total.count + 1 if latency else 1
+            process_statistics.add_latency('call.export-test', 0.2)
+            component._export_metrics()
+            lines = open(os.path.join(directory, 'metrics-test.prom')).read().splitlines()
+        finally:
+            config.remove_option('metrics', 'prometheus_dir')
+            shutil.rmtree(directory)
+        assert '# TYPE cobalt_latency_seconds histogram' in lines
+        assert 'cobalt_latency_seconds_count{component="metrics-test",name="method"} 1' in lines
+        assert 'cobalt_latency_seconds_bucket{component="metrics-test",name="method",le="0.025"} 1' in lines
+        assert 'cobalt_latency_seconds_count{component="metrics-test",name="call.export-test"} %d' % calls in lines
+        # each family's samples follow its own HELP and TYPE lines
+        families = []
+        for line in lines:
+            family = line.split()[2] if line.startswith('#') else line.split('{')[0].replace('_bucket', '')
+            family = family.replace('_sum', '').replace('_count', '')
+            if not families or families[-1] != family:
+                families.append(family)
+        assert families == ['cobalt_latency_seconds', 'cobalt_latency_window_seconds'], families
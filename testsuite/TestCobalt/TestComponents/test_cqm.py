@@ -37,6 +37,7 @@ import os.path
 import pwd
 import grp
 import tempfile
+import threading
 import time
 from threading import Lock, Condition
 import traceback
@@ -47,6 +48,7 @@ import xmlrpclib
 from mock import patch
 
 import Cobalt.Components.cqm
+import Cobalt.Checkpoint
 from Cobalt.Components.base import Component, exposed, automatic, query
 from Cobalt.Components.cqm import QueueManager, Signal_Map, Job
 from Cobalt.Components.slp import TimingServiceLocator
@@ -296,6 +298,261 @@ class TestCQMJobManagement (TestCQMComponent):
         results = self.cqm.get_jobs([{'tag':"job", 'jobname':"hello"}])
         assert len(results) == 1
 
+    def test_job_index_follows_queue_changes(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
+
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"wally"}])
+        [job] = self.cqm.get_jobs([{'tag':"job", 'user':"wally"}])
+
+        self.cqm.set_jobs([{'tag':"job", 'jobid':job.jobid}], {'queue':"foo"})
+        assert self.cqm.get_jobs([{'jobid':job.jobid, 'queue':"foo"}]) == [job]
+        assert self.cqm.get_jobs([{'queue':"default", 'user':"wally"}]) == []
+        assert self.cqm.Queues['foo'].jobs.q_get([{'jobid':job.jobid}]) == [job]
+
+        self.cqm.add_queues([{'tag':"queue", 'name':"bar"}])
+        self.cqm.add_jobs([{'tag':"job", 'queue':"bar", 'user':"wally"}])
+        assert len(self.cqm.get_jobs([{'user':"wally"}])) == 2
+
+        self.cqm.del_queues([{'name':"foo"}], force=True)
+        assert self.cqm.get_jobs([{'jobid':job.jobid}]) == []
+        assert len(self.cqm.get_jobs([{'user':"wally"}])) == 1
+
+    def test_get_jobs_since(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
+        spec = {'tag':"job", 'jobid':"*", 'user':"*", 'queue':"*"}
+
+        [job_a] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        [job_b] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"wally"}])
+        delta = self.cqm.get_jobs_since(0, [spec])
+        assert delta['complete']
+        assert sorted([job['jobid'] for job in delta['items']]) == [job_a.jobid, job_b.jobid]
+        generation = delta['generation']
+
+        delta = self.cqm.get_jobs_since(generation, [spec])
+        assert not delta['complete']
+        assert delta['items'] == [] and delta['deleted'] == []
+        generation = delta['generation']
+
+        [job_c] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        self.cqm.set_jobs([{'tag':"job", 'jobid':job_b.jobid}], {'queue':"foo"})
+        self.cqm.del_jobs([{'tag':"job", 'jobid':job_a.jobid}], force=True)
+        delta = self.cqm.get_jobs_since(generation, [spec])
+        assert not delta['complete']
+        assert sorted([job['jobid'] for job in delta['items']]) == [job_b.jobid, job_c.jobid]
+        assert [job['queue'] for job in delta['items'] if job['jobid'] == job_b.jobid] == ["foo"]
+        assert delta['deleted'] == [job_a.jobid]
+        generation = delta['generation']
+
+        # jobs that stop matching are reported as deleted
+        self.cqm.set_jobs([{'tag':"job", 'jobid':job_c.jobid}], {'user_hold':True}, "dilbert")
+        delta = self.cqm.get_jobs_since(generation, [{'tag':"job", 'jobid':"*", 'state':"queued"}])
+        assert delta['items'] == [] and delta['deleted'] == [job_c.jobid]
+
+        # a generation from before a restart gets a complete snapshot, even once the new feed has handed out as many
+        self.cqm.add_queues([{'tag':"queue", 'name':"bar"}])
+        self.cqm.Queues.__dict__.pop('_job_feed')
+        for _ in range(10):
+            self.cqm.get_jobs_since(0, [spec])
+        delta = self.cqm.get_jobs_since(generation, [spec])
+        assert delta['complete']
+        assert sorted([job['jobid'] for job in delta['items']]) == [job_b.jobid, job_c.jobid]
+        assert delta['generation'].split('.')[0] != generation.split('.')[0]
+        # as do generations that are not this queue manager's
+        for stale in [12, "bogus", "%s.x" % generation.split('.')[0]]:
+            assert self.cqm.get_jobs_since(stale, [spec])['complete']
+
+    def test_get_jobs_from_snapshot(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [job_a] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        spec = {'tag':"job", 'jobid':"*", 'user':"*", 'queue':"*"}
+        with patch.object(Cobalt.Components.cqm, 'SNAPSHOT_MAX_AGE', 60):
+            [record] = self.cqm.get_jobs([{'tag':"job", 'jobid':job_a.jobid, 'user':"*"}])
+            assert record is not job_a
+            assert record.to_rx(['jobid', 'user']) == {'jobid':job_a.jobid, 'user':"dilbert"}
+
+            # changes are not seen until the snapshot is older than the bound
+            [job_b] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"wally"}])
+            self.cqm.set_jobs([{'tag':"job", 'jobid':job_a.jobid}], {'user_list':["dilbert", "dogbert"]})
+            assert [r.jobid for r in self.cqm.get_jobs([spec])] == [job_a.jobid]
+            assert self.cqm.get_jobs([{'tag':"job", 'jobid':"*", 'user':"dogbert"}]) == []
+
+            self.cqm._snapshots['jobs'].time -= 61
+            assert sorted([r.jobid for r in self.cqm.get_jobs([spec])]) == [job_a.jobid, job_b.jobid]
+            assert [r.jobid for r in self.cqm.get_jobs([{'tag':"job", 'jobid':"*", 'user':"dogbert"}])] == [job_a.jobid]
+            [queue] = self.cqm.get_queues([{'tag':"queue", 'name':"*"}])
+            assert queue.name == "default"
+
+    def test_get_jobs_options(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        jobs = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':user, 'walltime':walltime}
+            for user, walltime in [("dilbert", 30), ("wally", 10), ("dogbert", 20), ("wally", 40)]])
+        jobids = [job.jobid for job in jobs]
+        spec = {'tag':"job", 'jobid':"*", 'user':"*", 'walltime':"*"}
+        options = {'where':[['walltime', '>', 15], ['user', 'prefix', "d"]], 'sort':['-walltime']}
+        assert [job.jobid for job in self.cqm.get_jobs([spec], options)] == [jobids[0], jobids[2]]
+        options = {'where':[['user', 'in', ["wally", "dogbert"]]], 'sort':['walltime'], 'offset':1, 'limit':1}
+        assert [job.jobid for job in self.cqm.get_jobs([spec], options)] == [jobids[2]]
+        assert self.cqm.count_jobs([spec], options) == 3
+        assert self.cqm.count_jobs([spec]) == 4
+        assert [queue.name for queue in self.cqm.get_queues([{'tag':"queue", 'name':"*"}], {'sort':['name']})] == \
+                ["default"]
+        assert self.cqm.count_queues([{'tag':"queue", 'name':"*"}], {'where':[['name', '!=', "default"]]}) == 0
+
+    def test_checkpoint_journal(self):
+        statefile = tempfile.mktemp()
+        journal = Cobalt.Checkpoint.StateJournal(statefile, snapshot_interval=3600)
+        try:
+            self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+            jobs = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':user} for user in ["dilbert", "wally"]])
+            assert journal.checkpoint(self.cqm, self.cqm.checkpoint_feed())[1], "first checkpoint not a snapshot"
+            self.cqm.set_jobs([{'tag':"job", 'jobid':jobs[0].jobid}], {'user_hold':True})
+            self.cqm.del_jobs([{'tag':"job", 'jobid':jobs[1].jobid}], force=True)
+            [new_job] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dogbert"}])
+            assert not journal.checkpoint(self.cqm, self.cqm.checkpoint_feed())[1], "second checkpoint not journaled"
+            journal.flush()
+            loaded = Cobalt.Checkpoint.load_state(statefile)
+            spec = {'tag':"job", 'jobid':"*", 'user':"*", 'user_hold':"*"}
+            assert sorted([(job.jobid, job.user, job.user_hold) for job in loaded.get_jobs([spec])]) == \
+                    [(jobs[0].jobid, "dilbert", True), (new_job.jobid, "dogbert", False)]
+            assert loaded.Queues['default'].jobs[0] is loaded.get_jobs([{'tag':"job", 'jobid':jobs[0].jobid}])[0]
+        finally:
+            journal.close()
+            for name in [statefile, statefile + ".journal"]:
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    def test_wait_jobs(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [job_a, job_b] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':user} for user in ["dilbert", "wally"]])
+        spec = [{'tag':"job", 'jobid':"*"}]
+        start = time.time()
+        assert sorted(self.cqm.wait_jobs(spec, 'started', 0.2)) == [job_a.jobid, job_b.jobid]
+        assert time.time() - start >= 0.2
+
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(
+            self.cqm.wait_jobs([{'tag':"job", 'jobid':job_a.jobid}], 'done', 30)))
+        waiter.start()
+        time.sleep(0.2)
+        start = time.time()
+        self.cqm.del_jobs([{'tag':"job", 'jobid':job_a.jobid}], force=True)
+        waiter.join(30)
+        assert results == [[]], "waiter not released: %s" % (results,)
+        assert time.time() - start < 5
+        assert self.cqm.wait_jobs(spec, 'done', 0) == [job_b.jobid]
+        assert self.cqm.wait_jobs([{'tag':"job", 'jobid':job_a.jobid}], 'done', 30) == []
+
+    def test_wait_jobs_max_waiters(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [job] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        spec = [{'tag':"job", 'jobid':job.jobid}]
+        with patch.object(Cobalt.Components.cqm, 'WAIT_JOBS_MAX_WAITERS', 1):
+            waiter = threading.Thread(target=self.cqm.wait_jobs, args=(spec, 'done', 30))
+            waiter.start()
+            time.sleep(0.2)
+            start = time.time()
+            assert self.cqm.wait_jobs(spec, 'done', 30) == [job.jobid]
+            assert time.time() - start < 5
+            self.cqm.del_jobs(spec, force=True)
+            waiter.join(30)
+        assert Cobalt.Components.cqm.job_waits.waiters == 0
+
+    @raises(QueueError)
+    def test_wait_jobs_bad_condition(self):
+        self.cqm.wait_jobs([{'tag':"job", 'jobid':"*"}], 'gone', 0)
+
+    def test_dep_fail_follows_dependencies(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+
+        [job_a] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        [job_b] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert",
+            'all_dependencies':str(job_a.jobid)}])
+        [job_c] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert",
+            'all_dependencies':"%s:999999" % job_a.jobid}])
+        assert not job_b.dep_fail
+        assert job_c.dep_fail
+        assert job_b.state == "dep_hold"
+        assert job_c.state == "dep_fail"
+        assert set(self.cqm.dep_graph.get_dependents(job_a.jobid)) == set([job_b, job_c])
+
+        self.cqm.set_jobs([{'tag':"job", 'jobid':job_c.jobid}], {'all_dependencies':[str(job_a.jobid)]})
+        assert not job_c.dep_fail
+        assert job_c.state == "dep_hold"
+
+        self.cqm.del_jobs([{'tag':"job", 'jobid':job_a.jobid}], force=True)
+        assert job_b.dep_fail
+        assert job_c.dep_fail
+        assert set(self.cqm.dep_graph.get_dependents(job_a.jobid)) == set([job_b, job_c])
+
+        self.cqm.set_jobs([{'tag':"job", 'jobid':job_b.jobid}], {'dep_hold':False})
+        assert not job_b.dep_fail
+        assert job_b.state == "queued"
+        assert job_b not in self.cqm.dep_graph.get_dependents(job_a.jobid)
+
+    def test_check_all_dep_fail(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [job_a] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert"}])
+        [job_b] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"dilbert",
+            'all_dependencies':str(job_a.jobid)}])
+        # a removal the dependency graph does not hear about
+        self.cqm.Queues['default'].jobs.remove(job_a)
+        assert not job_b.dep_fail
+        self.cqm.check_all_dep_fail()
+        assert job_b.dep_fail
+
+    def test_utility_scores(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"prio"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"big"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"small"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"broken"}])
+        self.cqm.set_queues([{'tag':"queue", 'name':"prio"}], {'priority':5, 'policy':"high_prio"})
+        self.cqm.set_queues([{'tag':"queue", 'name':"default"}], {'priority':2})
+        self.cqm.set_queues([{'tag':"queue", 'name':"big"}], {'policy':"by_size"})
+        self.cqm.set_queues([{'tag':"queue", 'name':"small"}], {'policy':"by_size_scalar"})
+        self.cqm.set_queues([{'tag':"queue", 'name':"broken"}], {'policy':"broken"})
+        self.cqm.set_queues([{'tag':"queue", 'name':"*"}], {'state':"running"})
+
+        utility_fd, utility_file = tempfile.mkstemp()
+        os.write(utility_fd, "@vectorized\n"
+                             "def by_size():\n"
+                             "    return size * 2 + queue_priority\n"
+                             "def by_size_scalar():\n"
+                             "    return math.sqrt(size)\n"
+                             "def broken():\n"
+                             "    return 'not a number'\n")
+        os.close(utility_fd)
+        try:
+            with patch.object(Cobalt.Components.cqm, 'get_bgsched_config', return_value=utility_file):
+                self.cqm.define_user_utility_functions()
+        finally:
+            os.unlink(utility_file)
+
+        jobs = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'nodes':1},
+                                  {'tag':"job", 'queue':"prio", 'nodes':1},
+                                  {'tag':"job", 'queue':"big", 'nodes':3},
+                                  {'tag':"job", 'queue':"big", 'nodes':4},
+                                  {'tag':"job", 'queue':"small", 'nodes':16}])
+        for numpy in [Cobalt.Components.cqm.numpy, None]:
+            for job in jobs:
+                job.score = 0.0
+            with patch.object(Cobalt.Components.cqm, 'numpy', numpy):
+                self.cqm.compute_utility_scores()
+            assert [job.score for job in jobs] == [2.1, 1.0, 6.0, 8.0, 4.0], [job.score for job in jobs]
+
+        # a utility function that misbehaves discards the whole pass and is replaced by the default policy
+        [broken_job] = self.cqm.add_jobs([{'tag':"job", 'queue':"broken", 'nodes':1}])
+        self.cqm.compute_utility_scores()
+        assert [job.score for job in jobs] == [2.1, 1.0, 6.0, 8.0, 4.0]
+        assert broken_job.score == 0.0
+        assert self.cqm.user_utility_functions['broken'] is self.cqm.builtin_utility_functions['default']
+        self.cqm.compute_utility_scores()
+        assert [job.score for job in jobs] == [4.2, 2.0, 12.0, 16.0, 8.0]
+        assert broken_job.score == 0.1
+
     def test_set_jobid(self):
         # create a local QueueManager so that we can be sure no jobids have been used
         id = Cobalt.Components.cqm.cqm_id_gen.get() + 10
@@ -36,6 +36,7 @@ import Cobalt.Exceptions
 import time
 import Cobalt.Components.system
 from Cobalt.Components.system.CraySystem import CraySystem
+from Cobalt.Components.system.NodeStateIndex import nids_to_bitmap, bitmap_to_nids, bitmap_count
 from Cobalt.Components.system.base_pg_manager import ProcessGroupManager
 import Cobalt.Components.system.AlpsBridge as AlpsBridge
 
@@ -421,6 +422,40 @@ class TestCraySystem(object):
                 drain_time=100.0)
         assert_match(sorted(nodelist), ['4', '5'], "Bad Nodelist")
 
+    def test__assemble_queue_data_ssd_required(self):
+        '''CraySystem._assemble_queue_data: nodes without a large enough SSD excluded'''
+        for i in range(1, 6):
+            self.system.nodes[str(i)].attributes['ssd_enabled'] = int(i != 2)
+            self.system.nodes[str(i)].attributes['ssd_info'] = {'size': (i * 100) * 1000000000}
+        self.system._gen_node_to_queue()
+        self.base_job['attrs'] = {'ssds': 'required', 'ssd_size': 300}
+        nodelist = self.system._assemble_queue_data(self.base_job)
+        assert_match(nodelist, ['3', '4', '5'], "Bad Nodelist")
+
+    def test_node_index_tracks_node_changes(self):
+        '''CraySystem.node_index: status and drain changes on nodes are indexed'''
+        index = self.system.node_index
+        self.system.nodes['2'].status = 'busy'
+        self.system.nodes['4'].set_drain(100.0, 2)
+        assert_match(bitmap_to_nids(index.status('idle')), ['1', '3', '4', '5'], "Bad idle nodes")
+        assert_match(bitmap_to_nids(index.status('busy')), ['2'], "Bad busy nodes")
+        assert_match(bitmap_to_nids(index.draining_before(101)), ['4'], "Bad draining nodes")
+        assert_match(index.draining_before(100), 0, "Bad draining nodes")
+        self.system.nodes['4'].clear_drain()
+        assert_match(index.draining, 0, "Drain not cleared")
+        self.system.nodes['2'].status = 'idle'
+        assert_match(bitmap_to_nids(index.status('idle')), ['1', '2', '3', '4', '5'], "Bad idle nodes")
+
+    def test_node_index_queue_change(self):
+        '''CraySystem.node_index: queue changes indexed on regeneration'''
+        self.system.nodes['1'].queues = ['foo']
+        self.system.nodes['2'].queues = ['foo', 'default']
+        self.system._gen_node_to_queue()
+        index = self.system.node_index
+        assert_match(bitmap_to_nids(index.queue('foo')), ['1', '2'], "Bad foo nodes")
+        assert_match(bitmap_to_nids(index.queue('default')), ['2', '3', '4', '5'], "Bad default nodes")
+        assert_match(index.queue('bar'), 0, "Bad bar nodes")
+
     def test_find_queue_equivalence_classes_single(self):
         '''CraySystem.find_queue_equivalence_classes: single queue'''
         self.system._gen_node_to_queue()
@@ -755,6 +790,35 @@ class TestCraySystem(object):
         assert self.system.nodes['1'].reserved_until == 800.0, (
                 'reserved until expected 800.0, got %s' % self.system.nodes['1'].reserved_until)
 
+    @patch.object(CraySystem, '_ALPS_reserve_resources', fake_reserve)
+    @patch.object(time, 'time', return_value=500.000)
+    def test_find_job_location_allocate_multiple(self, *args, **kwargs):
+        '''CraySystem.find_job_locaton: Assign several jobs in one pass'''
+        Cobalt.Components.system.CraySystem.DRAIN_MODE = "first-fit"
+        jobs = []
+        for jobid, nodes in [(1, 2), (2, 4), (3, 1), (4, 2), (5, 1)]:
+            jobs.append(dict(self.base_job))
+            jobs[-1]['jobid'] = jobid
+            jobs[-1]['nodes'] = nodes
+        retval = self.system.find_job_location(jobs, [], [])
+        assert_match(retval, {1: ['1-2'], 3: ['3'], 4: ['4-5']}, 'bad locations')
+        assert_match(self.system.pending_starts, {1: 800.0, 3: 800.0, 4: 800.0}, "bad pending starts")
+        for nid, jobid in [(1, 1), (2, 1), (3, 3), (4, 4), (5, 4)]:
+            assert_match(self.system.nodes[str(nid)].reserved_jobid, jobid, 'Node %s not reserved' % nid)
+
+    @patch.object(CraySystem, '_ALPS_reserve_resources', fake_reserve)
+    @patch.object(time, 'time', return_value=500.000)
+    def test_find_job_location_allocate_max_placements(self, *args, **kwargs):
+        '''CraySystem.find_job_locaton: Limit jobs assigned in one pass'''
+        Cobalt.Components.system.CraySystem.DRAIN_MODE = "first-fit"
+        jobs = []
+        for jobid in range(1, 6):
+            jobs.append(dict(self.base_job))
+            jobs[-1]['jobid'] = jobid
+        with patch.object(Cobalt.Components.system.CraySystem, 'MAX_PLACEMENTS_PER_PASS', 2):
+            retval = self.system.find_job_location(jobs, [], [])
+        assert_match(retval, {1: ['1'], 2: ['2']}, 'bad locations')
+
     @patch.object(CraySystem, '_ALPS_reserve_resources', fake_reserve)
     @patch.object(time, 'time', return_value=500.000)
     def test_find_job_location_allocate_drain_one_eq(self, *args, **kwargs):
@@ -1220,6 +1284,22 @@ class TestCraySystem(object):
         self.system.get_location_statistics("foo")
         assert False, "No exception raised"
 
+class TestNodeStateIndex(object):
+    '''Tests for the bitmap helpers in src/lib/Components/system/NodeStateIndex.py'''
+
+    def test_bitmap_round_trip(self):
+        '''NodeStateIndex: node ids to bitmap and back'''
+        bitmap = nids_to_bitmap(['9', 1, '3', '1024'])
+        assert_match(bitmap, (1 << 1) | (1 << 3) | (1 << 9) | (1 << 1024), "Bad bitmap")
+        assert_match(bitmap_to_nids(bitmap), ['1', '3', '9', '1024'], "Bad node ids")
+        assert_match(bitmap_count(bitmap), 4, "Bad count")
+
+    def test_bitmap_empty(self):
+        '''NodeStateIndex: empty bitmaps'''
+        assert_match(nids_to_bitmap([]), 0, "Bad bitmap")
+        assert_match(bitmap_to_nids(0), [], "Bad node ids")
+        assert_match(bitmap_count(0), 0, "Bad count")
+
 class TestALPSReservation(object):
     '''Tests for the ALPSReservation class in src/lib/Components/system/CraySystem.py'''
 
@@ -1498,3 +1578,76 @@ class TestCraySystem2(object):
         assert test_uns.tripped, "UNS not tripped"
         assert test_ges.tripped, "GES not tripped"
 
+
+class FakeSystemScriptForker(object):
+    '''Answer AlpsBridge forker calls with a child completing on the nth call.'''
+
+    def __init__(self, polls_to_complete=1, wait_supported=True):
+        self.polls_to_complete = polls_to_complete
+        self.wait_supported = wait_supported
+        self.calls = []
+        self.cleaned_up = []
+
+    def fork(self, *args):
+        self.calls.append('fork')
+        return 7
+
+    def _children(self, child_ids):
+        complete = len([call for call in self.calls if call != 'fork']) >= self.polls_to_complete
+        return [{'id': child_ids[0], 'complete': complete, 'lost_child': False, 'exit_status': 0,
+                 'stderr': [], 'stdout_string': 'output' if complete else ''}]
+
+    def wait_children(self, tag, child_ids, timeout):
+        if not self.wait_supported:
+            raise xmlrpclib.Fault(1, 'wait_children')
+        self.calls.append('wait_children')
+        return self._children(child_ids)
+
+    def get_children(self, tag, child_ids):
+        self.calls.append('get_children')
+        return self._children(child_ids)
+
+    def cleanup_children(self, child_ids):
+        self.cleaned_up.extend(child_ids)
+
+class TestAlpsBridge(object):
+    '''Tests for the forker calls in src/lib/Components/system/AlpsBridge.py'''
+
+    def setup(self):
+        AlpsBridge._wait_children_supported = True
+
+    def teardown(self):
+        AlpsBridge._wait_children_supported = True
+
+    @patch.object(AlpsBridge, 'sleep')
+    def test_call_sys_forker_waits_on_forker(self, mock_sleep):
+        '''AlpsBridge._call_sys_forker: wait for completion in the forker'''
+        forker = FakeSystemScriptForker(polls_to_complete=2)
+        with patch.object(AlpsBridge, 'ComponentProxy', return_value=forker):
+            resp = AlpsBridge._call_sys_forker('/bin/apbasil', 'apbridge', 'alps', in_str='<xml/>')
+        assert_match(resp, 'output', "Bad response")
+        assert_match(forker.calls, ['fork', 'wait_children', 'wait_children'], "Bad forker calls")
+        assert_match(forker.cleaned_up, [7], "Child not cleaned up")
+        assert_match(mock_sleep.call_count, 0, "Slept between waits")
+
+    @patch.object(AlpsBridge, 'sleep')
+    def test_call_sys_forker_polls_old_forker(self, mock_sleep):
+        '''AlpsBridge._call_sys_forker: poll forkers without wait_children'''
+        forker = FakeSystemScriptForker(polls_to_complete=2, wait_supported=False)
+        with patch.object(AlpsBridge, 'ComponentProxy', return_value=forker):
+            resp = AlpsBridge._call_sys_forker('/bin/apbasil', 'apbridge', 'alps', in_str='<xml/>')
+        assert_match(resp, 'output', "Bad response")
+        assert_match(forker.calls, ['fork', 'get_children', 'get_children'], "Bad forker calls")
+        assert_match(AlpsBridge._wait_children_supported, False, "wait_children still used")
+        assert_match(mock_sleep.call_count, 1, "Bad poll count")
+
+    def test_call_concurrently(self):
+        '''AlpsBridge.call_concurrently: results in call order'''
+        assert_match(AlpsBridge.call_concurrently(lambda: 1, lambda: 2, lambda: 3), [1, 2, 3], "Bad results")
+
+    @raises(AlpsBridge.ALPSError)
+    def test_call_concurrently_raises(self):
+        '''AlpsBridge.call_concurrently: errors raised to the caller'''
+        def fail():
+            raise AlpsBridge.ALPSError('fail')
+        AlpsBridge.call_concurrently(lambda: 1, fail)
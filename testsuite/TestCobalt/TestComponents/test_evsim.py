@@ -0,0 +1,71 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+"""Tests for the event simulator's event queue.
+
+"""
+import random
+
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+from Cobalt.Components.evsim import EventQueue
+
+def event(unixtime, jobid, ev_type, machine=0):
+    return {'unixtime':unixtime, 'jobid':jobid, 'type':ev_type, 'machine':machine}
+
+class TestEventQueue(object):
+
+    def setup(self):
+        self.events = EventQueue()
+
+    def drain(self):
+        return [(ev['unixtime'], ev['jobid'], ev['type']) for ev in iter(self.events.pop, None)]
+
+    def test_order(self):
+        '''EventQueue: events come out by time, equal times in the order added'''
+        rand = random.Random(3)
+        added = []
+        for count in range(500):
+            ev = event(rand.randint(0, 50), count, 'Q')
+            added.append((ev['unixtime'], ev['jobid'], ev['type']))
+            self.events.push(ev)
+        assert_match(len(self.events), 500, "Bad length")
+        assert_match(self.events.first_event['unixtime'], min(added)[0], "Bad first event")
+        assert_match(self.events.last_time(), max(added)[0], "Bad last time")
+        # a stable sort keeps equal times in insertion order
+        assert_match(self.drain(), sorted(added, key=lambda ev: ev[0]), "Bad order")
+        assert_match(self.events.peek(), None, "Queue not empty")
+
+    def test_update(self):
+        '''EventQueue: update moves the pending event of a job and type'''
+        self.events.push(event(10, 1, 'Q'))
+        self.events.push(event(20, 1, 'E'))
+        self.events.push(event(30, 2, 'E'))
+        self.events.update(event(40, 1, 'E'))
+        self.events.update(event(5, 2, 'E'))
+        self.events.update(event(25, 3, 'E'))
+        assert_match(len(self.events), 4, "Bad length")
+        assert_match(self.events.peek()['jobid'], 2, "Bad next event")
+        assert_match(self.drain(), [(5, 2, 'E'), (10, 1, 'Q'), (25, 3, 'E'), (40, 1, 'E')], "Bad events")
+
+    def test_remove(self):
+        '''EventQueue: removed events are skipped'''
+        self.events.push(event(10, 1, 'E'))
+        self.events.push(event(20, 2, 'E'))
+        assert self.events.remove(0, 1, 'E'), "Event not removed"
+        assert not self.events.remove(0, 1, 'E'), "Event removed twice"
+        assert_match(self.events.smallest(5), [event(20, 2, 'E')], "Bad pending events")
+        assert_match(self.drain(), [(20, 2, 'E')], "Bad events")
+        # a popped event is no longer pending
+        self.events.push(event(30, 3, 'E'))
+        self.events.pop()
+        assert not self.events.remove(0, 3, 'E'), "Popped event removed"
+        assert_match(len(self.events), 0, "Bad length")
+
+    def test_machines(self):
+        '''EventQueue: the same jobid on different machines are different events'''
+        self.events.push(event(10, 1, 'E', 0))
+        self.events.push(event(20, 1, 'E', 1))
+        self.events.update(event(30, 1, 'E', 1))
+        assert_match(len(self.events), 2, "Bad length")
+        assert not self.events.remove(2, 1, 'E'), "Event removed from the wrong machine"
+        assert self.events.remove(0, 1, 'E'), "Event not removed"
+        assert_match(self.drain(), [(30, 1, 'E')], "Bad events")
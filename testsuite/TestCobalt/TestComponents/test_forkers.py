@@ -25,6 +25,7 @@ import os
 import subprocess
 import StringIO
 import sys
+import signal
 
 config_file = Cobalt.CONFIG_FILES[0]
 config_fp = open(config_file, "w")
@@ -57,6 +58,14 @@ class TestChild(Cobalt.Components.base_forker.BaseChild):
     def preexec_last(self):
         pass
 
+def wait_for_fds(fds, timeout):
+    '''Wait for fds to be readable, retrying waits interrupted by SIGCHLD.'''
+    end = time.time() + timeout
+    ready = []
+    while not ready and time.time() < end:
+        ready = Cobalt.Util.wait_readable(fds, end - time.time())
+    return ready
+
 class TestBaseForker(object):
 
     def setup_base_forker(self):
@@ -64,6 +73,10 @@ class TestBaseForker(object):
         self.bf = Cobalt.Components.base_forker.BaseForker()
         self.bf.child_cls = TestChild
 
+    def teardown(self):
+        if getattr(self, 'bf', None) is not None:
+            self.bf.close()
+
     def test_wait_SIGTERM(self):
         # make sure SIGTERM gets sent when marked for death
         self.setup_base_forker()
@@ -91,6 +104,107 @@ class TestBaseForker(object):
         self.bf._wait() #SIGKILL and we're done
         assert self.bf.children[self.child_id].signum == 9, 'Job not SIGKILLed'
 
+    def test_child_exit_wakes_forker(self):
+        # a child exiting makes the SIGCHLD pipe readable and do_tasks reaps it
+        self.setup_base_forker()
+        self.child_id = self.bf.fork(['/bin/true'])
+        assert self.child_id != None, "No child id returned"
+        pid = self.bf.children[self.child_id].pid
+        assert self.bf._children_by_pid[pid] is self.bf.children[self.child_id], "child not mapped by pid"
+        ready = wait_for_fds(self.bf.wakeup_fds(), 5)
+        assert_match(ready, [self.bf._sigchld_pipe[0]], "Forker not woken by child exit")
+        self.bf.do_tasks()
+        child = self.bf.children[self.child_id]
+        assert child.complete, "Child not reaped"
+        assert_match(child.exit_status, 0, "Bad exit status")
+        assert pid not in self.bf._children_by_pid, "Reaped child still mapped by pid"
+        assert_match(self.bf._drain_sigchld_pipe(), False, "SIGCHLD pipe not drained")
+
+    def test_close(self):
+        # closing restores the previous SIGCHLD handler and closes the self-pipe
+        previous = signal.getsignal(signal.SIGCHLD)
+        self.setup_base_forker()
+        fds = self.bf._sigchld_pipe
+        assert signal.getsignal(signal.SIGCHLD) == self.bf._handle_sigchld, "SIGCHLD handler not installed"
+        self.bf.close()
+        assert_match(signal.getsignal(signal.SIGCHLD), previous, "SIGCHLD handler not restored")
+        assert_match(self.bf.wakeup_fds(), [], "SIGCHLD pipe still waited on")
+        for fd in fds:
+            try:
+                os.fstat(fd)
+            except OSError:
+                pass
+            else:
+                assert False, "SIGCHLD pipe fd %d not closed" % (fd,)
+        self.bf.close()
+
+    def test_stdout_read_when_ready(self):
+        # only children with output waiting are read, and all output is kept
+        self.setup_base_forker()
+        self.bf.child_cls = Cobalt.Components.base_forker.BaseChild # redirects stdout in preexec_last
+        self.child_id = self.bf.fork(['/bin/sh', '-c', 'echo first; sleep 1; echo second'], stdout_string=True)
+        idle_id = self.bf.fork(['/bin/sleep', '60'], stdout_string=True)
+        assert_match(len(self.bf._stdout_pipes), 2, "stdout pipes not registered")
+        wait_for_fds([self.bf.children[self.child_id].pipe_read], 5)
+        self.bf._read_stdout_pipe()
+        assert_match(self.bf.children[self.child_id].stdout_string, "first\n", "Bad partial output")
+        timer = time.time() + 10
+        while not self.bf.children[self.child_id].complete and time.time() < timer:
+            Cobalt.Util.wait_readable(self.bf.wakeup_fds(), 1)
+            self.bf.do_tasks()
+        assert_match(self.bf.children[self.child_id].stdout_string, "first\nsecond\n", "Bad output")
+        assert_match(self.bf._stdout_pipes.values(), [self.bf.children[idle_id]], "Reaped child pipe still polled")
+        self.bf.children[idle_id].signal(signal.SIGKILL)
+        wait_for_fds([self.bf._sigchld_pipe[0]], 5)
+        self.bf.do_tasks()
+        assert self.bf.children[idle_id].complete, "Killed child not reaped"
+        assert_match(self.bf._stdout_pipes, {}, "Reaped child pipe still polled")
+
+    def test_wait_children_complete(self):
+        # wait_children returns once the child completes
+        self.setup_base_forker()
+        self.child_id = self.bf.fork(['/bin/sleep', '0.5'])
+        start = time.time()
+        children = self.bf.wait_children(None, [self.child_id], 10)
+        assert time.time() - start < 5, "wait_children did not return on completion"
+        assert_match(children[0]['complete'], True, "Child not complete")
+        assert_match(children[0]['exit_status'], 0, "Bad exit status")
+
+    def test_wait_children_timeout(self):
+        # wait_children gives up after the timeout and reports the running child
+        self.setup_base_forker()
+        self.child_id = self.bf.fork(['/bin/sleep', '60'])
+        start = time.time()
+        children = self.bf.wait_children(None, [self.child_id], 0.5)
+        assert time.time() - start >= 0.5, "wait_children returned early"
+        assert_match(children[0]['complete'], False, "Child complete")
+        self.bf.children[self.child_id].signal(signal.SIGKILL)
+        children = self.bf.wait_children(None, [self.child_id], 5)
+        assert_match(children[0]['signum'], 9, "Child not reaped")
+
+    def test_wait_children_gives_way(self):
+        # a pending request from another client ends the wait
+        self.setup_base_forker()
+        request_fds = os.pipe()
+        self.bf.server_fds = [request_fds[0]]
+        try:
+            os.write(request_fds[1], 'x')
+            self.child_id = self.bf.fork(['/bin/sleep', '60'])
+            start = time.time()
+            children = self.bf.wait_children(None, [self.child_id], 5)
+            assert time.time() - start < 2, "wait_children did not give way"
+            assert_match(children[0]['complete'], False, "Child complete")
+            self.bf.children[self.child_id].signal(signal.SIGKILL)
+        finally:
+            os.close(request_fds[0])
+            os.close(request_fds[1])
+
+    def test_wait_children_unknown_child(self):
+        # unknown children are reported lost without waiting
+        self.setup_base_forker()
+        children = self.bf.wait_children(None, [12345], 5)
+        assert_match(children[0]['lost_child'], True, "Child not lost")
+
 
 class TestUserScriptForker(object):
 
@@ -0,0 +1,103 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+"""Tests for the history manager's walltime adjusting parameters.
+
+"""
+import os
+import random
+import tempfile
+
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+from Cobalt.Components.histm import HistoryManager
+
+def brute_force_Ap(rvalues, least_item, fraction, minimum=None):
+    '''Ap as computed by sorting every R value of a key'''
+    if len(rvalues) > least_item:
+        Ap = sorted(rvalues)[int(fraction * len(rvalues))]
+    else:
+        Ap = 1
+    if minimum is not None and Ap < minimum:
+        Ap = minimum
+    return min(Ap, 1)
+
+class TestHistoryManager(object):
+
+    def setup(self):
+        self.histm = HistoryManager()
+        self.histm.least_item = 2
+        self.histm.lastDays = 1
+        self.jobinfo_file = tempfile.mktemp()
+        self.histm.jobinfo_file = self.jobinfo_file
+        self.histm.reset_history()
+
+    def teardown(self):
+        if os.path.exists(self.jobinfo_file):
+            os.unlink(self.jobinfo_file)
+
+    def write(self, data, mode="a"):
+        jobinfo = open(self.jobinfo_file, mode)
+        jobinfo.write(data)
+        jobinfo.close()
+
+    def test_Ap_matches_sorting(self):
+        '''HistoryManager: incremental Ap matches sorting all R values'''
+        rand = random.Random(5)
+        lines = []
+        for jobid in range(300):
+            lines.append("%d user%d proj%d 1 %.3f\n" % (jobid, rand.randint(0, 3), rand.randint(0, 3), rand.random()))
+        # the second half includes jobs run again with new R values
+        for jobid in range(0, 300, 7):
+            lines.append("%d user%d proj%d 1 %.3f\n" % (jobid, rand.randint(0, 3), rand.randint(0, 3), rand.random()))
+        self.write("".join(lines[:150]))
+        self.histm.update_Ap_Dict()
+        self.write("".join(lines[150:]))
+        self.histm.update_Ap_Dict()
+        jobs = {}
+        for line in lines:
+            jobid, user, project, _, rvalue = line.split()
+            jobs[jobid] = (user, project, float(rvalue))
+        for user in set([job[0] for job in jobs.values()]):
+            expected = brute_force_Ap([job[2] for job in jobs.values() if job[0] == user], 2, self.histm.fraction)
+            assert_match(self.histm.get_Ap('user', user), expected, "Bad Ap for %s" % user)
+        for project in set([job[1] for job in jobs.values()]):
+            expected = brute_force_Ap([job[2] for job in jobs.values() if job[1] == project], 2, self.histm.fraction)
+            assert_match(self.histm.get_Ap('project', project), expected, "Bad Ap for %s" % project)
+        for pair in set([job[:2] for job in jobs.values()]):
+            expected = brute_force_Ap([job[2] for job in jobs.values() if job[:2] == pair], 2, self.histm.fraction,
+                                      self.histm.minimum_ap)
+            assert_match(self.histm.get_Ap_by_keypair(*pair), expected, "Bad Ap for %s" % (pair,))
+
+    def test_appended_lines(self):
+        '''HistoryManager: only complete appended lines are read'''
+        self.write("1 user proj 1 0.2\n2 user proj 1 0.3\n3 user proj 1 0.4\n4 user pr")
+        self.histm.update_Ap_Dict()
+        assert_match(len(self.histm.job_dict), 3, "Bad job count")
+        assert_match(self.histm.get_Ap('user', 'user'), 0.4, "Bad Ap")
+        self.write("oj 1 0.1\n")
+        self.histm.update_Ap_Dict()
+        assert_match(len(self.histm.job_dict), 4, "Appended job not read")
+        assert_match(self.histm.get_Ap('user', 'user'), 0.4, "Bad Ap after append")
+        # a replaced file is read from the start
+        self.write("5 other proj 1 0.5\n", "w")
+        self.histm.update_Ap_Dict()
+        assert_match(sorted(self.histm.job_dict.keys()), ['5'], "Replaced file not read again")
+        assert_match(self.histm.get_Ap_dict('user'), {'other':1}, "Stale Ap kept")
+
+    def test_malformed_lines(self):
+        '''HistoryManager: lines with bad numbers are skipped whole'''
+        self.write("1 user proj 1 0.2\n2 user proj 1 bad\n3 user proj 1 0.3 soon\n4 user proj 1 0.4\n5 user proj 1 0.1\n")
+        self.histm.update_Ap_Dict()
+        assert_match(sorted(self.histm.job_dict.keys()), ['1', '4', '5'], "Malformed lines added")
+        assert_match(self.histm.get_Ap('user', 'user'), 0.4, "Bad Ap")
+
+    def test_last_days(self):
+        '''HistoryManager: jobs that ended more than last_days before the latest are dropped'''
+        day = 86400
+        self.write("1 user proj 1 0.9 %d\n2 user proj 1 0.2 %d\n3 user proj 1 0.3 %d\n" % (0, day, day))
+        self.histm.update_Ap_Dict()
+        assert_match(sorted(self.histm.job_dict.keys()), ['1', '2', '3'], "Bad window")
+        assert_match(self.histm.get_Ap('project', 'proj'), 0.9, "Bad Ap")
+        self.write("4 user proj 1 0.4 %d\n" % (day + 3600))
+        self.histm.update_Ap_Dict()
+        assert_match(sorted(self.histm.job_dict.keys()), ['2', '3', '4'], "Old job not dropped")
+        assert_match(self.histm.get_Ap('project', 'proj'), 0.4, "Bad Ap after window moved")
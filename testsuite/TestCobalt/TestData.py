@@ -3,10 +3,14 @@
 import time
 import itertools
 import warnings
+import cPickle
+import xmlrpclib
 
 from Cobalt.Data import IncrID, RandomID, Data, ForeignData, DataList, \
-     DataDict, ForeignData, ForeignDataDict, DataState
-from Cobalt.Exceptions import DataCreationError, DataStateError, DataStateTransitionError
+     DataDict, ForeignData, ForeignDataDict, DataState, ChangeFeed, DataSnapshot, \
+     query_items, filter_items
+from Cobalt.Exceptions import DataCreationError, DataStateError, DataStateTransitionError, QueryError
+from nose.tools import raises
 
 import Cobalt.Logging
 
@@ -330,6 +334,216 @@ class TestDataDict (object):
         assert self.datadict["three"].tag == "three"
 
 
+class IndexedData (Data):
+    fields = Data.fields + ['name', 'owner', 'state', 'members', 'is_ready']
+    indexed = ['name', 'owner', 'is_ready', 'members']
+    index_triggers = {'state': ['is_ready']}
+
+    def __init__ (self, spec):
+        Data.__init__(self, spec)
+        self.name = spec.get('name')
+        self.owner = spec.get('owner')
+        self.state = spec.get('state', 'queued')
+        self.members = spec.get('members')
+
+    is_ready = property(lambda self: self.state == 'ready')
+
+
+class TestIndexedDataDict (object):
+
+    def setup (self):
+        self.datadict = DataDict()
+        self.datadict.item_cls = IndexedData
+        self.datadict.key = "name"
+        self.datadict.q_add([{'name':"one", 'owner':"alice"},
+                             {'name':"two", 'owner':"bob", 'state':"ready"},
+                             {'name':"three", 'owner':"alice", 'members':['x']}])
+
+    def names (self, items):
+        return sorted([item.name for item in items])
+
+    def test_q_get_indexed (self):
+        assert self.names(self.datadict.q_get([{'owner':"alice"}])) == ["one", "three"]
+        assert self.names(self.datadict.q_get([{'owner':"alice", 'name':"one"}])) == ["one"]
+        assert self.names(self.datadict.q_get([{'owner':"carol"}])) == []
+        assert self.names(self.datadict.q_get([{'owner':"bob"}, {'name':"one"}])) == ["one", "two"]
+
+    def test_q_get_unindexed_fallback (self):
+        assert self.names(self.datadict.q_get([{'tag':"unknown", 'state':"ready"}])) == ["two"]
+        assert self.names(self.datadict.q_get([{'owner':"*"}])) == ["one", "three", "two"]
+
+    def test_unhashable_values (self):
+        assert self.names(self.datadict.q_get([{'members':['x']}])) == ["three"]
+        assert self.names(self.datadict.q_get([{'members':None}])) == ["one", "two"]
+
+    def test_attribute_update (self):
+        assert self.names(self.datadict.q_get([{'owner':"bob"}])) == ["two"]
+        self.datadict['one'].owner = "bob"
+        assert self.names(self.datadict.q_get([{'owner':"bob"}])) == ["one", "two"]
+        assert self.names(self.datadict.q_get([{'owner':"alice"}])) == ["three"]
+
+    def test_trigger_update (self):
+        assert self.names(self.datadict.q_get([{'is_ready':True}])) == ["two"]
+        self.datadict['three'].state = "ready"
+        self.datadict['two'].state = "queued"
+        assert self.names(self.datadict.q_get([{'is_ready':True}])) == ["three"]
+
+    def test_add_del (self):
+        self.datadict.q_get([{'owner':"alice"}])
+        self.datadict.q_add([{'name':"four", 'owner':"alice"}])
+        removed = self.datadict['one']
+        del self.datadict['one']
+        assert self.names(self.datadict.q_get([{'owner':"alice"}])) == ["four", "three"]
+        removed.owner = "bob"
+        assert self.names(self.datadict.q_get([{'owner':"bob"}])) == ["two"]
+        self.datadict.q_del([{'name':"two"}])
+        assert self.names(self.datadict.q_get([{'owner':"bob"}])) == []
+
+    def test_pickle (self):
+        self.datadict.q_get([{'owner':"alice"}])
+        restored = cPickle.loads(cPickle.dumps(self.datadict))
+        assert self.names(restored.q_get([{'owner':"alice"}])) == ["one", "three"]
+        restored['one'].owner = "bob"
+        assert self.names(restored.q_get([{'owner':"bob"}])) == ["one", "two"]
+        assert self.names(self.datadict.q_get([{'owner':"bob"}])) == ["two"]
+
+
+class TestIndexedDataList (object):
+
+    def setup (self):
+        self.datalist = DataList()
+        self.datalist.item_cls = IndexedData
+        self.datalist.q_add([{'name':"one", 'owner':"alice"},
+                             {'name':"two", 'owner':"bob"}])
+
+    def names (self, items):
+        return sorted([item.name for item in items])
+
+    def test_list_operations (self):
+        assert self.names(self.datalist.q_get([{'owner':"alice"}])) == ["one"]
+        moved = self.datalist.q_get([{'name':"two"}])[0]
+        self.datalist.remove(moved)
+        assert self.names(self.datalist.q_get([{'owner':"bob"}])) == []
+        moved.owner = "alice"
+        self.datalist.append(moved)
+        assert self.names(self.datalist.q_get([{'owner':"alice"}])) == ["one", "two"]
+        del self.datalist[0]
+        assert self.names(self.datalist.q_get([{'owner':"alice"}])) == ["two"]
+        self.datalist.q_del([{'owner':"alice"}])
+        assert len(self.datalist) == 0
+
+
+class TestChangeFeed (object):
+
+    def setup (self):
+        self.items = [IndexedData({'name':name}) for name in ["one", "two", "three"]]
+        self.feed = ChangeFeed('name', 100, max_removed=2)
+        for item in self.items:
+            self.feed.add(item)
+
+    def names (self, items):
+        return sorted([item.name for item in items])
+
+    def test_since (self):
+        generation, complete, items, removed = self.feed.since(0)
+        assert complete
+        assert self.names(items) == ["one", "three", "two"]
+        generation, complete, items, removed = self.feed.since(generation)
+        assert not complete
+        assert items == [] and removed == []
+
+        self.items[0].owner = "alice"
+        self.feed.remove(self.items[1])
+        self.items[1].owner = "bob"
+        generation, complete, items, removed = self.feed.since(generation)
+        assert not complete
+        assert self.names(items) == ["one"]
+        assert removed == ["two"]
+
+        # moving an item (remove then add) reports it as changed
+        self.feed.remove(self.items[2])
+        self.feed.add(self.items[2])
+        generation, complete, items, removed = self.feed.since(generation)
+        assert self.names(items) == ["three"]
+        assert removed == []
+
+    def test_stale_generation (self):
+        generation = self.feed.since(0)[0]
+        assert self.feed.since(100)[1]
+        assert self.feed.since(generation + 10)[1]
+        for item in self.items:
+            self.feed.remove(item)
+        generation, complete, items, removed = self.feed.since(generation)
+        assert complete
+        assert items == [] and removed == []
+
+    def test_reset (self):
+        generation = self.feed.since(0)[0]
+        four = IndexedData({'name':"four"})
+        self.feed.reset([self.items[0], four])
+        generation, complete, items, removed = self.feed.since(generation)
+        assert self.names(items) == ["four"]
+        assert sorted(removed) == ["three", "two"]
+
+
+class TestDataSnapshot (object):
+
+    def setup (self):
+        self.items = [IndexedData({'name':name, 'owner':"alice", 'members':[name]}) for name in ["one", "two"]]
+        self.snapshot = DataSnapshot(self.items, IndexedData.indexed)
+
+    def test_q_get (self):
+        records = self.snapshot.q_get([{'name':"one"}])
+        assert [record.name for record in records] == ["one"]
+        assert records[0] is not self.items[0]
+        assert records[0].to_rx(['name', 'is_ready']) == {'name':"one", 'is_ready':False}
+        assert len(self.snapshot.q_get([{'owner':"alice", 'name':"*"}])) == 2
+
+    def test_frozen (self):
+        self.items[0].state = 'ready'
+        self.items[0].members.append("three")
+        assert self.snapshot.q_get([{'is_ready':True}]) == []
+        [record] = self.snapshot.q_get([{'name':"one"}])
+        assert record.members == ["one"]
+
+
+class TestQueryItems (object):
+
+    def setup (self):
+        self.items = [IndexedData({'name':name, 'owner':owner, 'members':size})
+                for name, owner, size in [("one", "alice", 4), ("two", "bob", 2), ("three", "alice", 8),
+                    ("four", None, 2)]]
+
+    def names (self, items):
+        return [item.name for item in items]
+
+    def test_filter (self):
+        assert self.names(filter_items(self.items, [['members', '>=', 4]])) == ["one", "three"]
+        assert self.names(filter_items(self.items, [['owner', 'in', ["bob", None]]])) == ["two", "four"]
+        assert self.names(filter_items(self.items, [['name', 'prefix', "t"], ['members', '<', 8]])) == ["two"]
+        assert self.names(filter_items(self.items, [['owner', 'prefix', "a"]])) == ["one", "three"]
+        assert filter_items(self.items, [['bogus', '!=', 1]]) == []
+
+    def test_sort_and_page (self):
+        options = {'sort':['-members', 'name']}
+        assert self.names(query_items(self.items, options)) == ["three", "one", "four", "two"]
+        options.update(offset=1, limit=2)
+        assert self.names(query_items(self.items, options)) == ["one", "four"]
+        assert query_items(self.items, {'offset':10}) == []
+
+    @raises(QueryError)
+    def test_bad_operator (self):
+        filter_items(self.items, [['members', '=~', 4]])
+
+    @raises(QueryError)
+    def test_bad_in_values (self):
+        filter_items(self.items, [['owner', 'in', "bob"]])
+
+    @raises(QueryError)
+    def test_bad_limit (self):
+        query_items(self.items, {'limit':-1})
+
+
 class TestForeignDataDict (object):
     class my_data (ForeignData):
         fields = ['id', 'value']
@@ -374,3 +588,48 @@ class TestForeignDataDict (object):
         assert f.__oserror__.status == True
         f.Sync()
         assert f.__oserror__.status == False
+
+    def TestSyncDelta(self):
+        deltas = [{'generation':5, 'complete':True, 'deleted':[],
+                   'items':[{'id':1, 'value':'queued'}, {'id':2, 'value':'queued'}]},
+                  {'generation':6, 'complete':False, 'deleted':[1],
+                   'items':[{'id':2, 'value':'hold'}, {'id':3, 'value':'queued'}]},
+                  {'generation':7, 'complete':True, 'deleted':[],
+                   'items':[{'id':3, 'value':'running'}]}]
+        calls = []
+        def delta_function(generation, specs):
+            calls.append(generation)
+            return deltas[len(calls) - 1]
+        f = ForeignDataDict()
+        f.item_cls = self.my_data
+        f.key = 'id'
+        f.__delta_function__ = delta_function
+        f.Sync()
+        assert sorted(f.keys()) == [1, 2]
+        f.Sync()
+        assert sorted(f.keys()) == [2, 3]
+        assert f[2].value == 'hold'
+        f.Sync()
+        assert f.keys() == [3]
+        assert f[3].value == 'running'
+        assert calls == [0, 5, 6]
+
+        # other failures of the delta call leave the cache alone
+        def broken(generation, specs):
+            raise xmlrpclib.Fault(1, "get_jobs_since failed")
+        f.__delta_function__ = broken
+        f.__delta_method__ = 'get_jobs_since'
+        f.__function__ = lambda specs: [{'id':4, 'value':'queued'}]
+        f.Sync()
+        assert f.keys() == [3]
+        assert f.generation == 7
+        assert f.__oserror__.status == False
+
+        # fall back to a full fetch if the other component lacks the delta call
+        def missing(generation, specs):
+            raise xmlrpclib.Fault(7, 'get_jobs_since')
+        f.__delta_function__ = missing
+        f.Sync()
+        assert f.keys() == [4]
+        assert f.generation == 0
+        assert f.__oserror__.status == True
@@ -8,7 +8,7 @@ import ssl
 import ConfigParser
 
 import Cobalt.Server
-from Cobalt.Server import find_intended_location, XMLRPCServer
+from Cobalt.Server import find_intended_location, XMLRPCServer, PooledXMLRPCServer
 from Cobalt.Components.base import Component
 
 cp = ConfigParser.ConfigParser()
@@ -212,3 +212,54 @@ class TestXMLRPCServer_https (XMLRPCServerTester):
     def test_url (self):
         hname = socket.gethostname()
         assert self.server.url == "https://%s:5900" % hname, self.server.url
+
+
+class TestPooledXMLRPCServer (object):
+
+    def setup (self):
+        self._outside_require_auth = Cobalt.Server.XMLRPCRequestHandler.require_auth
+        Cobalt.Server.XMLRPCRequestHandler.require_auth = False
+        self.server = PooledXMLRPCServer(("localhost", 5901), keyfile=keypath, certfile=certpath, cafile=capath,
+                register=False, workers=2, queue_depth=1)
+        self.server.require_auth = False
+        self.server.register_instance(Component(register=False))
+        self.server.serve = True
+        self.server.start_workers()
+        self.poll_thread = threading.Thread(target=self._poll)
+        self.poll_thread.start()
+        self.context = ssl._create_unverified_context()
+        self.proxy = xmlrpclib.ServerProxy("https://localhost:5901", context=self.context)
+
+    def _poll (self):
+        while self.server.serve:
+            self.server._poll()
+
+    def teardown (self):
+        self.server.shutdown()
+        self.poll_thread.join()
+        self.server.stop_workers()
+        self.server.server_close()
+        Cobalt.Server.XMLRPCRequestHandler.require_auth = self._outside_require_auth
+
+    def test_ping (self):
+        sent_args = (1, 5, 8, 2)
+        assert list(self.proxy.ping(*sent_args)) == list(sent_args)
+        assert list(self.proxy.ping(*sent_args)) == list(sent_args)
+
+    def test_queue_wait_recorded (self):
+        self.proxy.ping()
+        assert self.server.instance.statistics.metrics['rpc_queue_wait'].total.count >= 1
+
+    def test_reject_when_full (self):
+        self.server.stop_workers()
+        # one connection fills the queue, the next is turned away
+        waiting = socket.create_connection(("localhost", 5901))
+        try:
+            try:
+                self.proxy.ping()
+            except xmlrpclib.ProtocolError, err:
+                assert err.errcode == 503, err.errcode
+            else:
+                assert not "Request was not rejected."
+        finally:
+            waiting.close()
@@ -6,10 +6,12 @@ import pwd
 import errno
 import tempfile
 import re
+import threading
 NamedTemporaryFile = tempfile.NamedTemporaryFile
 
 import Cobalt.Util
 Timer = Cobalt.Util.Timer
+ReadWriteLock = Cobalt.Util.ReadWriteLock
 disk_writer_thread = Cobalt.Util.disk_writer_thread
 init_cobalt_config = Cobalt.Util.init_cobalt_config
 check_required_options = Cobalt.Util.check_required_options
@@ -383,6 +385,40 @@ setting = 2
         fo.flush()
         return fo.name
 
+class TestReadWriteLock(object):
+    '''Tests for Cobalt.Util.ReadWriteLock'''
+
+    def _acquire_in_thread(self, acquire):
+        acquired = threading.Event()
+        def run():
+            acquire()
+            acquired.set()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return acquired
+
+    def test_readers_share(self):
+        '''ReadWriteLock: readers hold the lock together'''
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        assert self._acquire_in_thread(lock.acquire_read).wait(5), "second reader blocked"
+
+    def test_writer_excludes_readers(self):
+        '''ReadWriteLock: a writer waits for readers and blocks them'''
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        writer = self._acquire_in_thread(lock.acquire)
+        assert not writer.wait(0.2), "writer got in with a reader"
+        reader = self._acquire_in_thread(lock.acquire_read)
+        assert not reader.wait(0.2), "reader got in ahead of a waiting writer"
+        lock.release_read()
+        assert writer.wait(5), "writer never acquired the lock"
+        assert not reader.wait(0.2), "reader got in with a writer"
+        lock.release()
+        assert reader.wait(5), "reader never acquired the lock"
+
+
 class TestMergeNodelist(object):
     '''Tests for Cobalt.Util.merge_nodelist used on cluster systems'''
 
@@ -1,7 +1,10 @@
 # Copyright 2017 UChicago Argonne, LLC. All rights reserved.
 # Licensed under a modified BSD 3-clause license. See LICENSE for details.
 import logging
-from datetime import datetime
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
 import time
 
 # Config options must be initialized prior to importing accounting.
@@ -112,6 +115,58 @@ class TestAccounting (object):
         expected = "01/01/2000 00:00:00;E;123;Exit_status=255 Resource_List.ncpus=None Resource_List.nodect=None Resource_List.walltime=0 args= ctime=0.1 cwd=None end=-2.0 etime=0.3 exe=None exec_host=None group=unknown jobname=N/A mode=co priority_core_hours=0 qtime=0.2 queue=default resource=NOTSET resources_used.location=ANL resources_used.nodect=None resources_used.walltime=0.0 session=unknown start=-1.0 user=None"
         assert_match(log_entry, expected, "Bad End Message.")
 
+    def test_serialize_message (self):
+        message = {'list':["a", "b c"], 'nested':{'when':datetime(2000, 1, 1), 'count':2}, 'time':timedelta(minutes=1),
+                   'text':'say "hi"', 'none':None, 'ints':[1, 2]}
+        expected = 'ints=[1, 2] list=a,"b c" nested.count=2 nested.when=%r none=None text="say \\"hi\\"" time=60.0' % \
+                time.mktime(datetime(2000, 1, 1).timetuple())
+        assert_match(accounting.serialize_message(message), expected, "Bad serialization.")
+
+
+class TestDatetimeFileHandler (object):
+
+    def setup (self):
+        self.log_dir = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.log_dir, "%Y%m%d")
+
+    def teardown (self):
+        shutil.rmtree(self.log_dir)
+
+    def record (self, message, when):
+        record = logging.LogRecord("accounting", logging.INFO, __file__, 0, message, None, None)
+        record.created = when
+        return record
+
+    def read (self, when):
+        return open(datetime.fromtimestamp(when).strftime(self.pattern)).read()
+
+    def test_next_rollover (self):
+        handler = accounting.DatetimeFileHandler(self.pattern)
+        noon = time.mktime(datetime(2000, 1, 1, 12, 30).timetuple())
+        assert_match(handler.next_rollover(noon), time.mktime(datetime(2000, 1, 2).timetuple()), "Bad day boundary")
+        handler.close()
+        handler = accounting.DatetimeFileHandler(os.path.join(self.log_dir, "%Y%m%d%H"))
+        assert_match(handler.next_rollover(noon), time.mktime(datetime(2000, 1, 1, 13).timetuple()), "Bad hour boundary")
+        handler.close()
+        assert_match(accounting._pattern_period("%Y%m%d-%H%M"), 60, "Bad period")
+
+    def test_buffered (self):
+        handler = accounting.BufferedDatetimeFileHandler(self.pattern, flush_interval=5)
+        today = time.time()
+        tomorrow = handler.next_rollover(today) + 1
+        try:
+            handler.handle(self.record("first", today))
+            handler.handle(self.record("second", tomorrow))
+            start = time.time()
+            handler.flush()
+            assert time.time() - start < 2, "flush waited for the flush interval"
+            assert_match(self.read(today), "first\n", "Bad first file")
+            assert_match(self.read(tomorrow), "second\n", "Record not rolled over")
+            handler.handle(self.record("third", tomorrow))
+        finally:
+            handler.close()
+        assert_match(self.read(tomorrow), "second\nthird\n", "Record not written on close")
+
 #from accounting.py
 
 def demo ():
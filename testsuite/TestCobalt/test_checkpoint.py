@@ -0,0 +1,122 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Tests for journaled statefiles in Cobalt.Checkpoint'''
+import os
+import cPickle
+import tempfile
+
+from Cobalt.Checkpoint import StateJournal, load_state
+from Cobalt.Components.base import Component
+from Cobalt.Data import Data, ChangeFeed
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+
+
+class Item(Data):
+    fields = Data.fields + ["name", "value"]
+
+    def __init__(self, name, value, owner=None):
+        Data.__init__(self, {})
+        self.name = name
+        self.value = value
+        self.owner = owner
+
+
+class ItemComponent(Component):
+
+    name = 'checkpoint-test'
+
+    def __init__(self, **kwargs):
+        Component.__init__(self, **kwargs)
+        self.items = []
+        self.feed = ChangeFeed('name')
+
+    def __getstate__(self):
+        state = Component.__getstate__(self)
+        state['items'] = self.items
+        return state
+
+    def __setstate__(self, state):
+        Component.__setstate__(self, state)
+        self.items = state['items']
+        self.feed = ChangeFeed('name')
+        self.feed.reset(self.items)
+
+    def add(self, name, value):
+        item = Item(name, value, self)
+        self.items.append(item)
+        self.feed.add(item)
+        return item
+
+    def remove(self, item):
+        self.items.remove(item)
+        self.feed.remove(item)
+
+
+class TestStateJournal(object):
+    '''Tests for Cobalt.Checkpoint.StateJournal and load_state'''
+
+    def setup(self):
+        self.statefile = tempfile.mktemp()
+        self.journal = StateJournal(self.statefile, snapshot_interval=3600)
+        self.component = ItemComponent(register=False)
+
+    def teardown(self):
+        self.journal.close()
+        for name in [self.statefile, self.statefile + ".journal"]:
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def checkpoint(self):
+        snapshot = self.journal.checkpoint(self.component, self.component.feed)[1]
+        self.journal.flush()
+        return snapshot
+
+    def loaded_items(self):
+        return sorted([(item.name, item.value) for item in load_state(self.statefile).items])
+
+    def test_replay(self):
+        '''StateJournal: changes since the snapshot are replayed on load'''
+        first = self.component.add('a', 1)
+        second = self.component.add('b', 2)
+        assert self.checkpoint(), "first checkpoint not a snapshot"
+        first.value = 10
+        self.component.remove(second)
+        self.component.add('c', 3)
+        assert not self.checkpoint(), "checkpoint not journaled"
+        assert_match(self.loaded_items(), [('a', 10), ('c', 3)], "Bad items")
+        loaded = load_state(self.statefile)
+        assert loaded.items[0].owner is loaded, "Reference to component not restored"
+
+    def test_stale_journal(self):
+        '''StateJournal: a new snapshot supersedes the journal'''
+        item = self.component.add('a', 1)
+        self.checkpoint()
+        item.value = 2
+        self.checkpoint()
+        self.journal.snapshot_interval = 0
+        item.value = 3
+        assert self.checkpoint(), "checkpoint not a snapshot"
+        assert_match(os.path.getsize(self.statefile + ".journal"), 0, "Journal not started over")
+        assert_match(self.loaded_items(), [('a', 3)], "Bad items")
+
+    def test_incomplete_record(self):
+        '''load_state: a record cut short at the end of the journal is ignored'''
+        item = self.component.add('a', 1)
+        self.checkpoint()
+        item.value = 2
+        self.checkpoint()
+        item.value = 3
+        self.checkpoint()
+        size = os.path.getsize(self.statefile + ".journal")
+        journal = open(self.statefile + ".journal", "r+b")
+        journal.truncate(size - 10)
+        journal.close()
+        assert_match(self.loaded_items(), [('a', 2)], "Bad items")
+
+    def test_plain_statefile(self):
+        '''load_state: statefiles saved whole are still loaded'''
+        self.component.add('a', 1)
+        statefile = open(self.statefile, "wb")
+        cPickle.dump(self.component, statefile)
+        statefile.close()
+        assert_match(self.loaded_items(), [('a', 1)], "Bad items")
@@ -0,0 +1,114 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Tests for the accounting log history index in Cobalt.Cqparse'''
+import os
+import shutil
+import tempfile
+
+from nose.tools import raises
+
+from Cobalt.Cqparse import HistoryIndex, parse_exit_record, DEFAULT_DAYS
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+
+RECORD = ("%(date)s;E;%(jobid)d;Exit_status=%(exit)s Resource_List.ncpus=64 Resource_List.nodect=4 "
+          "Resource_List.walltime=00:10:00 account=%(project)s ctime=%(ctime)s end=%(end)s exec_host=nid0000[0-3] "
+          "mode=script queue=%(queue)s resources_used.walltime=00:05:00 start=%(start)s user=%(user)s\n")
+
+def record(jobid, user, end, queue='default', project='myproj', exit=0):
+    return RECORD % {'date':'01/01/2000 00:00:00', 'jobid':jobid, 'exit':exit, 'project':project, 'ctime':end - 100,
+                     'end':end, 'queue':queue, 'start':end - 50, 'user':user}
+
+
+class TestHistoryIndex(object):
+    '''Tests for Cobalt.Cqparse.HistoryIndex'''
+
+    def setup(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.index = HistoryIndex(log_dir=self.log_dir)
+
+    def teardown(self):
+        self.index.close()
+        shutil.rmtree(self.log_dir)
+
+    def write(self, filename, data, mode="a"):
+        logfile = open(os.path.join(self.log_dir, filename), mode)
+        logfile.write(data)
+        logfile.close()
+
+    def jobids(self, **kwargs):
+        return [job.jobid for job in self.index.query(**kwargs)]
+
+    def test_parse_exit_record(self):
+        '''parse_exit_record: fields of an exit record'''
+        job = parse_exit_record(record(1, 'dilbert', 1000.0))
+        assert_match((job['jobid'], job['user'], job['nodes'], job['account'], job['exit'], job['queued_time']),
+                     (1, 'dilbert', '4', 'myproj', '0', 50.0), "Bad job")
+        assert_match(parse_exit_record("01/01/2000 00:00:00;S;1;user=dilbert\n"), None, "Not an exit record")
+
+    def test_query(self):
+        '''HistoryIndex: queries by user, queue, project, exit status and end time'''
+        self.write("20000101", record(1, 'dilbert', 1000.0) + record(2, 'wally', 2000.0, queue='debug', exit=256))
+        self.write("20000102", record(3, 'dilbert', 3000.0, project='other', exit=1))
+        assert_match(self.index.update(), 3, "Bad record count")
+        assert_match(self.jobids(), [1, 2, 3], "Bad jobs")
+        assert_match(self.jobids(user='dilbert'), [1, 3], "Bad user")
+        assert_match(self.jobids(queue='debug'), [2], "Bad queue")
+        assert_match(self.jobids(project='other'), [3], "Bad project")
+        assert_match(self.jobids(exit_status=1), [2, 3], "Bad exit status")
+        assert_match(self.jobids(start=2000.0, end=3000.0), [2], "Bad time range")
+        assert_match(self.jobids(limit=2), [2, 3], "Bad limit")
+        assert_match(self.index.count(), 3, "Bad count")
+        assert_match(self.index.count(user='dilbert', end=3000.0), 1, "Bad filtered count")
+        job = self.index.query(user='wally')[0]
+        assert_match((job.exit, job.queuedtime, job.account), (1, "00:00:50", 'myproj'), "Job not finalized")
+
+    def test_incremental(self):
+        '''HistoryIndex: only appended complete records are read'''
+        first = record(1, 'dilbert', 1000.0)
+        second = record(2, 'wally', 2000.0)
+        self.write("20000101", first + second[:20])
+        assert_match(self.index.update(), 1, "Bad record count")
+        assert_match(self.index.update(), 0, "Records indexed again")
+        self.write("20000101", second[20:])
+        assert_match(self.index.update(), 1, "Appended record not indexed")
+        assert_match(self.jobids(), [1, 2], "Bad jobs")
+        # a rewritten (shorter) file is indexed again
+        self.write("20000101", first, "w")
+        assert_match(self.index.update(), 1, "Rewritten file not indexed")
+        assert_match(self.jobids(), [1], "Bad jobs after rewrite")
+        # the index persists
+        self.index.close()
+        self.index = HistoryIndex(log_dir=self.log_dir)
+        assert_match(self.index.update(), 0, "Index not kept")
+        assert_match(self.jobids(), [1], "Bad jobs after reopening")
+
+    def test_read_only_index(self):
+        '''HistoryIndex: records that cannot be written to the index are still queried'''
+        self.write("20000101", record(1, 'dilbert', 1000.0))
+        self.index.update()
+        self.write("20000101", record(2, 'wally', 2000.0))
+        self.write("20000102", record(3, 'dilbert', 3000.0))
+        self.index.db.execute("PRAGMA query_only = ON")
+        assert_match(self.index.update(), 2, "Appended records not read")
+        assert_match(self.jobids(), [1, 2, 3], "Unsaved records not queried")
+        assert_match(self.jobids(user='dilbert', limit=1), [3], "Bad unsaved query")
+        assert_match(self.index.update(), 0, "Unsaved records read again")
+        # a rewritten file replaces both its indexed and unsaved records
+        self.write("20000101", record(4, 'alice', 1500.0), "w")
+        self.index.update()
+        assert_match(self.jobids(), [4, 3], "Rewritten file not replaced")
+        assert_match(self.index.count(), 2, "Bad count of unsaved records")
+
+    def test_read_only_recent_days(self):
+        '''HistoryIndex: an index that cannot be written is only caught up from the last DEFAULT_DAYS logs'''
+        days = ["200001%02d" % (day + 1) for day in range(DEFAULT_DAYS + 2)]
+        for jobid, day in enumerate(days):
+            self.write(day, record(jobid, 'dilbert', 1000.0 * (jobid + 1)))
+        self.index.db.execute("PRAGMA query_only = ON")
+        assert not self.index.writable(), "Index writable"
+        assert_match(self.index.update(), DEFAULT_DAYS, "Old logs read")
+        assert_match(self.jobids(), range(2, DEFAULT_DAYS + 2), "Bad jobs")
+
+    @raises(ValueError)
+    def test_bad_limit(self):
+        self.index.query(limit=0)
@@ -0,0 +1,197 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Tests for the cweb status cache'''
+import imp
+import json
+import os
+import xmlrpclib
+
+from nose.tools import raises
+
+cweb = imp.load_source('cweb', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            '..', '..', 'src', 'clients', 'cweb.py'))
+
+
+def queued_job(jobid, queue='default'):
+    return {'jobid':jobid, 'state':'queued', 'walltime':10, 'nodes':1, 'mode':'c1', 'queue':queue,
+            'starttime':'-', 'submittime':0.0, 'project':'myproj', 'score':1.0}
+
+
+class FakeQueueManager(object):
+    '''Serves the jobs it holds through the change feed, as whole snapshots.'''
+
+    def __init__(self):
+        self.jobs = {}
+        self.generations = []
+
+    def get_jobs_since(self, generation, specs):
+        self.generations.append(generation)
+        return {'generation':'feed.%d' % len(self.generations), 'complete':True, 'deleted':[],
+                'items':self.jobs.values()}
+
+
+class OldQueueManager(FakeQueueManager):
+    '''A queue-manager from before the change feed.'''
+
+    def get_jobs_since(self, generation, specs):
+        raise xmlrpclib.Fault(7, 'get_jobs_since')
+
+    def get_jobs(self, specs):
+        return self.jobs.values()
+
+
+class FakeScheduler(object):
+
+    def get_reservations(self, specs):
+        return []
+
+
+class TestStatusCache(object):
+    '''Tests for cweb.StatusCache and the status served from it'''
+
+    def setup(self):
+        self.saved = (cweb.ComponentProxy, cweb.status_cache, cweb.system_type)
+        self.cqm = FakeQueueManager()
+        self.scheduler = FakeScheduler()
+        cweb.ComponentProxy = self.proxy
+        cweb.system_type = 'cluster_system'
+        self.cache = cweb.StatusCache(history=2)
+        cweb.status_cache = self.cache
+
+    def teardown(self):
+        cweb.ComponentProxy, cweb.status_cache, cweb.system_type = self.saved
+
+    def proxy(self, name, defer=True):
+        return {'queue-manager':self.cqm, 'scheduler':self.scheduler}[name]
+
+    def get(self, path, query='', if_none_match=None):
+        environ = {'PATH_INFO':path, 'QUERY_STRING':query}
+        if if_none_match is not None:
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        body = ''.join(cweb.app(environ, start_response))
+        return response['status'], response['headers'], body
+
+    def changes(self, since):
+        return json.loads(self.cache.changes(since))
+
+    def test_refresh(self):
+        '''refresh publishes a version from the change feed'''
+        self.cqm.jobs = {1:queued_job(1), 2:queued_job(2)}
+        self.cache.refresh()
+        assert self.cache.version == 1
+        assert self.cache.generation == 'feed.1'
+        assert sorted(self.cache.jobs.items) == [1, 2]
+        del self.cqm.jobs[1]
+        self.cqm.jobs[2] = queued_job(2, queue='debug')
+        self.cache.refresh()
+        assert self.cqm.generations == [0, 'feed.1']
+        assert self.cache.version == 2
+        assert sorted(self.cache.jobs.items) == [2]
+        assert self.cache.jobs.items[2]['queue'] == 'debug'
+        etag, body = self.cache.status
+        assert etag == '"%s.2"' % self.cache.epoch
+        assert [job['jobid'] for job in json.loads(body)['queued']] == [2]
+
+    def test_refresh_old_queue_manager(self):
+        '''refresh fetches every job from a queue-manager without get_jobs_since'''
+        self.cqm = OldQueueManager()
+        self.cqm.jobs = {1:queued_job(1)}
+        self.cache.refresh()
+        assert sorted(self.cache.jobs.items) == [1]
+        self.cqm.jobs = {2:queued_job(2)}
+        self.cache.refresh()
+        assert sorted(self.cache.jobs.items) == [2]
+
+    @raises(xmlrpclib.Fault)
+    def test_refresh_other_fault(self):
+        '''refresh does not mistake another fault for an old queue-manager'''
+        def get_jobs_since(generation, specs):
+            raise xmlrpclib.Fault(1, 'no such job')
+        self.cqm.get_jobs_since = get_jobs_since
+        self.cache.refresh()
+
+    def test_parse_version(self):
+        '''versions are EPOCH.N, and another epoch's versions are 0'''
+        assert self.cache.parse_version('0') == 0
+        assert self.cache.parse_version('%s.5' % self.cache.epoch) == 5
+        assert self.cache.parse_version('%s0.5' % self.cache.epoch) == 0
+
+    def test_parse_bad_version(self):
+        '''anything but a version is a ValueError'''
+        for name in ['bogus', '5', '%s.x' % self.cache.epoch, 'a.b.c']:
+            try:
+                self.cache.parse_version(name)
+            except ValueError:
+                pass
+            else:
+                assert False, "%r parsed as a version" % name
+
+    def test_changes(self):
+        '''changes returns what changed after since, or everything when since is unusable'''
+        assert self.cache.changes('0') is None
+        self.cqm.jobs = {1:queued_job(1), 2:queued_job(2)}
+        self.cache.refresh()
+        del self.cqm.jobs[1]
+        self.cqm.jobs[3] = queued_job(3)
+        self.cache.refresh()
+        changes = self.changes('%s.1' % self.cache.epoch)
+        assert not changes['complete']
+        assert [job['jobid'] for job in changes['queued']] == [3]
+        assert changes['deleted']['jobs'] == [1]
+        assert changes['version'] == '%s.2' % self.cache.epoch
+        for since in ['0', 'other.1', '%s.3' % self.cache.epoch]:
+            changes = self.changes(since)
+            assert changes['complete'], since
+            assert [job['jobid'] for job in changes['queued']] == [2, 3]
+
+    def test_changes_past_horizon(self):
+        '''a since older than the history gets everything'''
+        self.cqm.jobs = {1:queued_job(1)}
+        for jobid in range(2, 6):
+            self.cache.refresh()
+            self.cqm.jobs[jobid] = queued_job(jobid)
+        self.cache.refresh()
+        assert self.cache.jobs.horizon == 3
+        changes = self.changes('%s.2' % self.cache.epoch)
+        assert changes['complete']
+        assert [job['jobid'] for job in changes['queued']] == [1, 2, 3, 4, 5]
+        changes = self.changes('%s.3' % self.cache.epoch)
+        assert not changes['complete']
+        assert [job['jobid'] for job in changes['queued']] == [4, 5]
+
+    def test_not_modified(self):
+        '''the full status is not sent again while the ETag matches'''
+        status, headers, body = self.get('/')
+        assert status.startswith('503')
+        self.cqm.jobs = {1:queued_job(1)}
+        self.cache.refresh()
+        status, headers, body = self.get('/')
+        assert status.startswith('200')
+        etag = headers['ETag']
+        assert json.loads(body)['version'] == etag.strip('"')
+        for if_none_match in [etag, '"other.1", %s' % etag, '*']:
+            status, headers, body = self.get('/', if_none_match=if_none_match)
+            assert status.startswith('304'), if_none_match
+            assert body == ''
+            assert headers['ETag'] == etag
+        # a version from before a restart
+        status, headers, body = self.get('/', if_none_match='"1"')
+        assert status.startswith('200')
+        self.cache.refresh()
+        status, headers, body = self.get('/', if_none_match=etag)
+        assert status.startswith('200')
+        assert headers['ETag'] != etag
+
+    def test_changes_request(self):
+        '''/changes serves the changes, and rejects a since that is not a version'''
+        self.cqm.jobs = {1:queued_job(1)}
+        self.cache.refresh()
+        status, headers, body = self.get('/changes', 'since=%s.1' % self.cache.epoch)
+        assert status.startswith('200')
+        assert json.loads(body)['queued'] == []
+        status, headers, body = self.get('/changes', 'since=bogus')
+        assert status.startswith('400')
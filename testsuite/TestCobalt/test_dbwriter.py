@@ -0,0 +1,131 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Tests for the database writer client in Cobalt.Logging'''
+import logging
+import os
+import tempfile
+import xmlrpclib
+
+from mock import MagicMock, patch
+
+import Cobalt.Logging
+import Cobalt.Proxy
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+
+
+class FakeCdbwriter(object):
+    '''Record messages sent to the cdbwriter component.'''
+
+    def __init__(self, batches=True, fail_after=None):
+        self.batches = []
+        self.messages = []
+        self.accept_batches = batches
+        self.fail_after = fail_after
+
+    def _accept(self, msgs):
+        if self.fail_after is not None and len(self.messages) + len(msgs) > self.fail_after:
+            raise xmlrpclib.ProtocolError('cdbwriter', 503, 'unavailable', {})
+        self.messages.extend(msgs)
+
+    def add_messages(self, msgs):
+        if not self.accept_batches:
+            raise xmlrpclib.Fault(1, 'add_messages')
+        self._accept(msgs)
+        self.batches.append(list(msgs))
+
+    def add_message(self, msg):
+        self._accept([msg])
+
+
+class TestDBWriter(object):
+    '''Tests for Cobalt.Logging.dbwriter'''
+
+    def setup(self):
+        self.cdbwriter = FakeCdbwriter()
+        self.proxy_patch = patch.object(Cobalt.Proxy, 'ComponentProxy', return_value=self.cdbwriter)
+        self.proxy_patch.start()
+        self.dbwriter = Cobalt.Logging.dbwriter(logging.getLogger('test_dbwriter'), batch_size=3)
+        self.dbwriter.enabled = True
+        self.overflow_filename = None
+
+    def teardown(self):
+        self.proxy_patch.stop()
+        if self.overflow_filename is not None and os.path.exists(self.overflow_filename):
+            os.unlink(self.overflow_filename)
+
+    def log(self, count):
+        '''log count messages through log_to_db, encoding each as its number'''
+        with patch.object(Cobalt.JSONEncoders, 'ReportObject') as report:
+            for msg in range(count):
+                report.return_value.encode.return_value = str(msg)
+                self.dbwriter.log_to_db(None, 'creating', 'job_data', None)
+
+    def test_batched_delivery(self):
+        '''dbwriter: messages delivered in order in batches'''
+        self.log(7)
+        self.dbwriter.close()
+        assert_match(self.cdbwriter.messages, [str(msg) for msg in range(7)], "Bad messages")
+        assert max([len(batch) for batch in self.cdbwriter.batches]) <= 3, "batch too large"
+        assert_match(len(self.dbwriter.msg_queue), 0, "Messages left queued")
+
+    def test_single_message_fallback(self):
+        '''dbwriter: fall back to add_message without add_messages'''
+        self.cdbwriter.accept_batches = False
+        self.dbwriter.restore_messages(['0', '1', '2', '3'])
+        self.dbwriter.flush_queue()
+        assert_match(self.cdbwriter.messages, ['0', '1', '2', '3'], "Bad messages")
+        assert_match(self.dbwriter.batch_supported, False, "Still sending batches")
+
+    def test_batch_fault(self):
+        '''dbwriter: a fault other than a missing add_messages requeues the batch'''
+        def add_messages(msgs):
+            raise xmlrpclib.Fault(1, 'database error')
+        self.cdbwriter.add_messages = add_messages
+        self.dbwriter.restore_messages(['0', '1', '2', '3'])
+        self.dbwriter.flush_queue()
+        assert_match(self.cdbwriter.messages, [], "Messages sent singly")
+        assert_match(self.dbwriter.batch_supported, True, "Batches given up")
+        assert_match(self.dbwriter.queued_messages(), ['0', '1', '2', '3'], "Bad queue")
+        assert_match(self.dbwriter.cdbwriter_alive, False, "Writer should be marked down")
+
+    def test_requeue_on_failure(self):
+        '''dbwriter: undelivered messages stay queued in order'''
+        self.cdbwriter.fail_after = 3
+        self.dbwriter.restore_messages(['0', '1', '2', '3', '4'])
+        self.dbwriter.flush_queue()
+        assert_match(self.cdbwriter.messages, ['0', '1', '2'], "Bad messages")
+        assert_match(self.dbwriter.queued_messages(), ['3', '4'], "Bad queue")
+        assert_match(self.dbwriter.cdbwriter_alive, False, "Writer should be marked down")
+        self.cdbwriter.fail_after = None
+        self.dbwriter.flush_queue()
+        assert_match(self.cdbwriter.messages, ['0', '1', '2', '3', '4'], "Bad messages")
+
+    def test_queued_includes_batch_in_flight(self):
+        '''dbwriter: the batch being sent is counted as queued until delivered'''
+        queued = []
+        def add_messages(msgs):
+            queued.append(self.dbwriter.queued_messages())
+            self.cdbwriter.messages.extend(msgs)
+        self.cdbwriter.add_messages = add_messages
+        self.dbwriter.restore_messages(['0', '1', '2', '3'])
+        self.dbwriter.flush_queue()
+        assert_match(queued, [['0', '1', '2', '3'], ['3']], "Batch in flight not counted")
+        assert_match(self.dbwriter.queued_messages(), [], "Delivered messages still queued")
+
+    def test_overflow(self):
+        '''dbwriter: spill to the overflow file while the writer is down'''
+        fd, self.overflow_filename = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.overflow_filename)
+        self.dbwriter.overflow_filename = self.overflow_filename
+        self.dbwriter.max_queued = 2
+        self.cdbwriter.fail_after = 0
+        self.dbwriter.restore_messages(['0', '1', '2'])
+        self.dbwriter.flush_queue()
+        assert_match(self.dbwriter.overflow, True, "Overflow not set")
+        assert_match(open(self.overflow_filename).read(), "0\n1\n2\n", "Bad overflow file")
+        self.dbwriter.restore_messages(['3'])
+        self.cdbwriter.fail_after = None
+        self.dbwriter.flush_queue()
+        assert_match([msg.strip() for msg in self.cdbwriter.messages], ['0', '1', '2', '3'], "Bad messages")
+        assert not os.path.exists(self.overflow_filename), "overflow file not removed"
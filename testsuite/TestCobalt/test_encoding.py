@@ -0,0 +1,116 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Tests for the alternate RPC encodings in Cobalt.Encoding and their use by the server dispatcher'''
+import xmlrpclib
+
+import Cobalt.Encoding
+from Cobalt.Encoding import JSONCodec, get_codec, choose_codec, parse_encodings, accept_header
+from Cobalt.Server import CobaltXMLRPCDispatcher
+from Cobalt.Components.base import Component, exposed
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+from nose.tools import raises
+
+
+class EncodingComponent(Component):
+
+    name = 'encoding-test'
+
+    def get_jobs(self, specs):
+        return [dict(spec, jobid=1, location=['a', u'b'], walltime=None) for spec in specs]
+    get_jobs = exposed(get_jobs)
+
+    def get_time(self):
+        return xmlrpclib.DateTime(0)
+    get_time = exposed(get_time)
+
+    def fail(self):
+        raise ValueError("failed")
+    fail = exposed(fail)
+
+
+class TestJSONCodec(object):
+    '''Tests for Cobalt.Encoding.JSONCodec'''
+
+    def setup(self):
+        self.codec = JSONCodec()
+
+    def test_request(self):
+        '''JSONCodec: requests round trip'''
+        data = self.codec.dumps_request(([{'jobid':'*'}], True), 'get_jobs')
+        assert_match(self.codec.loads_request(data), (([{'jobid':'*'}], True), 'get_jobs'), "Bad request")
+
+    def test_strings(self):
+        '''JSONCodec: ASCII strings decode to str, others to unicode'''
+        result = self.codec.loads_response(self.codec.dumps_response({'user':'alice', 'list':['a', [u'caf\xe9']]}))
+        assert_match(result, {'user':'alice', 'list':['a', [u'caf\xe9']]}, "Bad result")
+        assert type(result['user']) is str, "ASCII value not str"
+        assert type(result.keys()[0]) is str, "ASCII key not str"
+        assert type(result['list'][0]) is str, "ASCII list item not str"
+        assert type(result['list'][1][0]) is unicode, "non-ASCII string not unicode"
+
+    @raises(xmlrpclib.Fault)
+    def test_fault(self):
+        '''JSONCodec: faults are raised'''
+        self.codec.loads_response(self.codec.dumps_fault(xmlrpclib.Fault(3, "no such job")))
+
+
+class TestNegotiation(object):
+    '''Tests for choosing an encoding from request headers'''
+
+    def test_parse_encodings(self):
+        '''parse_encodings: unknown encodings are skipped'''
+        assert_match([codec.name for codec in parse_encodings('bogus, json')], ['json'], "Bad encodings")
+
+    def test_choose_codec(self):
+        '''choose_codec: the client's first enabled encoding before XML-RPC is chosen'''
+        json_codec = Cobalt.Encoding.codecs['json']
+        assert choose_codec(accept_header([json_codec]), [json_codec]) is json_codec
+        assert choose_codec('text/xml, application/json', [json_codec]) is None
+        assert choose_codec('application/json', []) is None
+        assert choose_codec(None, [json_codec]) is None
+        assert get_codec('application/json; charset=utf-8') is json_codec
+        assert get_codec('text/xml') is None
+
+    def test_gzip(self):
+        '''compress: bodies round trip through gzip'''
+        data = 'x' * 100000
+        assert len(Cobalt.Encoding.compress(data)) < len(data)
+        assert_match(Cobalt.Encoding.decompress(Cobalt.Encoding.compress(data)), data, "Bad body")
+
+
+class TestEncodedDispatch(object):
+    '''Tests for CobaltXMLRPCDispatcher._encoded_dispatch'''
+
+    def setup(self):
+        self.dispatcher = CobaltXMLRPCDispatcher(True, None)
+        self.dispatcher.register_instance(EncodingComponent(register=False))
+        self.codec = Cobalt.Encoding.codecs['json']
+
+    def test_json_response(self):
+        '''_encoded_dispatch: XML-RPC requests can be answered in JSON'''
+        request = xmlrpclib.dumps(([{'user':'alice'}],), 'get_jobs')
+        response, content_type = self.dispatcher._encoded_dispatch(request, None, self.codec)
+        assert_match(content_type, 'application/json', "Bad content type")
+        assert_match(self.codec.loads_response(response),
+                [{'user':'alice', 'jobid':1, 'location':['a', 'b'], 'walltime':None}], "Bad response")
+
+    def test_json_request(self):
+        '''_encoded_dispatch: JSON requests are decoded'''
+        request = self.codec.dumps_request(([{'user':'alice'}],), 'get_jobs')
+        response, content_type = self.dispatcher._encoded_dispatch(request, self.codec, None)
+        assert_match(content_type, 'text/xml', "Bad content type")
+        assert_match(xmlrpclib.loads(response)[0][0][0]['user'], 'alice', "Bad response")
+
+    def test_xmlrpc_fallback(self):
+        '''_encoded_dispatch: responses JSON cannot encode are sent as XML-RPC'''
+        request = xmlrpclib.dumps((), 'get_time')
+        response, content_type = self.dispatcher._encoded_dispatch(request, None, self.codec)
+        assert_match(content_type, 'text/xml', "Bad content type")
+        assert isinstance(xmlrpclib.loads(response)[0][0], xmlrpclib.DateTime)
+
+    @raises(xmlrpclib.Fault)
+    def test_json_fault(self):
+        '''_encoded_dispatch: faults are encoded in the response encoding'''
+        response, content_type = self.dispatcher._encoded_dispatch(xmlrpclib.dumps((), 'fail'), None, self.codec)
+        assert_match(content_type, 'application/json', "Bad content type")
+        self.codec.loads_response(response)
@@ -0,0 +1,261 @@
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Tests for connection pooling and location caching in Cobalt.Proxy'''
+import errno
+import httplib
+import socket
+import xmlrpclib
+
+from mock import patch
+
+import Cobalt.Proxy
+import Cobalt.Encoding
+from Cobalt.Proxy import ConnectionPool, XMLRPCTransport, RetryMethod
+from Cobalt.Exceptions import ComponentLookupError
+from testsuite.TestCobalt.Utilities.assert_functions import assert_match
+from nose.tools import raises
+
+RESPONSE = xmlrpclib.dumps((42,), methodresponse=1)
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, will_close, headers=None):
+        self.body = body
+        self.will_close = will_close
+        self.status = 200
+        self.reason = 'OK'
+        self.msg = {}
+        self.headers = headers or {}
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class FakeConnection(object):
+    '''Stand in for SSLHTTPConnection, failing requests with fail_with.'''
+
+    made = []
+
+    def __init__(self, host, **kwargs):
+        self.host = host
+        self.requests = 0
+        self.closed = False
+        self.fail_with = None
+        self.will_close = False
+        self.headers = {}
+        self.body = None
+        self.response = (RESPONSE, {})
+        FakeConnection.made.append(self)
+
+    def putrequest(self, method, handler, **kwargs):
+        self.headers = {}
+
+    def putheader(self, header, value):
+        self.headers[header] = value
+
+    def endheaders(self, body=None):
+        if self.fail_with is not None:
+            raise self.fail_with
+        self.body = body
+
+    def getresponse(self):
+        self.requests += 1
+        body, headers = self.response
+        return FakeResponse(body, self.will_close, headers)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServiceLocator(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def locate(self, name):
+        self.calls += 1
+        return {'system': 'https://host:1234'}.get(name, '')
+
+
+class TestConnectionPool(object):
+    '''Tests for Cobalt.Proxy.ConnectionPool'''
+
+    def test_reuse(self):
+        '''ConnectionPool: idle connections are reused by key'''
+        pool = ConnectionPool()
+        conn = FakeConnection('host')
+        pool.put('host', conn)
+        assert_match(pool.get('other'), None, "Connection for wrong key")
+        assert pool.get('host') is conn, "Connection not reused"
+        assert_match(pool.get('host'), None, "Connection handed out twice")
+
+    def test_idle_timeout(self):
+        '''ConnectionPool: connections idle too long are closed'''
+        pool = ConnectionPool(idle_timeout=0)
+        conn = FakeConnection('host')
+        pool.put('host', conn)
+        assert_match(pool.get('host'), None, "Stale connection reused")
+        assert conn.closed, "Stale connection not closed"
+
+    def test_max_idle(self):
+        '''ConnectionPool: connections beyond max_idle are closed'''
+        pool = ConnectionPool(max_idle=1)
+        conns = [FakeConnection('host'), FakeConnection('host')]
+        for conn in conns:
+            pool.put('host', conn)
+        assert not conns[0].closed, "Pooled connection closed"
+        assert conns[1].closed, "Excess connection not closed"
+
+
+class TestXMLRPCTransport(object):
+    '''Tests for keep-alive requests in Cobalt.Proxy.XMLRPCTransport'''
+
+    def setup(self):
+        FakeConnection.made = []
+        Cobalt.Proxy.connection_pool.clear()
+        self.conn_patch = patch.object(Cobalt.Proxy, 'SSLHTTPConnection', FakeConnection)
+        self.conn_patch.start()
+
+    def teardown(self):
+        self.conn_patch.stop()
+        Cobalt.Proxy.connection_pool.clear()
+        Cobalt.Proxy.located_servers.clear()
+        Cobalt.Proxy.gzip_servers.clear()
+
+    def test_keepalive(self):
+        '''XMLRPCTransport: requests share one connection'''
+        transport = XMLRPCTransport()
+        for _ in range(3):
+            assert_match(transport.request('root:pw@host:1234', '/RPC2', 'body'), (42,), "Bad response")
+        assert_match(len(FakeConnection.made), 1, "Connection not reused")
+        assert_match(FakeConnection.made[0].requests, 3, "Bad request count")
+        assert 'Authorization' in FakeConnection.made[0].headers, "Credentials not sent"
+
+    def test_server_closes(self):
+        '''XMLRPCTransport: connections the server closes are not reused'''
+        transport = XMLRPCTransport()
+        transport.request('host:1234', '/RPC2', 'body')
+        FakeConnection.made[0].will_close = True
+        transport.request('host:1234', '/RPC2', 'body')
+        transport.request('host:1234', '/RPC2', 'body')
+        assert_match(len(FakeConnection.made), 2, "Bad connection count")
+        assert FakeConnection.made[0].closed, "Connection not closed"
+
+    def test_keepalive_disabled(self):
+        '''XMLRPCTransport: no pooling with keepalive off'''
+        transport = XMLRPCTransport(keepalive=False)
+        transport.request('host:1234', '/RPC2', 'body')
+        transport.request('host:1234', '/RPC2', 'body')
+        assert_match(len(FakeConnection.made), 2, "Connection reused")
+        assert_match(FakeConnection.made[0].headers.get('Connection'), 'close', "Close not requested")
+
+    def test_stale_connection_retried(self):
+        '''XMLRPCTransport: a request on a stale pooled connection is resent'''
+        transport = XMLRPCTransport()
+        transport.request('host:1234', '/RPC2', 'body')
+        FakeConnection.made[0].fail_with = socket.error(errno.EPIPE, 'Broken pipe')
+        assert_match(transport.request('host:1234', '/RPC2', 'body'), (42,), "Bad response")
+        assert_match(len(FakeConnection.made), 2, "Request not resent on a new connection")
+        assert FakeConnection.made[0].closed, "Stale connection not closed"
+
+    @raises(socket.error)
+    def test_connect_failure_forgets_location(self):
+        '''XMLRPCTransport: failing to reach a located component forgets its location'''
+        Cobalt.Proxy.located_servers['system'] = ('https://host:1234', float('inf'))
+        transport = XMLRPCTransport(component_name='system')
+        with patch.object(FakeConnection, 'endheaders', side_effect=socket.error(errno.ECONNREFUSED, 'refused')):
+            try:
+                transport.request('host:1234', '/RPC2', 'body')
+            finally:
+                assert 'system' not in Cobalt.Proxy.located_servers, "Location not forgotten"
+
+    def test_encoded_response(self):
+        '''XMLRPCTransport: responses are decoded by content type and encoding'''
+        codec = Cobalt.Encoding.codecs['json']
+        transport = XMLRPCTransport(encodings=[codec], compress_threshold=1)
+        transport.request('host:1234', '/RPC2', 'body')
+        conn = FakeConnection.made[0]
+        assert_match(conn.headers['Accept'], 'application/json, text/xml', "Bad Accept header")
+        assert_match(conn.headers['Accept-Encoding'], 'gzip', "gzip not accepted")
+        conn.response = (Cobalt.Encoding.compress(codec.dumps_response([{'jobid':1}])),
+                {'content-type':'application/json', 'content-encoding':'gzip'})
+        assert_match(transport.request('host:1234', '/RPC2', 'body'), ([{'jobid':1}],), "Bad response")
+
+    def test_compressed_request(self):
+        '''XMLRPCTransport: large requests are gzipped once the server accepts it'''
+        transport = XMLRPCTransport(compress_threshold=10)
+        body = 'x' * 100
+        transport.request('host:1234', '/RPC2', body)
+        conn = FakeConnection.made[0]
+        assert_match(conn.body, body, "Request compressed before the server accepted gzip")
+        conn.response = (RESPONSE, {'accept-encoding':'gzip'})
+        transport.request('host:1234', '/RPC2', body)
+        transport.request('host:1234', '/RPC2', body)
+        assert_match(conn.headers.get('Content-Encoding'), 'gzip', "Request not compressed")
+        assert_match(Cobalt.Encoding.decompress(conn.body), body, "Bad request body")
+        transport.request('host:1234', '/RPC2', 'small')
+        assert_match(conn.body, 'small', "Small request compressed")
+
+
+class TestRetryMethod(object):
+    '''Tests for retrying calls in Cobalt.Proxy.RetryMethod'''
+
+    def test_busy_retried(self):
+        '''RetryMethod: calls turned away with 503 are retried'''
+        calls = []
+        def send(name, args):
+            calls.append(name)
+            if len(calls) == 1:
+                raise xmlrpclib.ProtocolError('host/', 503, 'Service Unavailable', FakeResponse('', True,
+                    {'retry-after':'0'}))
+            return 42
+        assert_match(RetryMethod(send, 'get_jobs')(), 42, "Bad result")
+        assert_match(calls, ['get_jobs', 'get_jobs'], "Call not retried")
+
+    @raises(xmlrpclib.Fault)
+    def test_error_not_retried(self):
+        '''RetryMethod: other HTTP errors fail the call'''
+        def send(name, args):
+            raise xmlrpclib.ProtocolError('host/', 500, 'Internal Server Error', {})
+        RetryMethod(send, 'get_jobs')()
+
+
+class TestLocate(object):
+    '''Tests for service location caching in Cobalt.Proxy'''
+
+    def setup(self):
+        self.slp = FakeServiceLocator()
+        self.proxy_patch = patch.object(Cobalt.Proxy, 'ComponentProxy', return_value=self.slp)
+        self.proxy_patch.start()
+        Cobalt.Proxy.located_servers.clear()
+
+    def teardown(self):
+        self.proxy_patch.stop()
+        Cobalt.Proxy.located_servers.clear()
+
+    def test_cached(self):
+        '''locate: locations are cached for the ttl'''
+        assert_match(Cobalt.Proxy.locate('system', 60), 'https://host:1234', "Bad location")
+        assert_match(Cobalt.Proxy.locate('system', 60), 'https://host:1234', "Bad location")
+        assert_match(self.slp.calls, 1, "Location not cached")
+        Cobalt.Proxy.forget_location('system')
+        Cobalt.Proxy.locate('system', 60)
+        assert_match(self.slp.calls, 2, "Location not forgotten")
+
+    def test_no_ttl(self):
+        '''locate: no caching with a ttl of 0'''
+        Cobalt.Proxy.locate('system', 0)
+        Cobalt.Proxy.locate('system', 0)
+        assert_match(self.slp.calls, 2, "Location cached")
+
+    @raises(ComponentLookupError)
+    def test_unknown(self):
+        '''locate: unregistered components are not found, or cached'''
+        try:
+            Cobalt.Proxy.locate('cqm', 60)
+        finally:
+            assert 'cqm' not in Cobalt.Proxy.located_servers, "Missing location cached"
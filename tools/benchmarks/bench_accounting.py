@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark accounting log writes.
+
+Logs bursts of job end records, as a scheduling pass finishing many jobs at
+once does, and times how long the caller is held with the synchronous
+DatetimeFileHandler and with the BufferedDatetimeFileHandler, plus how long
+the buffered records take to reach the file.  Also reports the rate of
+message serialization alone.
+
+Usage: bench_accounting.py [--records N] [--reps N] [--flush-interval S]
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import logging
+import optparse
+from datetime import timedelta
+
+import Cobalt
+
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[system]\nresource_name: bench\n")
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+from Cobalt.Util import init_cobalt_config
+init_cobalt_config()
+from Cobalt import accounting
+
+
+def best(func, reps):
+    times = []
+    for _ in xrange(reps):
+        times.append(func())
+    return min(times)
+
+
+def end_record(count):
+    now = time.time()
+    return accounting.end(count, 'bench', 'users', 'job%d' % count, 'default', '/home/bench', '/bin/true',
+                          ['-n', str(count)], 'script', now - 100, now - 100, now - 100, now - 50,
+                          ['nid%05d' % count], {'nodect':1, 'walltime':timedelta(minutes=10)},
+                          count, now, 0, {'nodect':1, 'walltime':timedelta(minutes=1)}, account='bench')
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--records", type="int", default=10000, help="records logged per burst")
+    parser.add_option("--reps", type="int", default=3, help="bursts of each kind (best is reported)")
+    parser.add_option("--flush-interval", type="float", default=1.0, help="buffered writer flush interval")
+    opts, _ = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp()
+    pattern = os.path.join(log_dir, "%Y%m%d")
+    logger = logging.getLogger("bench.accounting")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    def serialize():
+        start = time.time()
+        for count in xrange(opts.records):
+            end_record(count)
+        return time.time() - start
+
+    def burst(handler):
+        logger.addHandler(handler)
+        start = time.time()
+        for count in xrange(opts.records):
+            logger.info(end_record(count))
+        held = time.time() - start
+        handler.flush()
+        written = time.time() - start
+        logger.removeHandler(handler)
+        return held, written
+
+    sync_handler = accounting.DatetimeFileHandler(pattern)
+    sync = best(lambda: burst(sync_handler), opts.reps)
+    sync_handler.close()
+    buffered_handler = accounting.BufferedDatetimeFileHandler(pattern, flush_interval=opts.flush_interval)
+    buffered = best(lambda: burst(buffered_handler), opts.reps)
+    buffered_handler.close()
+
+    print "accounting bursts of %d end records, best of %d" % (opts.records, opts.reps)
+    print "%-40s %10.0f records/s" % ("serialization", opts.records / best(serialize, opts.reps))
+    print "%-40s %10.4f s" % ("synchronous handler, caller held", sync[0])
+    print "%-40s %10.4f s" % ("buffered handler, caller held", buffered[0])
+    print "%-40s %10.4f s" % ("buffered handler, until written", buffered[1])
+
+    shutil.rmtree(log_dir)
+    os.unlink(_config_file)
+
+
+if __name__ == '__main__':
+    main()
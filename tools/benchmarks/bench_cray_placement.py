@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark job placement throughput of the Cray system component.
+
+Builds a CraySystem in-process over a simulated machine of idle nodes, with
+ALPS reservations answered first-fit in-process, and runs scheduling passes
+of find_job_location over a queue of small jobs until every job is placed.
+It reports the passes needed (each pass is one bgsched scheduling interval)
+and the time spent, once with no limit on placements per pass and once
+limited to a single placement per pass, as the component used to do.
+
+Like the test suite, this needs the mock package, which stands in for the
+site cray_messaging library when it is not installed.
+
+Usage: bench_cray_placement.py [--nodes N] [--jobs N] [--job-nodes N] [--single-passes N]
+'''
+
+import sys
+import os
+import time
+import tempfile
+import logging
+import optparse
+
+import Cobalt
+
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[system]\nsize: 5000\n[alpssystem]\n[alps]\n")
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+from mock import MagicMock, patch
+try:
+    import cray_messaging
+except ImportError:
+    sys.modules['cray_messaging'] = MagicMock()
+
+import Cobalt.Components.system.CraySystem
+import Cobalt.Components.system.AlpsBridge as AlpsBridge
+from Cobalt.Components.system.CraySystem import CraySystem
+from Cobalt.Components.system.CrayNode import CrayNode
+
+
+def first_fit_reserve(user, jobid, nodes, attrs, node_id_list):
+    '''Answer an ALPS reservation request with the first nodes offered.'''
+    return {'reserved_nodes': [str(nid) for nid in node_id_list[:nodes]], 'reservation_id': int(jobid)}
+
+
+def build_system(node_count):
+    with patch.object(AlpsBridge, 'init_bridge'):
+        with patch.object(CraySystem, '_init_nodes_and_reservations', return_value=None):
+            with patch.object(CraySystem, '_run_update_state', return_value=None):
+                system = CraySystem()
+    for nid in xrange(1, node_count + 1):
+        node = CrayNode({'name': 'nid%05d' % nid, 'state': 'UP', 'node_id': str(nid), 'role': 'batch',
+                         'architecture': 'XT', 'SocketArray': [], 'queues': ['default']})
+        node.managed = True
+        system.nodes[str(nid)] = node
+        system.node_name_to_id[node.name] = node.node_id
+    system._gen_node_to_queue()
+    return system
+
+
+def run(label, node_count, job_count, job_nodes, max_placements, max_passes):
+    system = build_system(node_count)
+    jobs = [{'jobid': jobid, 'user': 'bench', 'attrs': {}, 'queue': 'default', 'nodes': job_nodes, 'walltime': 60}
+            for jobid in xrange(1, job_count + 1)]
+    Cobalt.Components.system.CraySystem.MAX_PLACEMENTS_PER_PASS = max_placements
+    passes = 0
+    placed = 0
+    start = time.time()
+    with patch.object(AlpsBridge, 'reserve', first_fit_reserve):
+        while jobs and passes < max_passes:
+            best_match = system.find_job_location(jobs, [], [])
+            passes += 1
+            placed += len(best_match)
+            jobs = [job for job in jobs if job['jobid'] not in best_match]
+    elapsed = time.time() - start
+    print "%-28s %6d jobs placed in %5d passes, %8.4f s (%.4f s/pass)" % (label, placed, passes, elapsed,
+            elapsed / max(passes, 1))
+    if jobs:
+        print "%-28s %6d jobs left; at this rate %d passes are needed" % ("", len(jobs),
+                passes * job_count / max(placed, 1))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--nodes", type="int", default=5000, help="number of simulated nodes")
+    parser.add_option("--jobs", type="int", default=1000, help="number of queued jobs")
+    parser.add_option("--job-nodes", type="int", default=1, help="nodes requested per job")
+    parser.add_option("--single-passes", type="int", default=20,
+            help="passes to run with one placement per pass before extrapolating")
+    opts, _ = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    print "%d nodes, %d queued %d-node jobs" % (opts.nodes, opts.jobs, opts.job_nodes)
+    run("all fitting jobs per pass", opts.nodes, opts.jobs, opts.job_nodes, 0, opts.jobs)
+    run("one job per pass", opts.nodes, opts.jobs, opts.job_nodes, 1, opts.single_passes)
+    os.unlink(_config_file)
+
+
+if __name__ == '__main__':
+    main()
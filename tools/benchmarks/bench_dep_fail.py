@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark dependency tracking in the queue manager.
+
+Builds a QueueManager in-process with a large number of queued jobs arranged
+in dependency chains and times the operations that touch dependency state:
+submitting, a full dep_fail resynchronization, completion of the head of a
+chain and clearing a job's dependencies.
+
+Usage: bench_dep_fail.py [--jobs N] [--depth N]
+'''
+
+import sys
+import os
+import time
+import tempfile
+import logging
+import optparse
+
+import Cobalt
+
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[cqm]\nlog_dir: %s\n[bgsched]\nutility_file: /dev/null\n" % tempfile.gettempdir())
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+from Cobalt.Components.cqm import QueueManager
+
+
+class _Quiet(object):
+    '''Discard stdout while jobs are created (Job.__init__ prints).'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def timed(label, func, *args):
+    start = time.time()
+    with _Quiet():
+        result = func(*args)
+    print "%-40s %10.4f s" % (label, time.time() - start)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--jobs", type="int", default=50000, help="number of queued jobs")
+    parser.add_option("--depth", type="int", default=100, help="length of each dependency chain")
+    opts, _ = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with _Quiet():
+        cqm = QueueManager(register=False)
+        cqm.add_queues([{'tag':'queue', 'name':'default'}])
+
+    def populate():
+        # bulk load straight into the JobList; add_jobs is timed separately below
+        specs = []
+        for count in xrange(opts.jobs):
+            spec = {'tag':'job', 'queue':'default', 'user':'bench', 'nodes':1, 'walltime':10}
+            if count % opts.depth:
+                spec['all_dependencies'] = str(count)
+            specs.append(spec)
+        for job in cqm.Queues['default'].jobs.q_add(specs):
+            cqm.dep_graph.update_job(job)
+        # build the query indexes up front, as a running cqm would already have them
+        cqm.Queues['default'].jobs.q_get([{'jobid':1}])
+        cqm.get_jobs([{'jobid':1}])
+
+    print "%d jobs, dependency chains of %d" % (opts.jobs, opts.depth)
+    timed("populate queue (bulk load)", populate)
+    timed("full check_dep_fail", cqm.check_dep_fail)
+    timed("submit one dependent job", cqm.add_jobs,
+            [{'tag':'job', 'queue':'default', 'user':'bench', 'nodes':1, 'walltime':10, 'all_dependencies':'1'}])
+
+    [job] = cqm.get_jobs([{'jobid':1}])
+    job.exit_status = 0
+    timed("complete chain head", cqm._job_terminal_action, {'job':job})
+
+    mid = opts.depth // 2
+    [job] = cqm.get_jobs([{'jobid':mid}])
+    timed("delete mid-chain job", cqm.del_jobs, [{'jobid':job.jobid}], True)
+    [job] = cqm.get_jobs([{'jobid':mid + 1}])
+    print "dependent of deleted job in dep_fail: %s" % (job.dep_fail,)
+
+    timed("clear dependencies of one job", cqm.set_jobs, [{'jobid':job.jobid}], {'all_dependencies':[]})
+    print "dependent of deleted job in dep_fail: %s" % (job.dep_fail,)
+    os.unlink(_config_file)
+
+
+if __name__ == '__main__':
+    main()
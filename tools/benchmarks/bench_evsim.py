@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark the qsim event queue.
+
+Replays a synthetic trace the way bqsim drives the event simulator: every
+job is submitted (Q), started some time later (S) and ends after its
+runtime (E), and a share of running jobs has its end event moved as
+walltime predictions change.  The trace runs through the heap EventQueue,
+and a smaller one through the time-ordered list the simulator kept before.
+
+Usage: bench_evsim.py [--jobs N] [--compare-jobs N] [--rekey FRACTION]
+'''
+
+import os
+import time
+import random
+import tempfile
+import optparse
+
+import Cobalt
+
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[cqm]\nlog_dir: %s\n[bgsched]\nutility_file: /dev/null\n" % tempfile.gettempdir())
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+from Cobalt.Components.evsim import EventQueue
+
+
+class ListEvents(object):
+    '''The time-ordered event list and index the simulator used before EventQueue.'''
+
+    def __init__(self):
+        self.event_list = [{'unixtime':0}]
+        self.time_stamp = 0
+
+    def push(self, ev_spec):
+        pos = len(self.event_list)
+        while ev_spec['unixtime'] < self.event_list[pos-1]['unixtime']:
+            pos = pos - 1
+        self.event_list.insert(pos, ev_spec)
+
+    def update(self, ev_spec):
+        for pos in xrange(len(self.event_list)):
+            event = self.event_list[pos]
+            if event.get('jobid') == ev_spec['jobid'] and event.get('type') == ev_spec['type']:
+                del self.event_list[pos]
+                break
+        self.push(ev_spec)
+
+    def pop(self):
+        if self.time_stamp < len(self.event_list) - 1:
+            self.time_stamp += 1
+            return self.event_list[self.time_stamp]
+        return None
+
+
+def replay(events, jobs, rekey, seed=1):
+    '''Run a trace of jobs through events, return (seconds, events processed).'''
+    rand = random.Random(seed)
+    # submissions spread over a year
+    submits = sorted(rand.uniform(0, 365 * 86400) for _ in xrange(jobs))
+    start = time.time()
+    for jobid, submit in enumerate(submits):
+        events.push({'unixtime':submit, 'jobid':jobid, 'type':'Q'})
+    processed = 0
+    while True:
+        event = events.pop()
+        if event is None:
+            break
+        processed += 1
+        now = event['unixtime']
+        if event['type'] == 'Q':
+            events.push({'unixtime':now + rand.expovariate(1 / 3600.0), 'jobid':event['jobid'], 'type':'S'})
+        elif event['type'] == 'S':
+            runtime = rand.uniform(60, 12 * 3600)
+            events.push({'unixtime':now + runtime, 'jobid':event['jobid'], 'type':'E'})
+            if rand.random() < rekey:
+                events.update({'unixtime':now + runtime * rand.uniform(0.5, 1), 'jobid':event['jobid'], 'type':'E'})
+    return time.time() - start, processed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--jobs", type="int", default=1000000, help="jobs in the trace")
+    parser.add_option("--compare-jobs", type="int", default=5000, help="jobs in the trace run through both queues")
+    parser.add_option("--rekey", type="float", default=0.1, help="share of jobs whose end event is moved")
+    opts, _ = parser.parse_args()
+
+    print "event queue replay, %.0f%% of end events moved" % (opts.rekey * 100)
+    for name, events, jobs in [("list, %d jobs" % opts.compare_jobs, ListEvents(), opts.compare_jobs),
+                               ("heap, %d jobs" % opts.compare_jobs, EventQueue(), opts.compare_jobs),
+                               ("heap, %d jobs" % opts.jobs, EventQueue(), opts.jobs)]:
+        elapsed, processed = replay(events, jobs, opts.rekey)
+        print "%-30s %10.2f s %12.0f events/s" % (name, elapsed, processed / elapsed)
+
+    os.unlink(_config_file)
+
+
+if __name__ == '__main__':
+    main()
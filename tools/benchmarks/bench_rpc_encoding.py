@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark RPC wire encodings on large job lists.
+
+Builds a QueueManager in-process with a large number of queued jobs and
+times a full get_jobs round trip in each available encoding, with and
+without gzip: dispatching and encoding the response as the server does,
+then decoding it as XMLRPCTransport does.  No sockets are involved, so the
+times are the encoding overhead alone.
+
+Usage: bench_rpc_encoding.py [--jobs N] [--reps N]
+'''
+
+import sys
+import os
+import time
+import tempfile
+import logging
+import optparse
+import xmlrpclib
+
+import Cobalt
+
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[cqm]\nlog_dir: %s\n[bgsched]\nutility_file: /dev/null\n" % tempfile.gettempdir())
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+import Cobalt.Encoding
+from Cobalt.Components.cqm import QueueManager
+from Cobalt.Server import CobaltXMLRPCDispatcher
+from Cobalt.Proxy import XMLRPCTransport
+
+
+class _Quiet(object):
+    '''Discard stdout while jobs are created (Job.__init__ prints).'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def round_trip(dispatcher, transport, request, codec, gzip):
+    '''Return (bytes sent, server seconds, client seconds) for one get_jobs call.'''
+    start = time.time()
+    response, content_type = dispatcher._encoded_dispatch(request, None, codec)
+    if gzip:
+        response = Cobalt.Encoding.compress(response)
+    encoded = time.time()
+    result = transport._parse_response(response, content_type, gzip and "gzip" or None)
+    decoded = time.time()
+    assert len(result[0]) > 0
+    return len(response), encoded - start, decoded - encoded
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--jobs", type="int", default=20000, help="number of queued jobs")
+    parser.add_option("--reps", type="int", default=3, help="round trips per encoding (best is reported)")
+    opts, _ = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with _Quiet():
+        cqm = QueueManager(register=False)
+        cqm.add_queues([{'tag':'queue', 'name':'default'}])
+        specs = [{'tag':'job', 'queue':'default', 'user':'bench', 'nodes':1, 'walltime':10, 'command':'/bin/true',
+                  'args':['-n', str(count)], 'attrs':{'count':str(count)}} for count in xrange(opts.jobs)]
+        cqm.Queues['default'].jobs.q_add(specs)
+    dispatcher = CobaltXMLRPCDispatcher(True, None)
+    dispatcher.register_instance(cqm)
+    transport = XMLRPCTransport()
+    # the fields qstat asks for in its full listing
+    query = [dict([(field, '*') for field in ['jobid', 'user', 'walltime', 'nodes', 'state', 'location', 'queue',
+        'command', 'args', 'attrs', 'submittime', 'starttime', 'project', 'score', 'mode', 'procs']])]
+    request = xmlrpclib.dumps((query,), 'get_jobs', allow_none=True)
+
+    print "get_jobs of %d jobs, best of %d" % (opts.jobs, opts.reps)
+    print "%-16s %12s %10s %10s %10s" % ("encoding", "bytes", "server s", "client s", "total s")
+    encodings = [None] + [Cobalt.Encoding.codecs[name] for name in sorted(Cobalt.Encoding.codecs)]
+    for codec in encodings:
+        for gzip in [False, True]:
+            best = None
+            for _ in xrange(opts.reps):
+                size, server, client = round_trip(dispatcher, transport, request, codec, gzip)
+                if best is None or server + client < best[1] + best[2]:
+                    best = (size, server, client)
+            label = (codec is None and "xmlrpc" or codec.name) + (gzip and "+gzip" or "")
+            print "%-16s %12d %10.4f %10.4f %10.4f" % (label, best[0], best[1], best[2], best[1] + best[2])
+
+    os.unlink(_config_file)
+
+
+if __name__ == '__main__':
+    main()
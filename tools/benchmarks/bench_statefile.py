@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark cqm statefile save pauses.
+
+Builds a QueueManager in-process with a large number of queued jobs and
+times how long saving holds the caller (and so the component lock): a
+whole-component save as Component.save does without a journal, a full
+snapshot checkpoint, and journal checkpoints after changing a few jobs.
+
+Usage: bench_statefile.py [--jobs N] [--changed N] [--reps N]
+'''
+
+import sys
+import os
+import time
+import tempfile
+import logging
+import optparse
+
+import Cobalt
+
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[cqm]\nlog_dir: %s\n[bgsched]\nutility_file: /dev/null\n" % tempfile.gettempdir())
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+from Cobalt.Checkpoint import StateJournal
+from Cobalt.Components.base import Component
+from Cobalt.Components.cqm import QueueManager
+
+
+class _Quiet(object):
+    '''Discard stdout while jobs are created (Job.__init__ prints).'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def best(func, reps):
+    times = []
+    for _ in xrange(reps):
+        times.append(func())
+    return min(times)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--jobs", type="int", default=20000, help="number of queued jobs")
+    parser.add_option("--changed", type="int", default=10, help="jobs changed between journal checkpoints")
+    parser.add_option("--reps", type="int", default=3, help="saves of each kind (best is reported)")
+    opts, _ = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with _Quiet():
+        cqm = QueueManager(register=False)
+        cqm.add_queues([{'tag':'queue', 'name':'default'}])
+        specs = [{'tag':'job', 'queue':'default', 'user':'bench', 'nodes':1, 'walltime':10, 'command':'/bin/true',
+                  'args':['-n', str(count)], 'attrs':{'count':str(count)}} for count in xrange(opts.jobs)]
+        jobs = cqm.Queues['default'].jobs.q_add(specs)
+    statefile = tempfile.mktemp()
+
+    def whole():
+        start = time.time()
+        Component.save(cqm, statefile)
+        return time.time() - start
+
+    journal = StateJournal(statefile, snapshot_interval=0)
+    def snapshot():
+        pause = journal.checkpoint(cqm, cqm.checkpoint_feed())[0]
+        journal.flush()
+        return pause
+
+    def checkpoint():
+        for job in jobs[:opts.changed]:
+            job.score = job.score + 1
+        pause = journal.checkpoint(cqm, cqm.checkpoint_feed())[0]
+        journal.flush()
+        return pause
+
+    print "save pauses with %d jobs, best of %d" % (opts.jobs, opts.reps)
+    print "%-40s %10.4f s" % ("whole statefile (pickle and write)", best(whole, opts.reps))
+    print "%-40s %10.4f s" % ("snapshot checkpoint", best(snapshot, opts.reps))
+    journal.snapshot_interval = 3600
+    snapshot()
+    print "%-40s %10.4f s" % ("journal checkpoint, %d jobs changed" % opts.changed, best(checkpoint, opts.reps))
+    journal.close()
+
+    for name in [statefile, statefile + ".journal", _config_file]:
+        if os.path.exists(name):
+            os.unlink(name)
+
+
+if __name__ == '__main__':
+    main()
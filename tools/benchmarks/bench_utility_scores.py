@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright 2017 UChicago Argonne, LLC. All rights reserved.
+# Licensed under a modified BSD 3-clause license. See LICENSE for details.
+'''Benchmark utility scoring in the queue manager.
+
+Builds a QueueManager in-process with a large number of runnable jobs spread
+over queues using the builtin policies and two user policies (one marked
+vectorized, one not) and times compute_utility_scores with and without numpy.
+
+Usage: bench_utility_scores.py [--jobs N] [--passes N]
+'''
+
+import sys
+import os
+import time
+import tempfile
+import logging
+import optparse
+
+import Cobalt
+
+UTILITY_DEFINITIONS = '''
+@vectorized
+def wfp():
+    return (queued_time / wall_time) ** 3 * size
+
+def unicef():
+    return max(queued_time / 60.0, 1.0) / math.log(max(size, 2))
+'''
+
+_fd, _utility_file = tempfile.mkstemp()
+os.write(_fd, UTILITY_DEFINITIONS)
+os.close(_fd)
+_fd, _config_file = tempfile.mkstemp()
+os.write(_fd, "[cqm]\nlog_dir: %s\n[bgsched]\nutility_file: %s\n[system]\nsize: 5000\n" %
+        (tempfile.gettempdir(), _utility_file))
+os.close(_fd)
+Cobalt.CONFIG_FILES = [_config_file]
+
+import Cobalt.Components.cqm
+from Cobalt.Components.cqm import QueueManager
+
+POLICIES = ['default', 'high_prio', 'wfp', 'unicef']
+
+
+class _Quiet(object):
+    '''Discard stdout while jobs are created (Job.__init__ prints).'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def timed(label, func, passes):
+    start = time.time()
+    with _Quiet():
+        for _ in xrange(passes):
+            func()
+    print "%-40s %10.4f s" % (label, (time.time() - start) / passes)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--jobs", type="int", default=50000, help="number of runnable jobs")
+    parser.add_option("--passes", type="int", default=3, help="scoring passes to average over")
+    opts, _ = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with _Quiet():
+        cqm = QueueManager(register=False)
+        for policy in POLICIES:
+            cqm.add_queues([{'tag':'queue', 'name':policy, 'policy':policy, 'state':'running'}])
+        cqm.set_queues([{'tag':'queue', 'name':'*'}], {'priority':1})
+        for queue_name in POLICIES:
+            # bulk load straight into the JobList; submission cost is not what is measured here
+            cqm.Queues[queue_name].jobs.q_add([{'tag':'job', 'queue':queue_name, 'user':'bench', 'nodes':1 + count % 512,
+                'walltime':10 + count % 720, 'submittime':time.time() - count} for count in xrange(opts.jobs // len(POLICIES))])
+        cqm.get_jobs([{'jobid':1}])
+    os.unlink(_utility_file)
+    os.unlink(_config_file)
+
+    print "%d runnable jobs, policies: %s" % (len(cqm.get_jobs([{'is_runnable':True}])), ", ".join(POLICIES))
+    if Cobalt.Components.cqm.numpy is not None:
+        timed("compute_utility_scores (numpy)", cqm.compute_utility_scores, opts.passes)
+        Cobalt.Components.cqm.numpy = None
+    timed("compute_utility_scores (pure python)", cqm.compute_utility_scores, opts.passes)
+
+
+if __name__ == '__main__':
+    main()